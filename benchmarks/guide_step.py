@@ -0,0 +1,121 @@
+"""
+Benchmark one spatial guidance iteration (GaussianDiffusion.gradients) with the
+autograd recover_from_ric, the fused RecoverFromRic backward, and the sparse
+path that recovers only the hinted joints and frames.
+
+Before timing, the hand-derived backward of RecoverFromRic is checked against finite differences
+(torch.autograd.gradcheck, float64) and its forward against recover_from_ric, for 22 and 21 joints.
+
+Runs on random features, no dataset or checkpoint is needed:
+    python -m benchmarks.guide_step --batch_size 32 --device cpu
+"""
+import argparse
+import time
+
+import torch
+
+from data_loaders.humanml.scripts.motion_process import recover_from_ric, recover_from_ric_fused, recover_from_ric_sparse
+
+
+def guide_gradients(x, hint, mask_hint, mean, std, recover_fn):
+    # mirrors GaussianDiffusion.gradients
+    with torch.enable_grad():
+        x.requires_grad_(True)
+        x_ = x.permute(0, 3, 2, 1).contiguous().squeeze(2)
+        x_ = x_ * std + mean
+        n_joints = 22 if x_.shape[-1] == 263 else 21
+        joint_pos = recover_fn(x_, n_joints)
+        loss = torch.norm((joint_pos - hint) * mask_hint, dim=-1)
+        grad = torch.autograd.grad([loss.sum()], [x])[0]
+        grad[..., 0] = 0
+    return loss, grad
+
+
+def sparse_guide_gradients(x, hint, mask_hint, mean, std, joint_ids, frame_ids):
+    # mirrors GaussianDiffusion.gradients with joint_ids/frame_ids
+    with torch.enable_grad():
+        x.requires_grad_(True)
+        x_ = x.permute(0, 3, 2, 1).squeeze(2)
+        n_joints = 22 if x_.shape[-1] == 263 else 21
+        joint_pos = recover_from_ric_sparse(x_, n_joints, joint_ids, frame_ids, mean=mean, std=std)
+        loss = torch.norm((joint_pos - hint) * mask_hint, dim=-1)
+        grad = torch.autograd.grad([loss.sum()], [x])[0]
+        grad[..., 0] = 0
+    return loss, grad
+
+
+def check_recover_from_ric_fused(device, n_frames=8, atol=1e-6):
+    """
+    Raise if recover_from_ric_fused does not match recover_from_ric, or if its backward does
+    not match finite differences.
+    """
+    for njoints, n_joints in [(263, 22), (251, 21)]:
+        data = torch.randn(2, n_frames, njoints, device=device) * 0.3
+        max_diff = (recover_from_ric_fused(data, n_joints) - recover_from_ric(data.clone(), n_joints)).abs().max().item()
+        assert max_diff < atol, f'{n_joints} joints: forward differs from recover_from_ric by {max_diff:.2e}'
+        data = data.double().requires_grad_(True)
+        assert torch.autograd.gradcheck(lambda d: recover_from_ric_fused(d, n_joints), (data,)), \
+            f'{n_joints} joints: backward does not match finite differences'
+
+
+def time_fn(fn, n_iters, device):
+    for _ in range(3):  # warmup
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(n_iters):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / n_iters
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", default=32, type=int)
+    parser.add_argument("--n_frames", default=196, type=int)
+    parser.add_argument("--n_iters", default=50, type=int, help="Number of timed guidance iterations.")
+    parser.add_argument("--dataset", default='humanml', choices=['humanml', 'kit'], type=str)
+    parser.add_argument("--device", default='cpu', type=str)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    njoints, n_joints = (263, 22) if args.dataset == 'humanml' else (251, 21)
+    torch.manual_seed(0)
+    check_recover_from_ric_fused(device)
+    x = torch.randn(args.batch_size, njoints, 1, args.n_frames, device=device) * 0.3
+    mean = torch.randn(njoints, device=device) * 0.1
+    std = torch.rand(njoints, device=device) * 0.1 + 0.05
+    # pelvis hints on every 10th frame, as in the trajectory-following setup
+    mask_hint = torch.zeros(args.batch_size, args.n_frames, n_joints, 1, dtype=torch.bool, device=device)
+    mask_hint[:, ::10, 0] = True
+    hint = torch.randn(args.batch_size, args.n_frames, n_joints, 3, device=device) * mask_hint
+
+    _, grad_autograd = guide_gradients(x.clone(), hint, mask_hint, mean, std, recover_from_ric)
+    _, grad_fused = guide_gradients(x.clone(), hint, mask_hint, mean, std, recover_from_ric_fused)
+    joint_ids = torch.nonzero(mask_hint.any(dim=1).any(dim=0).squeeze(-1)).squeeze(1)
+    frame_ids = torch.nonzero(mask_hint.any(dim=2).any(dim=0).squeeze(-1)).squeeze(1)
+    sparse_hint = hint[:, frame_ids][:, :, joint_ids]
+    sparse_mask_hint = mask_hint[:, frame_ids][:, :, joint_ids]
+    _, grad_sparse = sparse_guide_gradients(x.clone(), sparse_hint, sparse_mask_hint, mean, std, joint_ids, frame_ids)
+    max_diff = max((grad_autograd - grad_fused).abs().max().item(), (grad_autograd - grad_sparse).abs().max().item())
+
+    t_autograd = time_fn(lambda: guide_gradients(x.clone(), hint, mask_hint, mean, std, recover_from_ric),
+                         args.n_iters, device)
+    t_fused = time_fn(lambda: guide_gradients(x.clone(), hint, mask_hint, mean, std, recover_from_ric_fused),
+                      args.n_iters, device)
+    t_sparse = time_fn(lambda: sparse_guide_gradients(x.clone(), sparse_hint, sparse_mask_hint, mean, std,
+                                                      joint_ids, frame_ids),
+                       args.n_iters, device)
+
+    print(f'batch_size {args.batch_size}, n_frames {args.n_frames}, device {args.device}')
+    print(f'autograd recover_from_ric: {t_autograd * 1000:.3f} ms / guide iteration')
+    print(f'fused RecoverFromRic:      {t_fused * 1000:.3f} ms / guide iteration ({t_autograd / t_fused:.2f}x)')
+    print(f'sparse (hinted only):      {t_sparse * 1000:.3f} ms / guide iteration ({t_autograd / t_sparse:.2f}x)')
+    print(f'max gradient difference:   {max_diff:.2e}')
+    print('RecoverFromRic forward and gradcheck (22 and 21 joints): ok')
+
+
+if __name__ == "__main__":
+    main()
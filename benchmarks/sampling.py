@@ -0,0 +1,165 @@
+"""
+Benchmark the sampling loop on a randomly initialized CMDM (and CLIP text tower), with synthetic
+normalization statistics, prompts and pelvis hints: no checkpoint, dataset, SMPL or GloVe is needed.
+
+Every combination of --batch_sizes, --n_frames, --sample_steps, --guide_iterations and --cfg is
+sampled --n_repeats times, after a warmup run, and the samples/sec, the per-step latency and the
+per-step stage timings (see diffusion/profiler.py) are written to --output_path as json:
+    python -m benchmarks.sampling --batch_sizes 1 8 --sample_steps 10 50 --guide_iterations 0 10 --output_path sampling.json
+"""
+import argparse
+import datetime
+import itertools
+import json
+import os
+import platform
+import statistics
+import subprocess
+from types import SimpleNamespace
+
+import torch
+
+from diffusion.guidance import GuidanceSchedule
+from diffusion.profiler import SamplingProfiler
+from model import cmdm
+from model.cfg_sampler import ClassifierFreeSampleModel
+from model.clip_text import CLIPTextTower
+from utils.model_util import get_model_args, create_gaussian_diffusion, get_sample_fn
+
+PROMPTS = ['a person walks forward.', 'a person jumps up and down.', 'a person waves with the right hand.',
+           'a person walks in a circle.', 'a person kicks with the left leg.', 'a person sits down.']
+STEP_STAGES = ['model', 'control', 'trunk', 'guide']
+
+
+def random_clip_text_tower():
+    # the text tower of ViT-B/32, registered as the frozen CLIP of the CMDM instances instead of clip.load
+    clip_model = CLIPTextTower(embed_dim=512, context_length=77, vocab_size=49408, transformer_width=512,
+                               transformer_heads=8, transformer_layers=12)
+    torch.nn.init.normal_(clip_model.positional_embedding, std=0.01)
+    torch.nn.init.normal_(clip_model.text_projection, std=512 ** -0.5)
+    clip_model.eval()
+    for p in clip_model.parameters():
+        p.requires_grad = False
+    return clip_model
+
+
+def synthetic_norm_stats(njoints, n_joints):
+    return {'mean': torch.randn(njoints) * 0.1, 'std': torch.rand(njoints) * 0.5 + 0.5,
+            'raw_mean': torch.randn(n_joints * 3) * 0.1, 'raw_std': torch.rand(n_joints * 3) * 0.5 + 0.5}
+
+
+def synthetic_model_kwargs(diffusion, bs, n_frames, n_joints, fps, device):
+    # the pelvis walking forward, hinted every 10th frame, normalized as the dataset hints
+    hint = torch.zeros(bs, n_frames, n_joints, 3)
+    frames = torch.arange(0, n_frames, 10)
+    hint[:, frames, 0, 1] = 0.95
+    hint[:, frames, 0, 2] = 1.2 * frames.float() / fps
+    mask = hint.sum(-1, keepdim=True) != 0
+    raw_mean, raw_std = diffusion.raw_mean.view(n_joints, 3), diffusion.raw_std.view(n_joints, 3)
+    hint = (hint - raw_mean) / raw_std * mask
+    return {'y': {'text': [PROMPTS[i % len(PROMPTS)] for i in range(bs)],
+                  'mask': torch.ones(bs, 1, 1, n_frames, dtype=torch.bool, device=device),
+                  'lengths': torch.full((bs,), n_frames, dtype=torch.long, device=device),
+                  'hint': hint.view(bs, n_frames, -1).to(device)}}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_sizes", default=[1, 8], type=int, nargs='+')
+    parser.add_argument("--n_frames", default=[196], type=int, nargs='+')
+    parser.add_argument("--sample_steps", default=[10, 50], type=int, nargs='+',
+                        help="Numbers of denoising steps (respaced from 1000).")
+    parser.add_argument("--guide_iterations", default=[0, 10], type=int, nargs='+',
+                        help="Numbers of spatial guidance gradient steps per denoising step.")
+    parser.add_argument("--cfg", default=['off', 'on'], choices=['off', 'on'], type=str, nargs='+',
+                        help="Sample without/with classifier-free guidance (two model passes per step).")
+    parser.add_argument("--guidance_param", default=2.5, type=float, help="The classifier-free guidance scale.")
+    parser.add_argument("--fused_cfg", action='store_true', help="Run both CFG passes as one batched pass.")
+    parser.add_argument("--sampler", default='ddim', choices=['ddpm', 'ddim', 'dpmsolver'], type=str)
+    parser.add_argument("--latent_dim", default=512, type=int)
+    parser.add_argument("--layers", default=8, type=int)
+    parser.add_argument("--dataset", default='humanml', choices=['humanml', 'kit'], type=str)
+    parser.add_argument("--n_repeats", default=3, type=int, help="Number of timed runs per configuration.")
+    parser.add_argument("--num_threads", default=0, type=int, help="torch threads, 0 keeps the default.")
+    parser.add_argument("--device", default='cpu', type=str)
+    parser.add_argument("--seed", default=0, type=int)
+    parser.add_argument("--output_path", default='sampling_benchmark.json', type=str)
+    args = parser.parse_args()
+
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+    device = torch.device(args.device)
+    torch.manual_seed(args.seed)
+    model_args = SimpleNamespace(dataset=args.dataset, latent_dim=args.latent_dim, layers=args.layers,
+                                 cond_mode='both_text_spatial', cond_mask_prob=0.1, arch='trans_enc',
+                                 emb_trans_dec=False, noise_schedule='cosine', sigma_small=True, lambda_vel=0.,
+                                 lambda_rcxyz=0., lambda_fc=0., sampler=args.sampler, ddim_eta=0.,
+                                 dpm_solver_order=2)
+    cmdm_args = get_model_args(model_args, SimpleNamespace(dataset=None))
+    if cmdm_args['clip_version'] not in cmdm._CLIP_MODELS:
+        cmdm._CLIP_MODELS[cmdm_args['clip_version']] = random_clip_text_tower()
+    model = cmdm.CMDM(**cmdm_args)
+    model.to(device)
+    model.eval()
+    cfg_model = ClassifierFreeSampleModel(model, fused=args.fused_cfg)
+    njoints, n_joints = model.njoints, 22 if model.njoints == 263 else 21
+    fps = 12.5 if args.dataset == 'kit' else 20
+    norm_stats = synthetic_norm_stats(njoints, n_joints)
+
+    results = []
+    for sample_steps in args.sample_steps:
+        model_args.sample_steps = sample_steps
+        diffusion = create_gaussian_diffusion(model_args, norm_stats=norm_stats)
+        sample_fn = get_sample_fn(model_args, diffusion)
+        for guide_iterations, cfg, n_frames, bs in itertools.product(args.guide_iterations, args.cfg, args.n_frames,
+                                                                    args.batch_sizes):
+            diffusion.guide_schedule = GuidanceSchedule(n_steps=guide_iterations, n_steps_tail=guide_iterations)
+            model_kwargs = synthetic_model_kwargs(diffusion, bs, n_frames, n_joints, fps, device)
+            if cfg == 'on':
+                model_kwargs['y']['scale'] = torch.full((bs,), args.guidance_param, device=device)
+            runs = []
+            for run in range(args.n_repeats + 1):  # the first one is the warmup
+                model.text_embed_cache.clear()  # every run encodes its prompts
+                profiler = SamplingProfiler(sync_cuda=True)
+                with profiler:
+                    sample_fn(cfg_model if cfg == 'on' else model, (bs, njoints, model.nfeats, n_frames),
+                              clip_denoised=False, model_kwargs=model_kwargs, progress=False)
+                if run > 0:
+                    runs.append(profiler)
+
+            times = [p.total_time for p in runs]
+            step_times = [step['time_step'] for p in runs for step in p.steps]
+            result = {'batch_size': bs, 'n_frames': n_frames, 'sample_steps': sample_steps,
+                      'guide_iterations': guide_iterations, 'cfg': cfg == 'on',
+                      'time': statistics.median(times), 'time_min': min(times),
+                      'samples_per_sec': bs / statistics.median(times),
+                      'step_latency': statistics.median(step_times), 'step_latency_max': max(step_times),
+                      # the text encoding runs once per batch, before the steps
+                      'time_clip': sum(p.totals.get('time_clip', 0.) for p in runs) / len(runs)}
+            for stage in STEP_STAGES:  # the mean time of the stage per step
+                result['step_time_' + stage] = sum(p.totals.get('time_' + stage, 0.) for p in runs) / len(step_times)
+            results.append(result)
+            print(f"bs {bs:3d}, {n_frames} frames, {sample_steps} steps, {guide_iterations} guide iterations, "
+                  f"cfg {cfg:>3}: {result['samples_per_sec']:.2f} samples/s, "
+                  f"{result['step_latency'] * 1000:.1f} ms / step (model {result['step_time_model'] * 1000:.1f} ms, "
+                  f"guide {result['step_time_guide'] * 1000:.1f} ms)")
+
+    output = {'date': datetime.datetime.now().isoformat(), 'git_commit': git_commit(),
+              'torch': torch.__version__, 'num_threads': torch.get_num_threads(),
+              'platform': platform.platform(), 'processor': platform.processor(),
+              'args': vars(args), 'results': results}
+    with open(args.output_path, 'w') as fw:
+        json.dump(output, fw, indent=2)
+    print(f'Saved [{args.output_path}]')
+
+
+if __name__ == "__main__":
+    main()
@@ -7,16 +7,14 @@ from utils import dist_util
 
 class CompMDMGeneratedDataset(Dataset):
 
-    def __init__(self, model, diffusion, dataloader, mm_num_samples, mm_num_repeats, max_motion_length, num_samples_limit, scale=1.):
+    def __init__(self, model, diffusion, dataloader, mm_num_samples, mm_num_repeats, max_motion_length, num_samples_limit, scale=1., sample_fn=None, text_only=False):
         self.dataloader = dataloader
         self.dataset = dataloader.dataset
         assert mm_num_samples < len(dataloader.dataset)
-        use_ddim = False  # FIXME - hardcoded
         clip_denoised = False  # FIXME - hardcoded
         self.max_motion_length = max_motion_length
-        sample_fn = (
-            diffusion.p_sample_loop if not use_ddim else diffusion.ddim_sample_loop
-        )
+        if sample_fn is None:
+            sample_fn = diffusion.p_sample_loop
 
         real_num_batches = len(dataloader)
         if num_samples_limit is not None:
@@ -46,6 +44,9 @@ class CompMDMGeneratedDataset(Dataset):
 
                 tokens = [t.split('_') for t in model_kwargs['y']['tokens']]
 
+                # the hints are kept for the control metrics, but not given to the model
+                hint = model_kwargs['y'].pop('hint') if text_only else model_kwargs['y'].get('hint')
+
                 # add CFG scale to batch
                 if scale != 1.:
                     model_kwargs['y']['scale'] = torch.ones(motion.shape[0],
@@ -75,7 +76,7 @@ class CompMDMGeneratedDataset(Dataset):
                         sub_dicts = [{'motion': sample[bs_i].squeeze().permute(1,0).cpu().numpy(),
                                     'length': model_kwargs['y']['lengths'][bs_i].cpu().numpy(),
                                     'caption': model_kwargs['y']['text'][bs_i],
-                                    'hint': model_kwargs['y']['hint'][bs_i].cpu().numpy() if 'hint' in model_kwargs['y'] else None,
+                                    'hint': hint[bs_i].cpu().numpy() if hint is not None else None,
                                     'tokens': tokens[bs_i],
                                     'cap_len': len(tokens[bs_i]),
                                     } for bs_i in range(dataloader.batch_size)]
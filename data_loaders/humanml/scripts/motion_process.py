@@ -428,6 +428,211 @@ def recover_from_ric(data, joints_num):
     positions = torch.cat([r_pos.unsqueeze(-2), positions], dim=-2)
 
     return positions
+
+
+class RecoverFromRic(torch.autograd.Function):
+    '''
+    recover_from_ric with a hand-derived backward, used by the spatial guidance.
+    The root rotation is a rotation around Y by theta = 2 * cumsum(rot_vel), so the
+    quaternions are replaced by cos/sin of theta, and the backward only keeps those.
+    '''
+
+    @staticmethod
+    def forward(ctx, data, joints_num):
+        shape = data.shape
+        data = data.reshape(-1, shape[-2], shape[-1])
+        cos, sin = _ric_root_rotation(data)
+        r_vel_x, r_vel_z = _ric_rotate(cos, sin, *_ric_root_vel(data))
+        r_pos_x = torch.cumsum(r_vel_x, dim=-1)
+        r_pos_z = torch.cumsum(r_vel_z, dim=-1)
+
+        local = data[..., 4:(joints_num - 1) * 3 + 4].view(data.shape[:-1] + (joints_num - 1, 3))
+        x, z = _ric_rotate(cos[..., None], sin[..., None], local[..., 0], local[..., 2])
+
+        positions = data.new_empty(data.shape[:-1] + (joints_num, 3))
+        positions[..., 0, 0] = r_pos_x
+        positions[..., 0, 1] = data[..., 3]
+        positions[..., 0, 2] = r_pos_z
+        positions[..., 1:, 0] = x + r_pos_x[..., None]
+        positions[..., 1:, 1] = local[..., 1]
+        positions[..., 1:, 2] = z + r_pos_z[..., None]
+
+        ctx.save_for_backward(data, cos, sin)
+        ctx.joints_num = joints_num
+        ctx.shape = shape
+        return positions.view(shape[:-1] + (joints_num, 3))
+
+    @staticmethod
+    @torch.autograd.function.once_differentiable
+    def backward(ctx, grad_positions):
+        data, cos, sin = ctx.saved_tensors
+        joints_num = ctx.joints_num
+        grad = grad_positions.reshape(data.shape[:-1] + (joints_num, 3))
+        grad_data = torch.zeros_like(data)
+
+        # root height and local joints, rotated back by the transposed rotation
+        grad_data[..., 3] = grad[..., 0, 1]
+        g_x, g_z = grad[..., 1:, 0], grad[..., 1:, 2]
+        grad_local = grad_data[..., 4:(joints_num - 1) * 3 + 4].view(data.shape[:-1] + (joints_num - 1, 3))
+        grad_local[..., 0], grad_local[..., 2] = _ric_rotate(cos[..., None], -sin[..., None], g_x, g_z)
+        grad_local[..., 1] = grad[..., 1:, 1]
+
+        # root XZ is added to all the joints, then integrated over time by the cumsum
+        h_x = _reverse_cumsum(grad[..., 0].sum(dim=-1))
+        h_z = _reverse_cumsum(grad[..., 2].sum(dim=-1))
+        grad_vel_x, grad_vel_z = _ric_rotate(cos, -sin, h_x, h_z)
+        grad_data[..., :-1, 1] = grad_vel_x[..., 1:]
+        grad_data[..., :-1, 2] = grad_vel_z[..., 1:]
+
+        # d(x', z')/d(theta) = (-z', x') for the rotated local joints and root velocities
+        local = data[..., 4:(joints_num - 1) * 3 + 4].view(data.shape[:-1] + (joints_num - 1, 3))
+        x, z = _ric_rotate(cos[..., None], sin[..., None], local[..., 0], local[..., 2])
+        r_vel_x, r_vel_z = _ric_rotate(cos, sin, *_ric_root_vel(data))
+        grad_theta = (g_z * x - g_x * z).sum(dim=-1) + h_z * r_vel_x - h_x * r_vel_z
+        # theta[t] = 2 * sum_{k<t} rot_vel[k]
+        grad_data[..., :-1, 0] = 2 * _reverse_cumsum(grad_theta)[..., 1:]
+
+        return grad_data.view(ctx.shape), None
+
+
+def _ric_root_rotation(data):
+    # cos/sin of the root Y rotation applied by qrot(qinv(r_rot_quat), .) in recover_root_rot_pos
+    r_rot_ang = torch.zeros_like(data[..., 0])
+    r_rot_ang[..., 1:] = torch.cumsum(data[..., :-1, 0], dim=-1)
+    return torch.cos(2 * r_rot_ang), torch.sin(2 * r_rot_ang)
+
+
+def _ric_root_vel(data):
+    vel_x = torch.zeros_like(data[..., 0])
+    vel_z = torch.zeros_like(data[..., 0])
+    vel_x[..., 1:] = data[..., :-1, 1]
+    vel_z[..., 1:] = data[..., :-1, 2]
+    return vel_x, vel_z
+
+
+def _ric_rotate(cos, sin, x, z):
+    return cos * x - sin * z, sin * x + cos * z
+
+
+def _reverse_cumsum(x):
+    return torch.flip(torch.cumsum(torch.flip(x, dims=[-1]), dim=-1), dims=[-1])
+
+
+def recover_from_ric_fused(data, joints_num):
+    # same output as recover_from_ric, with a cheaper backward pass
+    return RecoverFromRic.apply(data, joints_num)
+
+
+def recover_from_ric_sparse(data, joints_num, joint_ids, frame_ids, mean=None, std=None):
+    '''
+    recover_from_ric restricted to the given joints and frames.
+    data: [..., seqlen, 263/251], joint_ids/frame_ids: sorted 1-D index tensors.
+    If mean/std are given, data is normalized and only the features that are used get de-normalized.
+    Only the root features are read for all the frames up to the last one in frame_ids (for the cumsum),
+    the local joint features are read at frame_ids only.
+    returns: [..., len(frame_ids), len(joint_ids), 3]
+    '''
+    n_frames = int(frame_ids[-1]) + 1
+    root = data[..., :n_frames, :4]
+    if mean is not None:
+        root = root * std[:4] + mean[:4]
+    zeros = torch.zeros_like(root[..., :1, 0])
+
+    r_rot_ang = torch.cat([zeros, torch.cumsum(root[..., :-1, 0], dim=-1)], dim=-1)
+    cos, sin = torch.cos(2 * r_rot_ang), torch.sin(2 * r_rot_ang)
+    vel_x = torch.cat([zeros, root[..., :-1, 1]], dim=-1)
+    vel_z = torch.cat([zeros, root[..., :-1, 2]], dim=-1)
+    r_vel_x, r_vel_z = _ric_rotate(cos, sin, vel_x, vel_z)
+    r_pos_x = torch.cumsum(r_vel_x, dim=-1)[..., frame_ids]
+    r_pos_z = torch.cumsum(r_vel_z, dim=-1)[..., frame_ids]
+
+    positions = []
+    if joint_ids[0] == 0:
+        positions.append(torch.stack([r_pos_x, root[..., frame_ids, 3], r_pos_z], dim=-1).unsqueeze(-2))
+    local_ids = joint_ids[joint_ids > 0]
+    if len(local_ids) > 0:
+        feats = (4 + (local_ids[:, None] - 1) * 3 + torch.arange(3, device=local_ids.device)).view(-1)
+        local = data[..., frame_ids, :][..., feats]
+        if mean is not None:
+            local = local * std[feats] + mean[feats]
+        local = local.view(local.shape[:-1] + (len(local_ids), 3))
+        x, z = _ric_rotate(cos[..., frame_ids, None], sin[..., frame_ids, None], local[..., 0], local[..., 2])
+        positions.append(torch.stack([x + r_pos_x[..., None], local[..., 1], z + r_pos_z[..., None]], dim=-1))
+    return torch.cat(positions, dim=-2)
+
+
+def project_root_hint(data, hint, mask, frame_ids, mean, std, eps=1e-6):
+    '''
+    Closed-form projection of the root (pelvis) trajectory onto root hints.
+    With the root rotations fixed, the root XZ positions are a cumulative sum of the rotated
+    root velocities, so hitting the hints is a linear least-squares problem. The root velocities
+    get the minimal correction (in normalized features) that moves the root onto the hints, and
+    the root height is set at the hinted frames. The first frame is left untouched, like in the
+    spatial guidance, so hints on the first two frames cannot be reached.
+    data: [bs, seqlen, 263/251] normalized features, mean/std: the normalization.
+    hint: [bs, len(frame_ids), 3] root positions at frame_ids, mask: [bs, len(frame_ids)] bool.
+    eps: relative damping of the least-squares system.
+    returns: the corrected data
+    '''
+    bs, n_frames = data.shape[:2]
+    n = len(frame_ids)
+    root = data[..., :4] * std[:4] + mean[:4]
+    cos, sin = _ric_root_rotation(root)
+    r_vel_x, r_vel_z = _ric_rotate(cos, sin, *_ric_root_vel(root))
+    r_pos_x = torch.cumsum(r_vel_x, dim=-1)[:, frame_ids]
+    r_pos_z = torch.cumsum(r_vel_z, dim=-1)[:, frame_ids]
+    residual = torch.stack([hint[..., 0] - r_pos_x, hint[..., 2] - r_pos_z], dim=-1) * mask[..., None]
+
+    # the position at frame f moves by sum_{0<j<f} M_j u_j, with M_j = R_{j+1} diag(std_vx, std_vz)
+    # and u_j the correction of the normalized velocity features of frame j
+    cos_j, sin_j = cos[:, 1:], sin[:, 1:]
+    a, b = std[1] ** 2, std[2] ** 2
+    mm = torch.stack([a * cos_j ** 2 + b * sin_j ** 2, (a - b) * cos_j * sin_j,
+                      (a - b) * cos_j * sin_j, a * sin_j ** 2 + b * cos_j ** 2], dim=-1)  # M_j M_j^T
+    mm[:, 0] = 0  # the first frame is not corrected
+    # cov[f] = sum_{0<j<f} M_j M_j^T
+    cov = torch.cat([torch.zeros_like(mm[:, :1]), torch.cumsum(mm, dim=1)], dim=1)
+    min_ids = torch.minimum(frame_ids[:, None], frame_ids[None, :])
+    gram = cov[:, min_ids].view(bs, n, n, 2, 2).permute(0, 1, 3, 2, 4).reshape(bs, 2 * n, 2 * n)
+    # the frames that are not hinted in a sample only get an identity row
+    pair_mask = (mask[:, :, None] & mask[:, None, :])
+    pair_mask = pair_mask[:, :, None, :, None].expand(bs, n, 2, n, 2).reshape(bs, 2 * n, 2 * n)
+    damping = eps * cov[:, -1, [0, 3]].sum(dim=-1).clamp(min=1e-12)
+    eye = torch.eye(2 * n, dtype=data.dtype, device=data.device)
+    gram = gram * pair_mask + eye * (damping[:, None, None] + (~pair_mask.diagonal(dim1=1, dim2=2))[:, None].float())
+    lam = torch.linalg.solve(gram, residual.reshape(bs, 2 * n, 1)).view(bs, n, 2) * mask[..., None]
+
+    # u_j = M_j^T sum_{f > j} lambda_f
+    lam_frames = data.new_zeros(bs, n_frames + 1, 2)
+    lam_frames[:, frame_ids + 1] = lam
+    lam_frames = torch.flip(torch.cumsum(torch.flip(lam_frames, dims=[1]), dim=1), dims=[1])[:, 2:]
+    u_x, u_z = _ric_rotate(cos_j, -sin_j, lam_frames[..., 0], lam_frames[..., 1])
+
+    data = data.clone()
+    data[:, 1:-1, 1] += u_x[:, 1:] * std[1]
+    data[:, 1:-1, 2] += u_z[:, 1:] * std[2]
+    height = (hint[..., 1] - mean[3]) / std[3]
+    height_mask = mask & (frame_ids > 0)
+    data[:, frame_ids, 3] = torch.where(height_mask, height, data[:, frame_ids, 3])
+    return data
+
+
+def global_to_local(positions, data):
+    '''
+    Express global positions in the coordinates of a motion that starts at the last frame of data.
+    The features are relative to the root, only the root pose of the first frame is implicit (at the
+    origin, facing Z+), so a motion continuing data from its last frame recovers its joints in the
+    frame of the root pose of data at that frame.
+    positions: [..., n, joints, 3] global positions, data: [..., seqlen, 263/251] (de-normalized) features.
+    returns: [..., n, joints, 3]
+    '''
+    r_rot_quat, r_pos = recover_root_rot_pos(data)
+    r_rot_quat = r_rot_quat[..., -1:, None, :].expand(positions.shape[:-1] + (4,))
+    offset = r_pos[..., -1:, None, :].clone()
+    offset[..., 1] = 0
+    return qrot(r_rot_quat, positions - offset)
+
+
 '''
 For Text2Motion Dataset
 '''
@@ -0,0 +1,119 @@
+import torch as th
+from diffusion.profiler import profile_step
+
+
+class ContinuousBatchSampler:
+    """
+    Step-level scheduler of the sampling loop, for continuous batching.
+
+    The samples of a batch can be at different timesteps. Every call to step() takes one
+    denoising step (GaussianDiffusion.p_sample, or ddim_sample) for all of them, the
+    samples that reach t = 0 leave the batch and the waiting ones join it, so a new
+    request does not wait for the whole batch to finish.
+
+    :param diffusion: the (Spaced)GaussianDiffusion to sample from.
+    :param model: the model, e.g. a ClassifierFreeSampleModel.
+    :param max_batch_size: the maximal number of samples denoised together.
+    :param sampler: 'ddpm' or 'ddim'. DPM-Solver++ keeps a history of model outputs
+                    over the steps and is not supported.
+    :param eta: for ddim, the noise level.
+    :param clip_denoised: see p_sample.
+    """
+
+    def __init__(self, diffusion, model, max_batch_size=32, sampler='ddpm', eta=0.0, clip_denoised=False):
+        if sampler == 'ddpm':
+            self.step_fn = diffusion.p_sample
+        elif sampler == 'ddim':
+            self.step_fn = lambda *args, **kwargs: diffusion.ddim_sample(*args, eta=eta, **kwargs)
+        else:
+            raise ValueError(f'continuous batching supports the ddpm and ddim samplers, not {sampler}')
+        self.diffusion = diffusion
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.clip_denoised = clip_denoised
+        self.waiting = []
+        self.active = []
+        self.batch_y = None
+        self.n_submitted = 0
+
+    def __len__(self):
+        # the number of samples that are not finished yet
+        return len(self.waiting) + len(self.active)
+
+    def submit(self, y, shape, noise=None):
+        """
+        Queue a sample, it joins the batch at the next step() with a free slot.
+
+        :param y: the model_kwargs['y'] of this sample alone (batch size 1).
+        :param shape: the shape of the sample, (1, C, 1, n_frames). All the samples must
+                      have the same shape.
+        :param noise: if specified, the noise to start from.
+        :return: the id of the sample, returned by step() with the sample once it is finished.
+        """
+        assert shape[0] == 1
+        sample_id = self.n_submitted
+        self.n_submitted += 1
+        self.waiting.append({'id': sample_id, 'y': y, 'shape': tuple(shape), 'noise': noise})
+        return sample_id
+
+    def step(self):
+        """
+        Take one denoising step for all the samples in the batch.
+
+        :return: a dict from the ids of the samples finished at this step to their [1 x C x 1 x n_frames]
+                 samples.
+        """
+        while len(self.waiting) > 0 and len(self.active) < self.max_batch_size:
+            self._admit(self.waiting.pop(0))
+        if len(self.active) == 0:
+            return {}
+        if self.batch_y is None:
+            self.batch_y = _collate_y([s['y'] for s in self.active])
+
+        x = th.cat([s['x'] for s in self.active])
+        t = th.tensor([s['t'] for s in self.active], device=x.device)
+        with th.no_grad(), profile_step(max(s['t'] for s in self.active)):
+            out = self.step_fn(self.model, x, t, clip_denoised=self.clip_denoised,
+                               model_kwargs={'y': self.batch_y})
+
+        finished = {}
+        for s, sample in zip(self.active, out['sample'].split(1)):
+            s['x'], s['t'] = sample, s['t'] - 1
+            if s['t'] < 0:
+                finished[s['id']] = sample
+        if len(finished) > 0:
+            self.active = [s for s in self.active if s['t'] >= 0]
+            self.batch_y = None
+        return finished
+
+    def _admit(self, s):
+        device = next(self.model.parameters()).device
+        s['x'] = s.pop('noise')
+        if s['x'] is None:
+            s['x'] = th.randn(*s['shape'], device=device)
+        if len(self.active) > 0:
+            assert s['shape'] == self.active[0]['shape'], 'all the samples must have the same shape'
+        s['t'] = self.diffusion.num_timesteps - 1
+        if hasattr(self.model, 'cache_text_embedding'):
+            # encoded once when the sample joins, reused at all its steps
+            self.model.cache_text_embedding(s['y'])
+        self.active.append(s)
+        self.batch_y = None
+
+
+def _collate_y(ys):
+    # batch the model_kwargs['y'] of single samples, the samples without a hint get an empty one
+    hint = next((y['hint'] for y in ys if 'hint' in y), None)
+    batch_y = {}
+    for key in set().union(*ys):
+        if key == 'hint':
+            values = [y['hint'] if 'hint' in y else th.zeros_like(hint) for y in ys]
+        else:
+            values = [y[key] for y in ys]
+        if th.is_tensor(values[0]) and values[0].dim() > 0:
+            batch_y[key] = th.cat(values)
+        elif isinstance(values[0], list):
+            batch_y[key] = sum(values, [])
+        else:
+            batch_y[key] = values[0]
+    return batch_y
@@ -8,13 +8,17 @@ Docstrings have been added, as well as DDIM sampling and a new collection of bet
 
 import enum
 import math
+import threading
+import time
 
 import numpy as np
 import torch
 import torch as th
 from copy import deepcopy
 from diffusion.nn import mean_flat, sum_flat
-from data_loaders.humanml.scripts.motion_process import recover_from_ric
+from diffusion.guidance import create_named_guidance_schedule, create_guide_optimizer
+from diffusion.profiler import profile_stage, profile_step, profile_count
+from data_loaders.humanml.scripts.motion_process import recover_from_ric_fused, recover_from_ric_sparse, project_root_hint
 from os.path import join as pjoin
 
 
@@ -101,6 +105,42 @@ class LossType(enum.Enum):
         return self == LossType.KL or self == LossType.RESCALED_KL
 
 
+class CancellationToken:
+    """
+    Stops a sampling loop (see p_sample_loop) after the current step, once cancel() was
+    called (e.g. from another thread) or after timeout seconds.
+    """
+
+    def __init__(self, timeout=None):
+        self.deadline = None if timeout is None else time.time() + timeout
+        self.event = threading.Event()
+
+    def cancel(self):
+        self.event.set()
+
+    @property
+    def cancelled(self):
+        return self.event.is_set() or (self.deadline is not None and time.time() >= self.deadline)
+
+
+def load_norm_stats(dataset):
+    """
+    The normalization statistics of a dataset, see GaussianDiffusion.
+    """
+    if dataset == 'humanml':
+        spatial_norm_path = './dataset/humanml_spatial_norm'
+        data_root = './dataset/HumanML3D'
+    elif dataset == 'kit':
+        spatial_norm_path = './dataset/kit_spatial_norm'
+        data_root = './dataset/KIT-ML'
+    else:
+        raise NotImplementedError('Dataset not recognized!!')
+    return {'raw_mean': torch.from_numpy(np.load(pjoin(spatial_norm_path, 'Mean_raw.npy'))),
+            'raw_std': torch.from_numpy(np.load(pjoin(spatial_norm_path, 'Std_raw.npy'))),
+            'mean': torch.from_numpy(np.load(pjoin(data_root, 'Mean.npy'))),
+            'std': torch.from_numpy(np.load(pjoin(data_root, 'Std.npy')))}
+
+
 class GaussianDiffusion:
     """
     Utilities for training and sampling diffusion models.
@@ -116,6 +156,8 @@ class GaussianDiffusion:
     :param rescale_timesteps: if True, pass floating point timesteps into the
                               model so that they are always scaled like in the
                               original paper (0 to 1000).
+    :param norm_stats: a dict with the 'mean', 'std' (of the features) and 'raw_mean', 'raw_std'
+                       (of the joint positions) tensors, instead of the ones of the dataset files.
     """
 
     def __init__(
@@ -136,6 +178,9 @@ class GaussianDiffusion:
         lambda_vel_rcxyz=0.,
         lambda_fc=0.,
         dataset='humanml',
+        guide_schedule=None,
+        train_guide_schedule=None,
+        norm_stats=None,
     ):
         self.model_mean_type = model_mean_type
         self.model_var_type = model_var_type
@@ -155,6 +200,9 @@ class GaussianDiffusion:
         self.lambda_vel_rcxyz = lambda_vel_rcxyz
         self.lambda_fc = lambda_fc
 
+        self.guide_schedule = guide_schedule or create_named_guidance_schedule('default')
+        self.train_guide_schedule = train_guide_schedule or create_named_guidance_schedule('train')
+
         if self.lambda_rcxyz > 0. or self.lambda_vel > 0. or self.lambda_root_vel > 0. or \
                 self.lambda_vel_rcxyz > 0. or self.lambda_fc > 0.:
             assert self.loss_type == LossType.MSE, 'Geometric losses are supported by MSE loss type only!'
@@ -197,21 +245,34 @@ class GaussianDiffusion:
             * np.sqrt(alphas)
             / (1.0 - self.alphas_cumprod)
         )
+        # for fixedlarge, we set the initial (log-)variance like so
+        # to get a better decoder log likelihood.
+        self.fixed_large_variance = np.append(self.posterior_variance[1], self.betas[1:])
+        self.fixed_large_log_variance = np.log(self.fixed_large_variance)
+
+        # device copies of the arrays above, see _extract()
+        self._device_arrays = {}
 
         self.l2_loss = lambda a, b: (a - b) ** 2  # th.nn.MSELoss(reduction='none')  # must be None for handling mask later on.
 
-        if dataset == 'humanml':
-            spatial_norm_path = './dataset/humanml_spatial_norm'
-            data_root = './dataset/HumanML3D'
-        elif dataset == 'kit':
-            spatial_norm_path = './dataset/kit_spatial_norm'
-            data_root = './dataset/KIT-ML'
-        else:
-            raise NotImplementedError('Dataset not recognized!!')
-        self.raw_mean = torch.from_numpy(np.load(pjoin(spatial_norm_path, 'Mean_raw.npy')))
-        self.raw_std = torch.from_numpy(np.load(pjoin(spatial_norm_path, 'Std_raw.npy')))
-        self.mean = torch.from_numpy(np.load(pjoin(data_root, 'Mean.npy'))).float()
-        self.std = torch.from_numpy(np.load(pjoin(data_root, 'Std.npy'))).float()
+        if norm_stats is None:
+            norm_stats = load_norm_stats(dataset)
+        self.raw_mean, self.raw_std = norm_stats['raw_mean'], norm_stats['raw_std']
+        self.mean, self.std = norm_stats['mean'].float(), norm_stats['std'].float()
+
+    def _extract(self, name, timesteps, broadcast_shape):
+        """
+        _extract_into_tensor() for the array self.<name>, the array is copied to
+        the device of timesteps once, instead of at every call.
+        """
+        key = (name, timesteps.device)
+        arr = self._device_arrays.get(key)
+        if arr is None:
+            arr = self._device_arrays[key] = th.from_numpy(getattr(self, name)).to(timesteps.device).float()
+        res = arr[timesteps]
+        while len(res.shape) < len(broadcast_shape):
+            res = res[..., None]
+        return res.expand(broadcast_shape)
 
     def masked_l2(self, a, b, mask):
         # assuming a.shape == b.shape == bs, J, Jdim, seqlen
@@ -233,12 +294,10 @@ class GaussianDiffusion:
         :return: A tuple (mean, variance, log_variance), all of x_start's shape.
         """
         mean = (
-            _extract_into_tensor(self.sqrt_alphas_cumprod, t, x_start.shape) * x_start
+            self._extract('sqrt_alphas_cumprod', t, x_start.shape) * x_start
         )
         variance = _extract_into_tensor(1.0 - self.alphas_cumprod, t, x_start.shape)
-        log_variance = _extract_into_tensor(
-            self.log_one_minus_alphas_cumprod, t, x_start.shape
-        )
+        log_variance = self._extract('log_one_minus_alphas_cumprod', t, x_start.shape)
         return mean, variance, log_variance
 
     def q_sample(self, x_start, t, noise=None):
@@ -256,8 +315,8 @@ class GaussianDiffusion:
             noise = th.randn_like(x_start)
         assert noise.shape == x_start.shape
         return (
-            _extract_into_tensor(self.sqrt_alphas_cumprod, t, x_start.shape) * x_start
-            + _extract_into_tensor(self.sqrt_one_minus_alphas_cumprod, t, x_start.shape)
+            self._extract('sqrt_alphas_cumprod', t, x_start.shape) * x_start
+            + self._extract('sqrt_one_minus_alphas_cumprod', t, x_start.shape)
             * noise
         )
 
@@ -270,13 +329,11 @@ class GaussianDiffusion:
         """
         assert x_start.shape == x_t.shape
         posterior_mean = (
-            _extract_into_tensor(self.posterior_mean_coef1, t, x_t.shape) * x_start
-            + _extract_into_tensor(self.posterior_mean_coef2, t, x_t.shape) * x_t
-        )
-        posterior_variance = _extract_into_tensor(self.posterior_variance, t, x_t.shape)
-        posterior_log_variance_clipped = _extract_into_tensor(
-            self.posterior_log_variance_clipped, t, x_t.shape
+            self._extract('posterior_mean_coef1', t, x_t.shape) * x_start
+            + self._extract('posterior_mean_coef2', t, x_t.shape) * x_t
         )
+        posterior_variance = self._extract('posterior_variance', t, x_t.shape)
+        posterior_log_variance_clipped = self._extract('posterior_log_variance_clipped', t, x_t.shape)
         assert (
             posterior_mean.shape[0]
             == posterior_variance.shape[0]
@@ -313,7 +370,8 @@ class GaussianDiffusion:
 
         B, C = x.shape[:2]
         assert t.shape == (B,)
-        model_output = model(x, self._scale_timesteps(t), **model_kwargs)
+        with profile_stage('model'):
+            model_output = model(x, self._scale_timesteps(t), **model_kwargs)
 
         if 'inpainting_mask' in model_kwargs['y'].keys() and 'inpainted_motion' in model_kwargs['y'].keys():
             inpainting_mask, inpainted_motion = model_kwargs['y']['inpainting_mask'], model_kwargs['y']['inpainted_motion']
@@ -325,20 +383,12 @@ class GaussianDiffusion:
             # print('inpainted_motion', inpainted_motion.shape, inpainted_motion)
 
         model_variance, model_log_variance = {
-            # for fixedlarge, we set the initial (log-)variance like so
-            # to get a better decoder log likelihood.
-            ModelVarType.FIXED_LARGE: (
-                np.append(self.posterior_variance[1], self.betas[1:]),
-                np.log(np.append(self.posterior_variance[1], self.betas[1:])),
-            ),
-            ModelVarType.FIXED_SMALL: (
-                self.posterior_variance,
-                self.posterior_log_variance_clipped,
-            ),
+            ModelVarType.FIXED_LARGE: ('fixed_large_variance', 'fixed_large_log_variance'),
+            ModelVarType.FIXED_SMALL: ('posterior_variance', 'posterior_log_variance_clipped'),
         }[self.model_var_type]
 
-        model_variance = _extract_into_tensor(model_variance, t, x.shape)
-        model_log_variance = _extract_into_tensor(model_log_variance, t, x.shape)
+        model_variance = self._extract(model_variance, t, x.shape)
+        model_log_variance = self._extract(model_log_variance, t, x.shape)
 
         def process_xstart(x):
             if denoised_fn is not None:
@@ -380,8 +430,8 @@ class GaussianDiffusion:
     def _predict_xstart_from_eps(self, x_t, t, eps):
         assert x_t.shape == eps.shape
         return (
-            _extract_into_tensor(self.sqrt_recip_alphas_cumprod, t, x_t.shape) * x_t
-            - _extract_into_tensor(self.sqrt_recipm1_alphas_cumprod, t, x_t.shape) * eps
+            self._extract('sqrt_recip_alphas_cumprod', t, x_t.shape) * x_t
+            - self._extract('sqrt_recipm1_alphas_cumprod', t, x_t.shape) * eps
         )
 
     def _predict_xstart_from_xprev(self, x_t, t, xprev):
@@ -396,15 +446,22 @@ class GaussianDiffusion:
 
     def _predict_eps_from_xstart(self, x_t, t, pred_xstart):
         return (
-            _extract_into_tensor(self.sqrt_recip_alphas_cumprod, t, x_t.shape) * x_t
+            self._extract('sqrt_recip_alphas_cumprod', t, x_t.shape) * x_t
             - pred_xstart
-        ) / _extract_into_tensor(self.sqrt_recipm1_alphas_cumprod, t, x_t.shape)
+        ) / self._extract('sqrt_recipm1_alphas_cumprod', t, x_t.shape)
 
     def _scale_timesteps(self, t):
         if self.rescale_timesteps:
             return t.float() * (1000.0 / self.num_timesteps)
         return t
 
+    def original_timesteps(self, t):
+        """
+        :param t: a tensor of timesteps of this diffusion process.
+        :return: the same timesteps in the original diffusion process (see SpacedDiffusion).
+        """
+        return t
+
     def condition_mean(self, cond_fn, p_mean_var, x, t, model_kwargs=None):
         """
         Compute the mean for the previous step, given a function cond_fn that
@@ -420,54 +477,116 @@ class GaussianDiffusion:
         )
         return new_mean
 
-    def gradients(self, x, hint, mask_hint, joint_ids=None):
+    def condition_score(self, cond_fn, p_mean_var, x, t, model_kwargs=None):
+        """
+        Compute what the p_mean_variance output would have been, should the
+        model's score function be conditioned by cond_fn.
+
+        See condition_mean() for details on cond_fn.
+
+        Unlike condition_mean(), this instead uses the conditioning strategy
+        from Song et al (2020).
+        """
+        alpha_bar = self._extract('alphas_cumprod', t, x.shape)
+
+        eps = self._predict_eps_from_xstart(x, t, p_mean_var["pred_xstart"])
+        eps = eps - (1 - alpha_bar).sqrt() * cond_fn(
+            x, self._scale_timesteps(t), **model_kwargs
+        )
+
+        out = p_mean_var.copy()
+        out["pred_xstart"] = self._predict_xstart_from_eps(x, t, eps)
+        out["mean"], _, _ = self.q_posterior_mean_variance(
+            x_start=out["pred_xstart"], x_t=x, t=t
+        )
+        return out
+
+    def gradients(self, x, hint, mask_hint, joint_ids=None, frame_ids=None, squared=False):
+        """
+        Gradient of the control loss w.r.t. x.
+
+        If joint_ids/frame_ids are given, only these joints are recovered at these frames,
+        and hint/mask_hint are expected to be restricted to them already.
+        If squared, the gradient is the one of the least-squares loss, half the sum of the
+        squared distances, the returned loss are still the distances.
+        """
         with torch.enable_grad():
             x.requires_grad_(True)
 
-            x_ = x.permute(0, 3, 2, 1).contiguous()
+            x_ = x.permute(0, 3, 2, 1)
             x_ = x_.squeeze(2)
-            x_ = x_ * self.std + self.mean
             n_joints = 22 if x_.shape[-1] == 263 else 21
-            joint_pos = recover_from_ric(x_, n_joints)
+            if joint_ids is None:
+                x_ = x_ * self.std + self.mean
+                joint_pos = recover_from_ric_fused(x_, n_joints)
+            else:
+                joint_pos = recover_from_ric_sparse(x_, n_joints, joint_ids, frame_ids, mean=self.mean, std=self.std)
             if n_joints == 21:
                 joint_pos = joint_pos * 0.001
                 hint = hint * 0.001
 
             loss = torch.norm((joint_pos - hint) * mask_hint, dim=-1)
-            grad = torch.autograd.grad([loss.sum()], [x])[0]
+            objective = 0.5 * (loss ** 2).sum() if squared else loss.sum()
+            grad = torch.autograd.grad([objective], [x])[0]
             # the motion in HumanML3D always starts at the origin (0,y,0), so we zero out the gradients for the root joint
             grad[..., 0] = 0
             x.detach()
         return loss, grad
 
     def calc_grad_scale(self, mask_hint):
-        assert mask_hint.shape[1] == 196
         num_keyframes = mask_hint.sum(dim=1).squeeze(-1)
-        max_keyframes = num_keyframes.max(dim=1)[0]
+        # samples without a hint (in a batch mixing them with hinted ones) have no gradient,
+        # they only need a finite scale
+        max_keyframes = num_keyframes.max(dim=1)[0].clamp(min=1)
         scale = 20 / max_keyframes
         return scale.unsqueeze(-1).unsqueeze(-1).unsqueeze(-1)
 
-    def guide(self, x, t, model_kwargs=None, t_stopgrad=-10, scale=.5, n_guide_steps=10, train=False, min_variance=0.01):
+    def guide(self, x, t, model_kwargs=None, train=False, schedule=None):
         """
         Spatial guidance
+
+        :param t: the timesteps of x in this diffusion process, the schedule is resolved on the
+                  original timesteps (see original_timesteps()).
+        :param schedule: a GuidanceSchedule, defaults to self.guide_schedule
+                         (self.train_guide_schedule if train).
         """
+        if schedule is None:
+            schedule = self.train_guide_schedule if train else self.guide_schedule
+        if schedule.per_sample:
+            # the samples without a hint (e.g. text-only requests batched with hinted ones) are not guided
+            hinted = model_kwargs['y']['hint'].flatten(1).ne(0).any(dim=1)
+            if not hinted.all():
+                x = x.detach().clone()
+                if hinted.any():
+                    idx = torch.nonzero(hinted).squeeze(1)
+                    group_kwargs = {'y': {'hint': model_kwargs['y']['hint'][idx]}}
+                    x[idx] = self.guide(x[idx], t[idx], model_kwargs=group_kwargs, train=train, schedule=schedule)
+                return x
+        # the samples can be at different timesteps (e.g. with continuous batching), they are guided
+        # in groups that take the same number and kind of steps
+        t_values = self.original_timesteps(t).tolist()
+        if not schedule.per_sample:
+            t_values = [t_values[0]] * len(t_values)
+        configs = {t_value: schedule.config_at(t_value) for t_value in set(t_values)}
+        if len(set(configs.values())) > 1:
+            x = x.detach().clone()
+            for config in set(configs.values()):
+                idx = th.tensor([i for i, t_value in enumerate(t_values) if configs[t_value] == config],
+                                device=x.device)
+                group_kwargs = {'y': {'hint': model_kwargs['y']['hint'][idx]}}
+                x[idx] = self.guide(x[idx], t[idx], model_kwargs=group_kwargs, train=train, schedule=schedule)
+            return x
+        n_guide_steps, optimizer, root_projection = configs[t_values[0]]
+        if n_guide_steps == 0:
+            return x.detach()
+
         n_joint = 22 if x.shape[1] == 263 else 21
-        model_log_variance = _extract_into_tensor(self.posterior_log_variance_clipped, t, x.shape)
+        model_log_variance = self._extract('posterior_log_variance_clipped', t, x.shape)
         model_variance = torch.exp(model_log_variance)
-        
-        if model_variance[0, 0, 0, 0] < min_variance:
-            model_variance = min_variance
-
-        if train:
-            if t[0] < 20:
-                n_guide_steps = 100
-            else:
-                n_guide_steps = 20
-        else:
-            if t[0] < 10:
-                n_guide_steps = 500
-            else:
-                n_guide_steps = 10
+        if schedule.per_sample:
+            model_variance = model_variance.clamp(min=schedule.min_variance)
+        elif model_variance[0, 0, 0, 0] < schedule.min_variance:
+            model_variance = schedule.min_variance
 
         # process hint
         hint = model_kwargs['y']['hint'].clone().detach()
@@ -479,22 +598,56 @@ class GaussianDiffusion:
             self.std = self.std.to(hint.device)
         hint = hint * self.raw_std + self.raw_mean
         hint = hint.view(hint.shape[0], hint.shape[1], n_joint, 3) * mask_hint
-        # joint id
-        joint_ids = []
-        for m in mask_hint:
-            joint_id = torch.nonzero(m.sum(0).squeeze(-1) != 0).squeeze(1)
-            joint_ids.append(joint_id)
-        
-        if not train:
+
+        scale = schedule.scale
+        if scale is None:
             scale = self.calc_grad_scale(mask_hint)
 
+        # only the joints and frames that carry a hint in the batch are recovered
+        joint_ids = torch.nonzero(mask_hint.any(dim=1).any(dim=0).squeeze(-1)).squeeze(1)
+        frame_ids = torch.nonzero(mask_hint.any(dim=2).any(dim=0).squeeze(-1)).squeeze(1)
+        if len(frame_ids) == 0:
+            return x.detach()
+        hint = hint[:, frame_ids][:, :, joint_ids]
+        mask_hint = mask_hint[:, frame_ids][:, :, joint_ids]
+
+        if root_projection and joint_ids.tolist() == [0]:
+            # only the root is hinted, the hints are reached in one least-squares step
+            x_ = x.detach().permute(0, 3, 2, 1).squeeze(2)
+            x_ = project_root_hint(x_, hint[:, :, 0], mask_hint[:, :, 0, 0], frame_ids, self.mean, self.std)
+            profile_count('guide_iterations')
+            return x_.unsqueeze(2).permute(0, 3, 2, 1).contiguous()
+
+        if optimizer == 'sgd' and not schedule.early_stopping:
+            profile_count('guide_iterations', n_guide_steps)
+            for _ in range(n_guide_steps):
+                loss, grad = self.gradients(x, hint, mask_hint, joint_ids, frame_ids)
+                x = x - scale * model_variance * grad
+            return x.detach()
+
+        # per sample state, so that the samples that have converged can be dropped from the batch
+        step = (scale * model_variance * torch.ones_like(x[:, :1, :1, :1]))[:, 0, 0, 0]
+        n_keyframes = mask_hint.sum(dim=(1, 2, 3)).clamp(min=1)
+        x = x.detach().clone()
+        optimizer = create_guide_optimizer(optimizer, x, step)
+        active = torch.arange(x.shape[0], device=x.device)
+        prev_error = None
         for _ in range(n_guide_steps):
-            loss, grad = self.gradients(x, hint, mask_hint, joint_ids)
-            grad = model_variance * grad
-            # print(loss.sum())
-            if t[0] >= t_stopgrad:
-                x = x - scale * grad
-        return x.detach()
+            profile_count('guide_iterations')
+            x_active = x[active]
+            loss, grad = self.gradients(x_active, hint[active], mask_hint[active], joint_ids, frame_ids,
+                                        squared=optimizer.squared)
+            x_next, loss, accepted = optimizer.step(active, x_active.detach(), loss.detach(), grad)
+            x[active] = x_next.detach()
+            # mean distance to the hints at the point the step was taken from
+            error = loss.sum(dim=(1, 2)) / n_keyframes[active]
+            if not schedule.early_stopping:
+                continue
+            keep = ~(schedule.converged(error, prev_error) & accepted)
+            active, prev_error = active[keep], error[keep]
+            if len(active) == 0:
+                break
+        return optimizer.result(x)
     
     def p_sample(
         self,
@@ -534,7 +687,8 @@ class GaussianDiffusion:
         )
         if 'hint' in model_kwargs['y'].keys():
             # spatial guidance/classifier guidance
-            out['mean'] = self.guide(out['mean'], t, model_kwargs=model_kwargs)
+            with profile_stage('guide'):
+                out['mean'] = self.guide(out['mean'], t, model_kwargs=model_kwargs)
 
         if const_noise:
             noise = th.randn_like(x[0])
@@ -572,6 +726,7 @@ class GaussianDiffusion:
         cond_fn_with_grad=False,
         dump_steps=None,
         const_noise=False,
+        cancel=None,
     ):
         """
         Generate samples from the model.
@@ -591,6 +746,8 @@ class GaussianDiffusion:
                        If not specified, use a model parameter's device.
         :param progress: if True, show a tqdm progress bar.
         :param const_noise: If True, will noise all samples with the same noise throughout sampling
+        :param cancel: if not None, a CancellationToken checked after every step. The loop then
+                       returns a dict (see _anytime_result) instead of the samples.
         :return: a non-differentiable batch of samples.
         """
         final = None
@@ -616,10 +773,36 @@ class GaussianDiffusion:
             if dump_steps is not None and i in dump_steps:
                 dump.append(deepcopy(sample["sample"]))
             final = sample
+            if cancel is not None and cancel.cancelled:
+                break
         if dump_steps is not None:
             return dump
+        if cancel is not None:
+            return self._anytime_result(final, i + 1, self.num_timesteps - skip_timesteps, model_kwargs)
         return final["sample"]
 
+    def _anytime_result(self, out, step, n_steps, model_kwargs=None):
+        """
+        The result of a sampling loop run with a CancellationToken.
+
+        :param out: the output of the last step taken.
+        :param step: the number of steps taken.
+        :param n_steps: the number of steps of the full loop.
+        :return: a dict with
+                 - 'sample': the samples if the loop finished, else the x_start prediction
+                   of the last step, with the spatial guidance of the next timestep applied.
+                 - 'step', 'n_steps': the number of steps taken, out of n_steps.
+                 - 'cancelled': True if the loop was stopped early.
+        """
+        if step == n_steps:
+            return {"sample": out["sample"], "step": step, "n_steps": n_steps, "cancelled": False}
+        x = out["pred_xstart"]
+        if model_kwargs is not None and 'hint' in model_kwargs['y'].keys():
+            t = th.full((x.shape[0],), n_steps - step - 1, dtype=th.long, device=x.device)
+            with profile_stage('guide'):
+                x = self.guide(x, t, model_kwargs=model_kwargs)
+        return {"sample": x, "step": step, "n_steps": n_steps, "cancelled": True}
+
     def p_sample_loop_progressive(
         self,
         model,
@@ -666,6 +849,10 @@ class GaussianDiffusion:
             my_t = th.ones([shape[0]], device=device, dtype=th.long) * indices[0]
             img = self.q_sample(init_image, my_t, img)
 
+        if model_kwargs is not None and hasattr(model, 'cache_text_embedding'):
+            # encode the text condition once, instead of at every model call
+            model.cache_text_embedding(model_kwargs['y'])
+
         if progress:
             # Lazy import so that we don't depend on tqdm.
             from tqdm.auto import tqdm
@@ -679,20 +866,522 @@ class GaussianDiffusion:
                                                size=model_kwargs['y'].shape,
                                                device=model_kwargs['y'].device)
             with th.no_grad():
-                sample_fn = self.p_sample
-                out = sample_fn(
-                    model,
-                    img,
-                    t,
-                    clip_denoised=clip_denoised,
-                    denoised_fn=denoised_fn,
-                    cond_fn=cond_fn,
-                    model_kwargs=model_kwargs,
-                    const_noise=const_noise,
-                )
+                with profile_step(i):
+                    sample_fn = self.p_sample
+                    out = sample_fn(
+                        model,
+                        img,
+                        t,
+                        clip_denoised=clip_denoised,
+                        denoised_fn=denoised_fn,
+                        cond_fn=cond_fn,
+                        model_kwargs=model_kwargs,
+                        const_noise=const_noise,
+                    )
                 yield out
                 img = out["sample"]
 
+    def _dpm_solver_coefs(self, t, shape):
+        """
+        Get alpha_t, sigma_t and the half log-SNR lambda_t = log(alpha_t / sigma_t)
+        for a batch of timesteps, as used by DPM-Solver.
+        """
+        alpha_bar = self._extract('alphas_cumprod', t, shape)
+        alpha_t = th.sqrt(alpha_bar)
+        sigma_t = th.sqrt(1.0 - alpha_bar)
+        return alpha_t, sigma_t, th.log(alpha_t) - th.log(sigma_t)
+
+    def dpm_solver_sample(
+        self,
+        model,
+        x,
+        t,
+        t_next,
+        history,
+        order=2,
+        clip_denoised=True,
+        denoised_fn=None,
+        model_kwargs=None,
+    ):
+        """
+        Take one multistep DPM-Solver++ step (data prediction form) from t to t_next.
+
+        Since we predict x_start, the model output is used as the data prediction
+        directly. Spatial guidance is applied to x_{t_next} after the solver
+        update, the same point where p_sample() guides the posterior mean.
+
+        :param t: the current timesteps.
+        :param t_next: the timesteps to step to, or None for the final step to
+                       the clean data.
+        :param history: a list of (t, pred_xstart) pairs from previous steps,
+                        oldest first. The current step is appended in place.
+        :param order: the solver order to use for this step (1, 2 or 3), capped
+                      by the number of available previous steps.
+        :return: a dict containing the following keys:
+                 - 'sample': the sample at t_next.
+                 - 'pred_xstart': a prediction of x_0.
+        """
+        out = self.p_mean_variance(
+            model,
+            x,
+            t,
+            clip_denoised=clip_denoised,
+            denoised_fn=denoised_fn,
+            model_kwargs=model_kwargs,
+        )
+        history.append((t, out["pred_xstart"]))
+        order = min(order, len(history))
+
+        if t_next is None:
+            # final step, sigma = 0: the solution is the data prediction itself
+            x_next = out["pred_xstart"]
+        else:
+            alpha_t, sigma_t, lambda_t = self._dpm_solver_coefs(t_next, x.shape)
+            _, sigma_s0, lambda_s0 = self._dpm_solver_coefs(t, x.shape)
+            h = lambda_t - lambda_s0
+            phi_1 = th.expm1(-h)
+            m0 = history[-1][1]
+            x_next = (sigma_t / sigma_s0) * x - alpha_t * phi_1 * m0
+            if order == 2:
+                _, _, lambda_s1 = self._dpm_solver_coefs(history[-2][0], x.shape)
+                r0 = (lambda_s0 - lambda_s1) / h
+                d1 = (m0 - history[-2][1]) / r0
+                x_next = x_next - 0.5 * alpha_t * phi_1 * d1
+            elif order == 3:
+                _, _, lambda_s1 = self._dpm_solver_coefs(history[-2][0], x.shape)
+                _, _, lambda_s2 = self._dpm_solver_coefs(history[-3][0], x.shape)
+                r0 = (lambda_s0 - lambda_s1) / h
+                r1 = (lambda_s1 - lambda_s2) / h
+                d1_0 = (m0 - history[-2][1]) / r0
+                d1_1 = (history[-2][1] - history[-3][1]) / r1
+                d1 = d1_0 + (r0 / (r0 + r1)) * (d1_0 - d1_1)
+                d2 = (d1_0 - d1_1) / (r0 + r1)
+                phi_2 = phi_1 / h + 1.0
+                phi_3 = phi_2 / h - 0.5
+                x_next = x_next + alpha_t * phi_2 * d1 - alpha_t * phi_3 * d2
+
+        if 'hint' in model_kwargs['y'].keys():
+            # spatial guidance/classifier guidance
+            with profile_stage('guide'):
+                x_next = self.guide(x_next, t, model_kwargs=model_kwargs)
+        return {"sample": x_next, "pred_xstart": out["pred_xstart"]}
+
+    def dpm_solver_sample_loop(
+        self,
+        model,
+        shape,
+        noise=None,
+        clip_denoised=True,
+        denoised_fn=None,
+        cond_fn=None,
+        model_kwargs=None,
+        device=None,
+        progress=False,
+        order=2,
+        skip_timesteps=0,
+        init_image=None,
+        randomize_class=False,
+        cond_fn_with_grad=False,
+        dump_steps=None,
+        const_noise=False,
+        cancel=None,
+    ):
+        """
+        Generate samples from the model using multistep DPM-Solver++.
+
+        Same usage as p_sample_loop(). Each timestep of this diffusion costs one
+        model evaluation, so wrap the base process in a SpacedDiffusion with
+        15-25 timesteps to get the intended speedup. The solver is
+        deterministic, so cond_fn and const_noise only apply to the initial noise.
+
+        :param order: 2 for DPM-Solver++(2M), 3 for DPM-Solver++(3M).
+        :param cancel: see p_sample_loop().
+        """
+        final = None
+        if dump_steps is not None:
+            dump = []
+
+        for i, sample in enumerate(self.dpm_solver_sample_loop_progressive(
+            model,
+            shape,
+            noise=noise,
+            clip_denoised=clip_denoised,
+            denoised_fn=denoised_fn,
+            cond_fn=cond_fn,
+            model_kwargs=model_kwargs,
+            device=device,
+            progress=progress,
+            order=order,
+            skip_timesteps=skip_timesteps,
+            init_image=init_image,
+            randomize_class=randomize_class,
+            cond_fn_with_grad=cond_fn_with_grad,
+            const_noise=const_noise,
+        )):
+            if dump_steps is not None and i in dump_steps:
+                dump.append(deepcopy(sample["sample"]))
+            final = sample
+            if cancel is not None and cancel.cancelled:
+                break
+        if dump_steps is not None:
+            return dump
+        if cancel is not None:
+            return self._anytime_result(final, i + 1, self.num_timesteps - skip_timesteps, model_kwargs)
+        return final["sample"]
+
+    def dpm_solver_sample_loop_progressive(
+        self,
+        model,
+        shape,
+        noise=None,
+        clip_denoised=True,
+        denoised_fn=None,
+        cond_fn=None,
+        model_kwargs=None,
+        device=None,
+        progress=False,
+        order=2,
+        skip_timesteps=0,
+        init_image=None,
+        randomize_class=False,
+        cond_fn_with_grad=False,
+        const_noise=False,
+    ):
+        """
+        Use multistep DPM-Solver++ to sample from the model and yield
+        intermediate samples from each solver step.
+
+        Same usage as p_sample_loop_progressive().
+        """
+        assert self.model_mean_type == ModelMeanType.START_X, 'DPM-Solver++ is implemented for x_start prediction only!'
+        assert order in [1, 2, 3], f'unsupported DPM-Solver++ order: {order}'
+        if device is None:
+            device = next(model.parameters()).device
+        assert isinstance(shape, (tuple, list))
+        if noise is not None:
+            img = noise
+        else:
+            if const_noise:
+                img = th.randn(*shape[1:], device=device)
+                img = img[None].repeat(shape[0], 1, 1, 1)
+            else:
+                img = th.randn(*shape, device=device)
+
+        if skip_timesteps and init_image is None:
+            init_image = th.zeros_like(img)
+
+        indices = list(range(self.num_timesteps - skip_timesteps))[::-1]
+
+        if init_image is not None:
+            my_t = th.ones([shape[0]], device=device, dtype=th.long) * indices[0]
+            img = self.q_sample(init_image, my_t, img)
+
+        if model_kwargs is not None and hasattr(model, 'cache_text_embedding'):
+            # encode the text condition once, instead of at every model call
+            model.cache_text_embedding(model_kwargs['y'])
+
+        if progress:
+            # Lazy import so that we don't depend on tqdm.
+            from tqdm.auto import tqdm
+
+            indices = tqdm(indices)
+
+        n_steps = len(indices)
+        history = []
+        for step, i in enumerate(indices):
+            t = th.tensor([i] * shape[0], device=device)
+            t_next = th.tensor([i - 1] * shape[0], device=device) if i > 0 else None
+            # lower order for the first and the last steps, which is more stable with few steps
+            step_order = min(order, n_steps - step)
+            with th.no_grad():
+                with profile_step(i):
+                    out = self.dpm_solver_sample(
+                        model,
+                        img,
+                        t,
+                        t_next,
+                        history,
+                        order=step_order,
+                        clip_denoised=clip_denoised,
+                        denoised_fn=denoised_fn,
+                        model_kwargs=model_kwargs,
+                    )
+                yield out
+                img = out["sample"]
+                del history[:-2]
+
+    def ddim_sample(
+        self,
+        model,
+        x,
+        t,
+        clip_denoised=True,
+        denoised_fn=None,
+        cond_fn=None,
+        model_kwargs=None,
+        eta=0.0,
+        const_noise=False,
+    ):
+        """
+        Sample x_{t-1} from the model using DDIM.
+
+        Same usage as p_sample(). Spatial guidance is applied to the
+        deterministic part of the DDIM update, before noise is added.
+        """
+        out_orig = self.p_mean_variance(
+            model,
+            x,
+            t,
+            clip_denoised=clip_denoised,
+            denoised_fn=denoised_fn,
+            model_kwargs=model_kwargs,
+        )
+        if cond_fn is not None:
+            out = self.condition_score(cond_fn, out_orig, x, t, model_kwargs=model_kwargs)
+        else:
+            out = out_orig
+
+        # Usually our model outputs epsilon, but we re-derive it
+        # in case we used x_start or x_prev prediction.
+        eps = self._predict_eps_from_xstart(x, t, out["pred_xstart"])
+
+        alpha_bar = self._extract('alphas_cumprod', t, x.shape)
+        alpha_bar_prev = self._extract('alphas_cumprod_prev', t, x.shape)
+        sigma = (
+            eta
+            * th.sqrt((1 - alpha_bar_prev) / (1 - alpha_bar))
+            * th.sqrt(1 - alpha_bar / alpha_bar_prev)
+        )
+        # Equation 12.
+        mean_pred = (
+            out["pred_xstart"] * th.sqrt(alpha_bar_prev)
+            + th.sqrt(1 - alpha_bar_prev - sigma ** 2) * eps
+        )
+        if 'hint' in model_kwargs['y'].keys():
+            # spatial guidance/classifier guidance
+            with profile_stage('guide'):
+                mean_pred = self.guide(mean_pred, t, model_kwargs=model_kwargs)
+
+        if const_noise:
+            noise = th.randn_like(x[0])
+            noise = noise[None].repeat(x.shape[0], 1, 1, 1)
+        else:
+            noise = th.randn_like(x)
+
+        nonzero_mask = (
+            (t != 0).float().view(-1, *([1] * (len(x.shape) - 1)))
+        )  # no noise when t == 0
+        sample = mean_pred + nonzero_mask * sigma * noise
+        return {"sample": sample, "pred_xstart": out_orig["pred_xstart"]}
+
+    def ddim_sample_loop(
+        self,
+        model,
+        shape,
+        noise=None,
+        clip_denoised=True,
+        denoised_fn=None,
+        cond_fn=None,
+        model_kwargs=None,
+        device=None,
+        progress=False,
+        eta=0.0,
+        skip_timesteps=0,
+        init_image=None,
+        randomize_class=False,
+        cond_fn_with_grad=False,
+        dump_steps=None,
+        const_noise=False,
+        cancel=None,
+    ):
+        """
+        Generate samples from the model using DDIM.
+
+        Same usage as p_sample_loop(). The number of denoising steps is the
+        number of timesteps of this diffusion, so wrap the base process in a
+        SpacedDiffusion to sample with fewer steps.
+
+        :param eta: the DDIM noise level; 0 gives deterministic sampling and 1
+                    matches the DDPM posterior variance.
+        :param cancel: see p_sample_loop().
+        """
+        final = None
+        if dump_steps is not None:
+            dump = []
+
+        for i, sample in enumerate(self.ddim_sample_loop_progressive(
+            model,
+            shape,
+            noise=noise,
+            clip_denoised=clip_denoised,
+            denoised_fn=denoised_fn,
+            cond_fn=cond_fn,
+            model_kwargs=model_kwargs,
+            device=device,
+            progress=progress,
+            eta=eta,
+            skip_timesteps=skip_timesteps,
+            init_image=init_image,
+            randomize_class=randomize_class,
+            cond_fn_with_grad=cond_fn_with_grad,
+            const_noise=const_noise,
+        )):
+            if dump_steps is not None and i in dump_steps:
+                dump.append(deepcopy(sample["sample"]))
+            final = sample
+            if cancel is not None and cancel.cancelled:
+                break
+        if dump_steps is not None:
+            return dump
+        if cancel is not None:
+            return self._anytime_result(final, i + 1, self.num_timesteps - skip_timesteps, model_kwargs)
+        return final["sample"]
+
+    def ddim_sample_loop_progressive(
+        self,
+        model,
+        shape,
+        noise=None,
+        clip_denoised=True,
+        denoised_fn=None,
+        cond_fn=None,
+        model_kwargs=None,
+        device=None,
+        progress=False,
+        eta=0.0,
+        skip_timesteps=0,
+        init_image=None,
+        randomize_class=False,
+        cond_fn_with_grad=False,
+        const_noise=False,
+    ):
+        """
+        Use DDIM to sample from the model and yield intermediate samples from
+        each timestep of DDIM.
+
+        Same usage as p_sample_loop_progressive().
+        """
+        if device is None:
+            device = next(model.parameters()).device
+        assert isinstance(shape, (tuple, list))
+        if noise is not None:
+            img = noise
+        else:
+            if const_noise:
+                img = th.randn(*shape[1:], device=device)
+                img = img[None].repeat(shape[0], 1, 1, 1)
+            else:
+                img = th.randn(*shape, device=device)
+
+        if skip_timesteps and init_image is None:
+            init_image = th.zeros_like(img)
+
+        indices = list(range(self.num_timesteps - skip_timesteps))[::-1]
+
+        if init_image is not None:
+            my_t = th.ones([shape[0]], device=device, dtype=th.long) * indices[0]
+            img = self.q_sample(init_image, my_t, img)
+
+        if model_kwargs is not None and hasattr(model, 'cache_text_embedding'):
+            # encode the text condition once, instead of at every model call
+            model.cache_text_embedding(model_kwargs['y'])
+
+        if progress:
+            # Lazy import so that we don't depend on tqdm.
+            from tqdm.auto import tqdm
+
+            indices = tqdm(indices)
+
+        for i in indices:
+            t = th.tensor([i] * shape[0], device=device)
+            if randomize_class and 'y' in model_kwargs:
+                model_kwargs['y'] = th.randint(low=0, high=model.num_classes,
+                                               size=model_kwargs['y'].shape,
+                                               device=model_kwargs['y'].device)
+            with th.no_grad():
+                with profile_step(i):
+                    out = self.ddim_sample(
+                        model,
+                        img,
+                        t,
+                        clip_denoised=clip_denoised,
+                        denoised_fn=denoised_fn,
+                        cond_fn=cond_fn,
+                        model_kwargs=model_kwargs,
+                        eta=eta,
+                        const_noise=const_noise,
+                    )
+                yield out
+                img = out["sample"]
+
+    def sample_loop_previews(
+        self,
+        model,
+        shape,
+        sampler='ddpm',
+        every=10,
+        frame_stride=4,
+        skip_timesteps=0,
+        **kwargs,
+    ):
+        """
+        Sample from the model and yield previews of the x_start prediction, decoded
+        to joint positions, every `every` sampling steps and at the last step.
+
+        The previews are recovered with recover_from_ric_sparse on every
+        frame_stride-th frame only, which is cheap next to a sampling step.
+        Closing the generator (e.g. breaking out of the loop) stops the sampling.
+
+        :param sampler: 'ddpm', 'ddim' or 'dpmsolver', the progressive loop to run.
+        :param every: the number of sampling steps between two previews.
+        :param frame_stride: decode one frame out of frame_stride.
+        :param kwargs: the other arguments of the progressive loop, e.g. model_kwargs,
+                       noise, eta for ddim or order for dpmsolver.
+        :return: a generator over dicts with
+                 - 'step': the number of sampling steps done so far.
+                 - 'n_steps': the total number of sampling steps.
+                 - 'frame_ids': [n] the indices of the decoded frames.
+                 - 'joints': [N x n x n_joints x 3] the joint positions of pred_xstart.
+                 - 'sample': the final samples, only in the last dict.
+        """
+        if sampler == 'ddpm':
+            loop = self.p_sample_loop_progressive
+        elif sampler == 'ddim':
+            loop = self.ddim_sample_loop_progressive
+        elif sampler == 'dpmsolver':
+            loop = self.dpm_solver_sample_loop_progressive
+        else:
+            raise ValueError(f'unknown sampler: {sampler}')
+        assert every > 0 and frame_stride > 0
+
+        n_steps = self.num_timesteps - skip_timesteps
+        for i, out in enumerate(loop(model, shape, skip_timesteps=skip_timesteps, **kwargs)):
+            step = i + 1
+            if step % every != 0 and step != n_steps:
+                continue
+            preview = {'step': step, 'n_steps': n_steps}
+            preview.update(self.decode_preview(out['pred_xstart'], frame_stride))
+            if step == n_steps:
+                preview['sample'] = out['sample']
+            yield preview
+
+    def decode_preview(self, x_start, frame_stride=4):
+        """
+        Decode normalized motion features to joint positions, on a subsample of the frames.
+
+        :param x_start: [N x 263/251 x 1 x seqlen] normalized hml_vec features.
+        :param frame_stride: decode one frame out of frame_stride.
+        :return: a dict with 'frame_ids' [n] and 'joints' [N x n x n_joints x 3].
+        """
+        n_joints = 22 if x_start.shape[1] == 263 else 21
+        with th.no_grad():
+            data = x_start.detach().squeeze(2).permute(0, 2, 1)
+            frame_ids = th.arange(0, data.shape[1], frame_stride, device=data.device)
+            joint_ids = th.arange(n_joints, device=data.device)
+            joints = recover_from_ric_sparse(data, n_joints, joint_ids, frame_ids,
+                                             self.mean.to(data.device), self.std.to(data.device))
+        return {'frame_ids': frame_ids, 'joints': joints}
+
     def training_losses(self, model, x_start, t, model_kwargs=None, noise=None, dataset=None):
         """
         Compute training losses for a single timestep.
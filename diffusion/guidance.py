@@ -0,0 +1,233 @@
+import torch
+
+
+def create_named_guidance_schedule(name, **kwargs):
+    """
+    Create a GuidanceSchedule from a library of pre-defined presets.
+
+    :param name: the name of the preset.
+    :param kwargs: GuidanceSchedule fields overriding the preset (None values are ignored).
+    """
+    if name not in GUIDANCE_PRESETS:
+        raise NotImplementedError(f"unknown guidance schedule: {name}")
+    params = dict(GUIDANCE_PRESETS[name])
+    params.update({k: v for k, v in kwargs.items() if v is not None})
+    return GuidanceSchedule(**params)
+
+
+class GuidanceSchedule:
+    """
+    How the spatial guidance (GaussianDiffusion.guide) runs at each denoising step.
+
+    All the timesteps are timesteps of the original diffusion process (0 to 999): with respaced
+    sampling (--sample_steps), guide() maps the respaced steps back to them, so that t_tail and
+    t_stopgrad select the same noise levels whatever the number of sampling steps.
+
+    :param n_steps: the number of gradient steps per denoising step.
+    :param n_steps_tail: the number of gradient steps for the last timesteps, t < t_tail.
+    :param t_tail: the original timestep below which n_steps_tail is used.
+    :param t_stopgrad: x is only updated for original timesteps t >= t_stopgrad.
+    :param scale: the gradient step size. If None, it is scaled per sample by the
+                  number of keyframes (see GaussianDiffusion.calc_grad_scale).
+    :param min_variance: lower bound of the posterior variance the gradients are multiplied by.
+    :param atol: if not None, a sample stops once its mean control error (in meters)
+                 is below atol.
+    :param rtol: if not None, a sample stops once its mean control error decreases by
+                 less than this fraction in one gradient step.
+    :param optimizer: the optimizer of the last timesteps, t < t_tail, 'sgd' for fixed-size
+                      gradient steps or 'lbfgs' (see LBFGSGuideOptimizer). The earlier timesteps
+                      only nudge x towards the hints and always take fixed-size gradient steps.
+    :param root_projection: if True and only the root joint is hinted, the last timesteps, t < t_tail,
+                            project the root trajectory onto the hints in closed form instead
+                            (see project_root_hint in motion_process.py).
+    :param per_sample: if True, every sample is guided according to its own timestep (the samples of a
+                       batch can be at different timesteps, e.g. with continuous batching), and the samples
+                       without a hint are not guided. If False, the whole batch is guided according to the
+                       timestep of its first sample, as guide() did before per-sample timesteps.
+    """
+
+    def __init__(self, n_steps=10, n_steps_tail=500, t_tail=10, t_stopgrad=-10, scale=None, min_variance=0.01,
+                 atol=None, rtol=None, optimizer='sgd', root_projection=False, per_sample=True):
+        self.n_steps = n_steps
+        self.n_steps_tail = n_steps_tail
+        self.t_tail = t_tail
+        self.t_stopgrad = t_stopgrad
+        self.scale = scale
+        self.min_variance = min_variance
+        self.atol = atol
+        self.rtol = rtol
+        self.optimizer = optimizer
+        self.root_projection = root_projection
+        self.per_sample = per_sample
+
+    def n_guide_steps(self, t):
+        if t < self.t_stopgrad:
+            return 0
+        return self.n_steps_tail if t < self.t_tail else self.n_steps
+
+    def optimizer_at(self, t):
+        return self.optimizer if t < self.t_tail else 'sgd'
+
+    def config_at(self, t):
+        """
+        What the guidance does at the original timestep t: (the number of gradient steps, the optimizer,
+        whether a root-only hint is projected in closed form).
+        """
+        return self.n_guide_steps(t), self.optimizer_at(t), self.root_projection and t < self.t_tail
+
+    @property
+    def early_stopping(self):
+        return self.atol is not None or self.rtol is not None
+
+    def converged(self, error, prev_error):
+        """
+        :param error: [bs] the mean control error of each sample.
+        :param prev_error: [bs] the error at the previous gradient step, or None.
+        :return: a [bs] bool tensor, True for the samples that can stop.
+        """
+        converged = error != error  # all False
+        if self.atol is not None:
+            converged = converged | (error < self.atol)
+        if self.rtol is not None and prev_error is not None:
+            converged = converged | (prev_error - error < self.rtol * prev_error)
+        return converged
+
+
+def create_guide_optimizer(name, x, step):
+    """
+    :param name: 'sgd' or 'lbfgs'.
+    :param x: [bs x ...] the tensor to be guided.
+    :param step: [bs] the gradient step size of each sample.
+    """
+    if name == 'sgd':
+        return SGDGuideOptimizer(x, step)
+    elif name == 'lbfgs':
+        return LBFGSGuideOptimizer(x, step)
+    else:
+        raise NotImplementedError(f"unknown guide optimizer: {name}")
+
+
+class SGDGuideOptimizer:
+    """
+    Fixed-size gradient steps, x = x - step * grad.
+    """
+    squared = False
+
+    def __init__(self, x, step):
+        self.step_size = step
+
+    def step(self, idx, x, loss, grad):
+        """
+        :param idx: [n] the indices of the samples x, loss and grad belong to.
+        :param x: [n x ...] the current point.
+        :param loss: [n x ...] the distances to the hints at x.
+        :param grad: [n x ...] the gradient of the control loss at x.
+        :return: a tuple (x_next, loss, accepted), where loss are the distances at the point
+                 x_next was computed from and accepted is False for the samples whose
+                 previous step was undone.
+        """
+        step = self.step_size[idx].view(-1, *([1] * (x.dim() - 1)))
+        return x - step * grad, loss, torch.ones_like(idx, dtype=torch.bool)
+
+    def result(self, x):
+        return x
+
+
+class LBFGSGuideOptimizer:
+    """
+    Batched L-BFGS on the least-squares control loss, every sample keeps its own history
+    of the last history_size steps.
+
+    Without history, a sample takes a Polyak step, f / |grad|^2 (the least-squares loss f
+    can reach zero). A step that increases the loss of a sample is undone at the next call,
+    and the sample continues from its previous point with a halved step length and a
+    cleared history. The gradient is zero on the first frame (see
+    GaussianDiffusion.gradients), and so are the steps, as they are linear combinations
+    of the gradients.
+    """
+    squared = True
+
+    def __init__(self, x, step, history_size=5):
+        bs, dim = x.shape[0], x[0].numel()
+        self.shape = x.shape
+        self.lr = torch.ones(bs, dtype=x.dtype, device=x.device)
+        self.s = x.new_zeros(bs, history_size, dim)
+        self.y = x.new_zeros(bs, history_size, dim)
+        self.valid = torch.zeros(bs, history_size, dtype=torch.bool, device=x.device)
+        self.x_prev = x.detach().reshape(bs, dim).clone()
+        self.g_prev = x.new_zeros(bs, dim)
+        self.f_prev = torch.full_like(self.lr, float('inf'))
+        self.loss_prev = None
+        self.started = torch.zeros(bs, dtype=torch.bool, device=x.device)
+
+    def step(self, idx, x, loss, grad):
+        if self.loss_prev is None:
+            self.loss_prev = loss.new_zeros(self.shape[0], *loss.shape[1:])
+        x, g = x.reshape(len(idx), -1), grad.reshape(len(idx), -1)
+        f = 0.5 * (loss ** 2).flatten(1).sum(-1)
+        started, x_prev, g_prev, f_prev, loss_prev, s, y, valid, lr = [
+            state.index_select(0, idx) for state in
+            (self.started, self.x_prev, self.g_prev, self.f_prev, self.loss_prev, self.s, self.y, self.valid, self.lr)]
+
+        # undo the steps that increased the loss
+        rejected = started & (f > f_prev)
+        x = torch.where(rejected[:, None], x_prev, x)
+        g = torch.where(rejected[:, None], g_prev, g)
+        f = torch.where(rejected, f_prev, f)
+        loss = torch.where(rejected.view(-1, *([1] * (loss.dim() - 1))), loss_prev, loss)
+        lr = torch.where(rejected, lr / 2, lr)
+        valid &= ~rejected[:, None]
+
+        # add the accepted steps with a positive curvature to the histories
+        s_new, y_new = x - x_prev, g - g_prev
+        push = started & ~rejected & ((s_new * y_new).sum(-1) > 1e-10)
+        if push.any():
+            s[push] = torch.cat([s[push, 1:], s_new[push, None]], dim=1)
+            y[push] = torch.cat([y[push, 1:], y_new[push, None]], dim=1)
+            valid[push] = torch.cat([valid[push, 1:], valid.new_ones(int(push.sum()), 1)], dim=1)
+
+        # two-loop recursion
+        sy = (s * y).sum(-1)
+        rho = torch.where(valid, 1 / sy.where(valid, torch.ones_like(sy)), torch.zeros_like(sy))
+        q = g
+        alpha = torch.zeros_like(rho)
+        for i in reversed(range(s.shape[1])):
+            alpha[:, i] = rho[:, i] * (s[:, i] * q).sum(-1)
+            q = q - alpha[:, i, None] * y[:, i]
+        gamma = torch.where(valid[:, -1],
+                            sy[:, -1] / (y[:, -1] ** 2).sum(-1).clamp(min=1e-20),
+                            f / (g ** 2).sum(-1).clamp(min=1e-20))
+        r = gamma[:, None] * q
+        for i in range(s.shape[1]):
+            beta = rho[:, i] * (y[:, i] * r).sum(-1)
+            r = r + (alpha[:, i] - beta)[:, None] * s[:, i]
+
+        for state, value in zip((self.x_prev, self.g_prev, self.f_prev, self.loss_prev, self.s, self.y, self.valid, self.lr),
+                                (x, g, f, loss, s, y, valid, lr)):
+            state.index_copy_(0, idx, value)
+        self.started.index_fill_(0, idx, True)
+        x_next = x - lr[:, None] * r
+        return x_next.view(len(idx), *self.shape[1:]), loss, ~rejected
+
+    def result(self, x):
+        """
+        The last accepted point of every sample, the last step of each sample was never evaluated.
+        """
+        return torch.where(self.started.view(-1, *([1] * (x.dim() - 1))), self.x_prev.view(self.shape), x)
+
+
+GUIDANCE_PRESETS = {
+    # the schedule used in the paper, a fixed number of steps
+    'default': dict(n_steps=10, n_steps_tail=500, t_tail=10),
+    # same, used while training (training batches have random timesteps, the first one sets the schedule)
+    'train': dict(n_steps=20, n_steps_tail=100, t_tail=20, scale=.5, per_sample=False),
+    # the paper's schedule, each sample stops once its control error has converged
+    'converge': dict(n_steps=10, n_steps_tail=500, t_tail=10, atol=0.001, rtol=1e-5, root_projection=True),
+    # fewer steps at the tail and a looser tolerance, for latency-sensitive sampling
+    'fast': dict(n_steps=5, n_steps_tail=100, t_tail=10, atol=0.01, rtol=1e-4, root_projection=True),
+    # quasi-newton steps at the tail, each sample stops once its control error has converged
+    'lbfgs': dict(n_steps=10, n_steps_tail=100, t_tail=10, atol=0.001, rtol=1e-5, optimizer='lbfgs',
+                  root_projection=True),
+    # no spatial guidance, the control signal is only followed through the control branch
+    'none': dict(n_steps=0, n_steps_tail=0),
+}
@@ -0,0 +1,142 @@
+"""
+Per-stage timings of the sampling loop.
+
+The sampling code marks its stages with profile_stage() / profile_step(), which do nothing
+unless a SamplingProfiler is active in the current thread:
+
+    profiler = SamplingProfiler(trace=True)
+    with profiler:
+        sample = sample_fn(model, shape, model_kwargs=model_kwargs)
+    profiler.logkvs()                     # one row of diffusion.logger key-values per step, then the totals
+    profiler.save_trace('trace.json')     # open in chrome://tracing or https://ui.perfetto.dev
+
+The stages are nested, their times are inclusive:
+    step         one denoising step (all the samplers)
+    model        the model call of the step (with classifier-free guidance, both passes)
+    cfg_cond, cfg_uncond, cfg_fused
+                 the passes of ClassifierFreeSampleModel
+    control, trunk
+                 the CMDM control branch and the MDM trunk
+    clip         CLIP text encoding (only for the prompts that are not cached)
+    guide        the spatial guidance, its gradient iterations are counted in guide_iterations
+"""
+import contextlib
+import json
+import threading
+import time
+from collections import defaultdict
+
+import torch
+
+from diffusion import logger
+
+_local = threading.local()
+_NULL_CONTEXT = contextlib.nullcontext()
+
+
+def profile_stage(name):
+    profiler = getattr(_local, 'profiler', None)
+    return _NULL_CONTEXT if profiler is None else profiler.stage(name)
+
+
+def profile_step(t):
+    profiler = getattr(_local, 'profiler', None)
+    return _NULL_CONTEXT if profiler is None else profiler.step(t)
+
+
+def profile_count(name, n=1):
+    profiler = getattr(_local, 'profiler', None)
+    if profiler is not None:
+        profiler.counts[name] += n
+
+
+class SamplingProfiler:
+    """
+    :param trace: if True, also record the stages as Chrome trace events (see save_trace()).
+    :param sync_cuda: if True, synchronize CUDA at the stage boundaries, so that the GPU time is
+                      accounted to the stage that queued the work. Otherwise the GPU work is
+                      accounted to the stage that waits for its results, and profiling costs
+                      almost nothing.
+    """
+
+    def __init__(self, trace=False, sync_cuda=False):
+        self.trace = trace
+        self.sync_cuda = sync_cuda and torch.cuda.is_available()
+        self.steps = []  # one dict of key-values per step
+        self.totals = defaultdict(float)
+        self.counts = defaultdict(float)  # of the current step
+        self.events = []
+        self.start_time = None  # the origin of the trace, the profiler can be entered several times
+        self.total_time = 0.
+
+    def __enter__(self):
+        self._previous = getattr(_local, 'profiler', None)
+        _local.profiler = self
+        self._enter_time = time.perf_counter()
+        if self.start_time is None:
+            self.start_time = self._enter_time
+        return self
+
+    def __exit__(self, *exc_info):
+        self._flush()  # what ran after the last step
+        self.total_time += time.perf_counter() - self._enter_time
+        _local.profiler = self._previous
+
+    @contextlib.contextmanager
+    def stage(self, name, **args):
+        self._sync()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._sync()
+            end = time.perf_counter()
+            self.counts['time_' + name] += end - start
+            self.counts['calls_' + name] += 1
+            if self.trace:
+                self.events.append({'name': name, 'ph': 'X', 'pid': 0, 'tid': 0, 'args': args,
+                                    'ts': (start - self.start_time) * 1e6, 'dur': (end - start) * 1e6})
+
+    @contextlib.contextmanager
+    def step(self, t):
+        self._flush()  # what ran before this step, e.g. the text encoding
+        with self.stage('step', t=t):
+            yield
+        row = {'step': len(self.steps), 't': t}
+        row.update(self.counts)
+        self.steps.append(row)
+        self._flush()
+
+    def summary(self):
+        """
+        :return: a dict with the total time, the time and number of calls of every stage, the number of
+                 guidance iterations and of steps.
+        """
+        summary = {'n_steps': len(self.steps), 'time_total': self.total_time}
+        summary.update(self.totals)
+        return summary
+
+    def logkvs(self, per_step=True):
+        """
+        Write the timings through diffusion.logger, one row per step (if per_step) and one with the totals.
+        """
+        if per_step:
+            for row in self.steps:
+                logger.logkvs(row)
+                logger.dumpkvs()
+        logger.logkv('step', 'total')
+        logger.logkvs(self.summary())
+        logger.dumpkvs()
+
+    def save_trace(self, path):
+        with open(path, 'w') as fw:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, fw)
+
+    def _flush(self):
+        for key, value in self.counts.items():
+            self.totals[key] += value
+        self.counts.clear()
+
+    def _sync(self):
+        if self.sync_cuda:
+            torch.cuda.synchronize()
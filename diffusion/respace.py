@@ -18,13 +18,18 @@ def space_timesteps(num_timesteps, section_counts):
     If the stride is a string starting with "ddim", then the fixed striding
     from the DDIM paper is used, and only one section is allowed.
 
+    If the stride is a string starting with "quad", then the steps are spaced
+    quadratically, i.e. denser towards t=0, which suits few-step multistep
+    solvers such as DPM-Solver++. Only one section is allowed.
+
     :param num_timesteps: the number of diffusion steps in the original
                           process to divide up.
     :param section_counts: either a list of numbers, or a string containing
                            comma-separated numbers, indicating the step count
                            per section. As a special case, use "ddimN" where N
                            is a number of steps to use the striding from the
-                           DDIM paper.
+                           DDIM paper, or "quadN" for N quadratically spaced
+                           steps.
     :return: a set of diffusion steps from the original process to use.
     """
     if isinstance(section_counts, str):
@@ -36,6 +41,22 @@ def space_timesteps(num_timesteps, section_counts):
             raise ValueError(
                 f"cannot create exactly {num_timesteps} steps with an integer stride"
             )
+        if section_counts.startswith("quad"):
+            desired_count = int(section_counts[len("quad") :])
+            if desired_count > num_timesteps:
+                raise ValueError(
+                    f"cannot create {desired_count} steps out of {num_timesteps}"
+                )
+            steps = np.linspace(0, np.sqrt(num_timesteps - 1), desired_count) ** 2
+            all_steps = []
+            for i, step in enumerate(steps):
+                # keep the steps distinct where the quadratic spacing is denser than 1
+                step = int(round(step))
+                if all_steps:
+                    step = max(step, all_steps[-1] + 1)
+                step = min(step, num_timesteps - desired_count + i)
+                all_steps.append(step)
+            return set(all_steps)
         section_counts = [int(x) for x in section_counts.split(",")]
     size_per = num_timesteps // len(section_counts)
     extra = num_timesteps % len(section_counts)
@@ -85,6 +106,7 @@ class SpacedDiffusion(GaussianDiffusion):
                 self.timestep_map.append(i)
         kwargs["betas"] = np.array(new_betas)
         super().__init__(**kwargs)
+        self.timestep_map_tensors = {}  # timestep_map on each device, shared by the wrapped models
 
     def p_mean_variance(
         self, model, *args, **kwargs
@@ -106,24 +128,36 @@ class SpacedDiffusion(GaussianDiffusion):
         if isinstance(model, _WrappedModel):
             return model
         return _WrappedModel(
-            model, self.timestep_map, self.rescale_timesteps, self.original_num_steps
+            model, self.timestep_map, self.rescale_timesteps, self.original_num_steps, self.timestep_map_tensors
         )
 
     def _scale_timesteps(self, t):
         # Scaling is done by the wrapped model.
         return t
+
+    def original_timesteps(self, t):
+        return _map_timesteps(self.timestep_map, self.timestep_map_tensors, t)
     
 
 class _WrappedModel:
-    def __init__(self, model, timestep_map, rescale_timesteps, original_num_steps):
+    def __init__(self, model, timestep_map, rescale_timesteps, original_num_steps, map_tensors=None):
         self.model = model
         self.timestep_map = timestep_map
         self.rescale_timesteps = rescale_timesteps
         self.original_num_steps = original_num_steps
+        self.map_tensors = {} if map_tensors is None else map_tensors
 
     def __call__(self, x, ts, **kwargs):
-        map_tensor = th.tensor(self.timestep_map, device=ts.device, dtype=ts.dtype)
-        new_ts = map_tensor[ts]
+        new_ts = _map_timesteps(self.timestep_map, self.map_tensors, ts)
         if self.rescale_timesteps:
             new_ts = new_ts.float() * (1000.0 / self.original_num_steps)
         return self.model(x, new_ts, **kwargs)
+
+
+def _map_timesteps(timestep_map, map_tensors, ts):
+    # timestep_map[ts], with a copy of timestep_map cached in map_tensors for each device and dtype
+    key = (ts.device, ts.dtype)
+    map_tensor = map_tensors.get(key)
+    if map_tensor is None:
+        map_tensor = map_tensors[key] = th.tensor(timestep_map, device=ts.device, dtype=ts.dtype)
+    return map_tensor[ts]
@@ -8,7 +8,8 @@ from data_loaders.humanml.networks.evaluator_wrapper import EvaluatorMDMWrapper
 from collections import OrderedDict
 from data_loaders.humanml.scripts.motion_process import *
 from data_loaders.humanml.utils.utils import *
-from utils.model_util import create_model_and_diffusion, load_model_wo_clip
+from utils.model_util import load_model_and_diffusion, get_sample_fn
+from model.quantization import quantize_cmdm
 
 from diffusion import logger
 from utils import dist_util
@@ -78,79 +79,80 @@ def evaluate_control(motion_loaders, file):
     skating_ratio_dict = OrderedDict({})
     trajectory_score_dict = OrderedDict({})
 
-    motion_loader_name = 'vald'
-    motion_loader = motion_loaders[motion_loader_name]
     print('========== Evaluating Control ==========')
-    # all_dist = []
-    all_size = 0
-    dist_sum = 0
-    skate_ratio_sum = 0
-    traj_err = []
-    traj_err_key = traj_err_key = ["traj_fail_20cm", "traj_fail_50cm", "kps_fail_20cm", "kps_fail_50cm", "kps_mean_err(m)"]
-    # print(motion_loader_name)
-    with torch.no_grad():
-        for idx, batch in enumerate(motion_loader):
-            word_embeddings, pos_one_hots, _, sent_lens, motions, m_lens, _, hint = batch
-            # process motion
-            # sample to motion
-            mean_for_eval = motion_loader.dataset.dataloader.dataset.mean_for_eval
-            std_for_eval = motion_loader.dataset.dataloader.dataset.std_for_eval
-            motions = motions * std_for_eval + mean_for_eval
-            motions = motions.float()
-            n_joints = 22 if motions.shape[-1] == 263 else 21
-            motions = recover_from_ric(motions, n_joints)
-            if n_joints == 21:
-                # kit
-                motions = motions * 0.001
+    for motion_loader_name, motion_loader in motion_loaders.items():
+        if motion_loader_name == 'ground truth':
+            continue
+        # all_dist = []
+        all_size = 0
+        dist_sum = 0
+        skate_ratio_sum = 0
+        traj_err = []
+        traj_err_key = traj_err_key = ["traj_fail_20cm", "traj_fail_50cm", "kps_fail_20cm", "kps_fail_50cm", "kps_mean_err(m)"]
+        # print(motion_loader_name)
+        with torch.no_grad():
+            for idx, batch in enumerate(motion_loader):
+                word_embeddings, pos_one_hots, _, sent_lens, motions, m_lens, _, hint = batch
+                # process motion
+                # sample to motion
+                mean_for_eval = motion_loader.dataset.dataloader.dataset.mean_for_eval
+                std_for_eval = motion_loader.dataset.dataloader.dataset.std_for_eval
+                motions = motions * std_for_eval + mean_for_eval
+                motions = motions.float()
+                n_joints = 22 if motions.shape[-1] == 263 else 21
+                motions = recover_from_ric(motions, n_joints)
+                if n_joints == 21:
+                    # kit
+                    motions = motions * 0.001
             
-            # foot skating error
-            if n_joints == 21:
-                skate_ratio, skate_vel = calculate_skating_ratio_kit(motions.permute(0, 2, 3, 1))  # [batch_size]
-            else:
-                skate_ratio, skate_vel = calculate_skating_ratio(motions.permute(0, 2, 3, 1))  # [batch_size]
-            skate_ratio_sum += skate_ratio.sum()
-
-            # control l2 error
-            # process hint
-            mask_hint = hint.view(hint.shape[0], hint.shape[1], n_joints, 3).sum(dim=-1, keepdim=True) != 0
-            raw_mean = motion_loader.dataset.dataloader.dataset.t2m_dataset.raw_mean
-            raw_std = motion_loader.dataset.dataloader.dataset.t2m_dataset.raw_std
-            hint = hint * raw_std + raw_mean
-            if n_joints == 21:
-                hint = hint * 0.001
-            hint = hint.view(hint.shape[0], hint.shape[1], n_joints, 3) * mask_hint
-            for motion, h, mask in zip(motions, hint, mask_hint):
-                control_error = control_l2(motion.unsqueeze(0).numpy(), h.unsqueeze(0).numpy(), mask.unsqueeze(0).numpy())
-                mean_error = control_error.sum() / mask.sum()
-                dist_sum += mean_error
-                control_error = control_error.reshape(-1)
-                mask = mask.reshape(-1)
-                err_np = calculate_trajectory_error(control_error, mean_error, mask)
-                traj_err.append(err_np)
-
-            all_size += motions.shape[0]
-
-        # l2 dist
-        dist_mean = dist_sum / all_size
-        l2_dict[motion_loader_name] = dist_mean
-
-        # Skating evaluation
-        skating_score = skate_ratio_sum / all_size
-        skating_ratio_dict[motion_loader_name] = skating_score
-
-        ### For trajecotry evaluation from GMD ###
-        traj_err = np.stack(traj_err).mean(0)
-        trajectory_score_dict[motion_loader_name] = traj_err
-
-    print(f'---> [{motion_loader_name}] Control L2 dist: {dist_mean:.4f}')
-    print(f'---> [{motion_loader_name}] Control L2 dist: {dist_mean:.4f}', file=file, flush=True)
-    print(f'---> [{motion_loader_name}] Skating Ratio: {skating_score:.4f}')
-    print(f'---> [{motion_loader_name}] Skating Ratio: {skating_score:.4f}', file=file, flush=True)
-    line = f'---> [{motion_loader_name}] Trajectory Error: '
-    for (k, v) in zip(traj_err_key, traj_err):
-        line += '(%s): %.4f ' % (k, np.mean(v))
-    print(line)
-    print(line, file=file, flush=True)
+                # foot skating error
+                if n_joints == 21:
+                    skate_ratio, skate_vel = calculate_skating_ratio_kit(motions.permute(0, 2, 3, 1))  # [batch_size]
+                else:
+                    skate_ratio, skate_vel = calculate_skating_ratio(motions.permute(0, 2, 3, 1))  # [batch_size]
+                skate_ratio_sum += skate_ratio.sum()
+
+                # control l2 error
+                # process hint
+                mask_hint = hint.view(hint.shape[0], hint.shape[1], n_joints, 3).sum(dim=-1, keepdim=True) != 0
+                raw_mean = motion_loader.dataset.dataloader.dataset.t2m_dataset.raw_mean
+                raw_std = motion_loader.dataset.dataloader.dataset.t2m_dataset.raw_std
+                hint = hint * raw_std + raw_mean
+                if n_joints == 21:
+                    hint = hint * 0.001
+                hint = hint.view(hint.shape[0], hint.shape[1], n_joints, 3) * mask_hint
+                for motion, h, mask in zip(motions, hint, mask_hint):
+                    control_error = control_l2(motion.unsqueeze(0).numpy(), h.unsqueeze(0).numpy(), mask.unsqueeze(0).numpy())
+                    mean_error = control_error.sum() / mask.sum()
+                    dist_sum += mean_error
+                    control_error = control_error.reshape(-1)
+                    mask = mask.reshape(-1)
+                    err_np = calculate_trajectory_error(control_error, mean_error, mask)
+                    traj_err.append(err_np)
+
+                all_size += motions.shape[0]
+
+            # l2 dist
+            dist_mean = dist_sum / all_size
+            l2_dict[motion_loader_name] = dist_mean
+
+            # Skating evaluation
+            skating_score = skate_ratio_sum / all_size
+            skating_ratio_dict[motion_loader_name] = skating_score
+
+            ### For trajecotry evaluation from GMD ###
+            traj_err = np.stack(traj_err).mean(0)
+            trajectory_score_dict[motion_loader_name] = traj_err
+
+        print(f'---> [{motion_loader_name}] Control L2 dist: {dist_mean:.4f}')
+        print(f'---> [{motion_loader_name}] Control L2 dist: {dist_mean:.4f}', file=file, flush=True)
+        print(f'---> [{motion_loader_name}] Skating Ratio: {skating_score:.4f}')
+        print(f'---> [{motion_loader_name}] Skating Ratio: {skating_score:.4f}', file=file, flush=True)
+        line = f'---> [{motion_loader_name}] Trajectory Error: '
+        for (k, v) in zip(traj_err_key, traj_err):
+            line += '(%s): %.4f ' % (k, np.mean(v))
+        print(line)
+        print(line, file=file, flush=True)
     return l2_dict, skating_ratio_dict, trajectory_score_dict
 
 
@@ -349,11 +351,23 @@ if __name__ == '__main__':
     fixseed(args.seed)
     args.batch_size = 32 # This must be 32! Don't change it! otherwise it will cause a bug in R precision calc!
     name = os.path.basename(os.path.dirname(args.model_path))
-    niter = os.path.basename(args.model_path).replace('model', '').replace('.pt', '')
+    niter = os.path.splitext(os.path.basename(args.model_path))[0].replace('model', '')
     log_file = os.path.join(os.path.dirname(args.model_path), 'eval_humanml_{}_{}'.format(name, niter))
     if args.guidance_param != 1.:
         log_file += f'_gscale{args.guidance_param}'
+        if args.guidance_interval is not None:
+            log_file += f'_ginterval{args.guidance_interval[0]}-{args.guidance_interval[1]}'
+        if args.guidance_schedule != 'constant':
+            log_file += f'_gsched{args.guidance_schedule}'
     log_file += f'_{args.eval_mode}'
+    if args.sampler != 'ddpm' or args.sample_steps > 0:
+        log_file += f'_{args.sampler}{args.sample_steps}'
+    if args.text_only:
+        log_file += '_textonly'
+    elif args.skip_empty_control:
+        log_file += '_skipcontrol'
+    if args.quantize:
+        log_file += '_int8'
     log_file += f'_joint{args.control_joint}'
     log_file += f'_density{args.density}'
     # log_file += '_cross_random'
@@ -384,26 +398,62 @@ if __name__ == '__main__':
     num_actions = gen_loader.dataset.num_actions
 
     logger.log("Creating model and diffusion...")
-    model, diffusion = create_model_and_diffusion(args, gen_loader)
-
     logger.log(f"Loading checkpoints from [{args.model_path}]...")
-    state_dict = torch.load(args.model_path, map_location='cpu')
-    load_model_wo_clip(model, state_dict)
+    model, diffusion = load_model_and_diffusion(args, gen_loader, quantize=False)
+    cmdm = model
 
     if args.guidance_param != 1:
-        model = ClassifierFreeSampleModel(model)   # wrapping model with the classifier-free sampler
+        model = ClassifierFreeSampleModel(model, fused=args.fused_cfg, guidance_interval=args.guidance_interval,
+                                          guidance_schedule=args.guidance_schedule)   # wrapping model with the classifier-free sampler
     model.to(dist_util.dev())
     model.eval()  # disable random masking
 
+    def get_loader(skip_empty_control, model=model):
+        (model.model if args.guidance_param != 1 else model).skip_empty_control = skip_empty_control
+        return get_mdm_loader(
+            model, diffusion, args.batch_size,
+            gen_loader, mm_num_samples, mm_num_repeats, gt_loader.dataset.opt.max_motion_length, num_samples_limit, args.guidance_param,
+            sample_fn=get_sample_fn(args, diffusion), text_only=args.text_only
+        )
+
     eval_motion_loaders = {
         ################
         ## HumanML3D Dataset##
         ################
-        'vald': lambda: get_mdm_loader(
-            model, diffusion, args.batch_size,
-            gen_loader, mm_num_samples, mm_num_repeats, gt_loader.dataset.opt.max_motion_length, num_samples_limit, args.guidance_param
-        )
+        'vald': lambda: get_loader(args.skip_empty_control and not args.text_only),
     }
+    if args.text_only:
+        # the same prompts, once with the control branch run on empty hints and once without it
+        eval_motion_loaders['vald_skip_control'] = lambda: get_loader(True)
+    if args.quantize:
+        # the same checkpoint quantized to int8, evaluated on the same prompts and hints as vald
+        assert dist_util.dev().type == 'cpu', 'the quantized model runs on the cpu only, use --device -1'
+        quantized_model = quantize_cmdm(cmdm, inplace=False)
+        if args.guidance_param != 1:
+            quantized_model = ClassifierFreeSampleModel(quantized_model, fused=args.fused_cfg,
+                                                        guidance_interval=args.guidance_interval,
+                                                        guidance_schedule=args.guidance_schedule)
+        quantized_model.eval()
+        eval_motion_loaders['vald_int8'] = lambda: get_loader(args.skip_empty_control and not args.text_only,
+                                                              quantized_model)
 
     eval_wrapper = EvaluatorMDMWrapper(args.dataset, dist_util.dev())
-    evaluation(eval_wrapper, gt_loader, eval_motion_loaders, log_file, replication_times, diversity_times, mm_num_times, run_mm=run_mm)
+    mean_dict = evaluation(eval_wrapper, gt_loader, eval_motion_loaders, log_file, replication_times, diversity_times, mm_num_times, run_mm=run_mm)
+
+    if args.quantize:
+        with open(log_file, 'a') as f:
+            print('========== int8 - fp32 Deltas ==========')
+            print('========== int8 - fp32 Deltas ==========', file=f, flush=True)
+            for metric_name in ['FID', 'R_precision', 'Matching Score', 'Diversity', 'Control_l2', 'Skating Ratio',
+                                'Trajectory Error']:
+                delta = np.atleast_1d(mean_dict[metric_name + '_vald_int8'] - mean_dict[metric_name + '_vald'])
+                line = f'---> [{metric_name}] ' + ' '.join('%+.4f' % d for d in delta)
+                print(line)
+                print(line, file=f, flush=True)
+
+    if args.guidance_param != 1:
+        # the forward passes saved by the guidance interval/schedule, to weigh against the metrics above
+        line = f'CFG forward passes: {model.n_cond_passes} conditional, {model.n_uncond_passes} unconditional'
+        print(line)
+        with open(log_file, 'a') as f:
+            print(line, file=f, flush=True)
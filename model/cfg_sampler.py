@@ -2,15 +2,25 @@
 import numpy as np
 import torch
 import torch.nn as nn
-from copy import deepcopy
+from diffusion.profiler import profile_stage
 
 # A wrapper model for Classifier-free guidance **SAMPLING** only
 # https://arxiv.org/abs/2207.12598
 class ClassifierFreeSampleModel(nn.Module):
 
-    def __init__(self, model):
+    def __init__(self, model, fused=False, guidance_interval=None, guidance_schedule='constant', num_timesteps=1000):
         super().__init__()
         self.model = model  # model is the actual model to run
+        # if True, run the conditional and unconditional passes as a single 2B batch
+        self.fused = fused
+        # guidance is applied only for timesteps in [lo, hi] (in the original 0..num_timesteps-1 range),
+        # with the scale weighted by guidance_schedule. Elsewhere only the conditional pass runs.
+        self.guidance_interval = guidance_interval
+        self.guidance_schedule = guidance_schedule
+        self.num_timesteps = num_timesteps
+        assert self.guidance_schedule in ['constant', 'linear', 'cosine'], f'unknown guidance schedule: {guidance_schedule}'
+        # number of conditional/unconditional forward passes (per batch) since the last reset_pass_counts()
+        self.reset_pass_counts()
 
         assert self.model.cond_mask_prob > 0, 'Cannot run a guided diffusion on a model that has not been trained with no conditions'
 
@@ -22,12 +32,62 @@ class ClassifierFreeSampleModel(nn.Module):
         self.data_rep = self.model.data_rep
         self.cond_mode = self.model.cond_mode
 
+    def cache_text_embedding(self, y):
+        return self.model.cache_text_embedding(y)
+
+    def reset_pass_counts(self):
+        self.n_cond_passes = 0
+        self.n_uncond_passes = 0
+
+    def guidance_weight(self, timesteps):
+        # [bs] weight in [0, 1] of the guidance at each sample's timestep
+        t = timesteps.float() / (self.num_timesteps - 1)
+        if self.guidance_schedule == 'constant':
+            weight = torch.ones_like(t)
+        elif self.guidance_schedule == 'linear':
+            weight = t
+        else:
+            weight = (1. - torch.cos(np.pi * t)) / 2.
+        if self.guidance_interval is not None:
+            lo, hi = self.guidance_interval
+            weight = weight * ((timesteps >= lo) & (timesteps <= hi)).float()
+        return weight
+
     def forward(self, x, timesteps, y=None):
         cond_mode = self.model.cond_mode
         assert cond_mode in ['only_text', 'only_spatial', 'both_text_spatial']
-        y_uncond = deepcopy(y)
-        y_uncond['uncond'] = True
-        out = self.model(x, timesteps, y)
-        out_uncond = self.model(x, timesteps, y_uncond)
-        return out_uncond + (y['scale'].view(-1, 1, 1, 1) * (out - out_uncond))
+        weight = self.guidance_weight(timesteps)
+        if not (weight > 0).any():
+            # outside of the guidance interval - the guided output equals the conditional one
+            self.n_cond_passes += 1
+            with profile_stage('cfg_cond'):
+                return self.model(x, timesteps, y)
+        self.n_cond_passes += 1
+        self.n_uncond_passes += 1
+        if self.fused:
+            with profile_stage('cfg_fused'):
+                out, out_uncond = self.fused_forward(x, timesteps, y)
+        else:
+            y_uncond = dict(y)  # the model does not modify y, a shallow copy is enough
+            y_uncond['uncond'] = True
+            with profile_stage('cfg_cond'):
+                out = self.model(x, timesteps, y)
+            with profile_stage('cfg_uncond'):
+                out_uncond = self.model(x, timesteps, y_uncond)
+        scale = 1. + (y['scale'] - 1.) * weight
+        return out_uncond + (scale.view(-1, 1, 1, 1) * (out - out_uncond))
 
+    def fused_forward(self, x, timesteps, y):
+        # stack [cond; uncond] along the batch and mask the condition of the second half per sample
+        bs = x.shape[0]
+        y_both = {}
+        for k, v in y.items():
+            if torch.is_tensor(v) and v.dim() > 0 and v.shape[0] == bs:
+                y_both[k] = torch.cat([v, v], dim=0)
+            elif isinstance(v, list) and len(v) == bs:
+                y_both[k] = v + v
+            else:
+                y_both[k] = v
+        y_both['uncond'] = torch.arange(2 * bs, device=x.device) >= bs
+        out_both = self.model(torch.cat([x, x], dim=0), torch.cat([timesteps, timesteps], dim=0), y_both)
+        return out_both[:bs], out_both[bs:]
@@ -0,0 +1,57 @@
+import torch
+import torch.nn as nn
+
+
+TEXT_TOWER_PREFIXES = ('token_embedding.', 'positional_embedding', 'transformer.', 'ln_final.', 'text_projection')
+
+
+class CLIPTextTower(nn.Module):
+    """
+    The text half of a CLIP model (clip.model.CLIP without the image encoder), with the same
+    parameter names and the same encode_text(), so that CMDM can use it as its clip_model.
+    """
+
+    def __init__(self, embed_dim, context_length, vocab_size, transformer_width, transformer_heads,
+                 transformer_layers):
+        super().__init__()
+        from clip.model import Transformer, LayerNorm
+        self.context_length = context_length
+        self.transformer = Transformer(width=transformer_width, layers=transformer_layers,
+                                       heads=transformer_heads, attn_mask=self.build_attention_mask())
+        self.token_embedding = nn.Embedding(vocab_size, transformer_width)
+        self.positional_embedding = nn.Parameter(torch.empty(context_length, transformer_width))
+        self.ln_final = LayerNorm(transformer_width)
+        self.text_projection = nn.Parameter(torch.empty(transformer_width, embed_dim))
+
+    @classmethod
+    def config_from_state_dict(cls, state_dict):
+        # same as clip.model.build_model
+        transformer_width = state_dict['ln_final.weight'].shape[0]
+        return {'embed_dim': state_dict['text_projection'].shape[1],
+                'context_length': state_dict['positional_embedding'].shape[0],
+                'vocab_size': state_dict['token_embedding.weight'].shape[0],
+                'transformer_width': transformer_width,
+                'transformer_heads': transformer_width // 64,
+                'transformer_layers': len(set(k.split('.')[2] for k in state_dict
+                                              if k.startswith('transformer.resblocks')))}
+
+    def build_attention_mask(self):
+        mask = torch.empty(self.context_length, self.context_length)
+        mask.fill_(float('-inf'))
+        mask.triu_(1)
+        return mask
+
+    @property
+    def dtype(self):
+        # clip.model.convert_weights casts the projections, not the embeddings
+        return self.text_projection.dtype
+
+    def encode_text(self, text):
+        x = self.token_embedding(text).type(self.dtype)  # [batch_size, n_ctx, d_model]
+        x = x + self.positional_embedding.type(self.dtype)
+        x = x.permute(1, 0, 2)  # NLD -> LND
+        x = self.transformer(x)
+        x = x.permute(1, 0, 2)  # LND -> NLD
+        x = self.ln_final(x).type(self.dtype)
+        # take features from the eot embedding (eot_token is the highest number in each sequence)
+        return x[torch.arange(x.shape[0]), text.argmax(dim=-1)] @ self.text_projection
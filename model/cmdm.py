@@ -1,12 +1,43 @@
 # This code is modified based on https://github.com/GuyTevet/motion-diffusion-model
+import contextlib
 import numpy as np
 import torch
 import torch.nn as nn
-import clip
+from collections import OrderedDict
 from model.rotation2xyz import Rotation2xyz
+from diffusion.profiler import profile_stage
 from .transformer import *
 
 
+def precision_autocast(precision, device):
+    """
+    The autocast context of an inference precision ('fp32', 'bf16' or 'fp16') on device.
+    """
+    if precision == 'fp32':
+        return contextlib.nullcontext()
+    dtype = {'bf16': torch.bfloat16, 'fp16': torch.float16}[precision]
+    if hasattr(torch, 'autocast'):  # torch >= 1.10, also on cpu
+        return torch.autocast(device_type=device.type, dtype=dtype)
+    if device.type != 'cuda' or precision != 'fp16':
+        raise ValueError(f'{precision} autocast on {device.type} needs torch >= 1.10')
+    return torch.cuda.amp.autocast()
+
+
+def autocast_state(device):
+    """
+    (enabled, dtype) of the autocast context active on device.
+    """
+    if hasattr(torch, 'get_autocast_dtype'):  # torch >= 2.4
+        return torch.is_autocast_enabled(device.type), torch.get_autocast_dtype(device.type)
+    if device.type == 'cpu':
+        if hasattr(torch, 'is_autocast_cpu_enabled'):  # torch >= 1.10
+            return torch.is_autocast_cpu_enabled(), torch.get_autocast_cpu_dtype()
+        return False, None
+    if hasattr(torch, 'get_autocast_gpu_dtype'):  # torch >= 1.10
+        return torch.is_autocast_enabled(), torch.get_autocast_gpu_dtype()
+    return torch.is_autocast_enabled(), torch.float16
+
+
 def zero_module(module):
     """
     Zero out the parameters of a module and return it.
@@ -16,6 +47,10 @@ def zero_module(module):
     return module
 
 
+# frozen CLIP models by version, shared by all the CMDM instances of the process
+_CLIP_MODELS = {}
+
+
 class CMDM(torch.nn.Module):
     def __init__(self, modeltype, njoints, nfeats, num_actions, translation, pose_rep, glob, glob_rot,
                  latent_dim=256, ff_size=1024, num_layers=8, num_heads=4, dropout=0.1,
@@ -54,10 +89,20 @@ class CMDM(torch.nn.Module):
 
         self.cond_mode = kargs.get('cond_mode', 'no_cond')
         self.cond_mask_prob = kargs.get('cond_mask_prob', 0.)
+        # skip the control branch for the samples without a hint, instead of running it on an all-zero hint
+        self.skip_empty_control = kargs.get('skip_empty_control', False)
+        # mask the padded frames (y['mask']) out of the attention of both encoders
+        self.mask_padding = kargs.get('mask_padding', False)
+        # the forward pass runs under autocast with 'bf16' or 'fp16', its output is fp32 either way
+        self.precision = kargs.get('precision', 'fp32')
+        # LRU of CLIP text embeddings keyed by prompt, shared by all requests to this model
+        self.text_cache_size = kargs.get('text_cache_size', 1024)
+        self.text_embed_cache = OrderedDict()
         self.arch = arch
         self.gru_emb_dim = self.latent_dim if self.arch == 'gru' else 0
         self.emb_trans_dec = emb_trans_dec
 
+        # SMPL is loaded on the first use of rot2xyz.smpl_model, never for the xyz and hml_vec reps
         self.rot2xyz = Rotation2xyz(device='cpu', dataset=self.dataset)
         # --- MDM ---
         self.input_process = InputProcess(self.data_rep, self.input_feats+self.gru_emb_dim, self.latent_dim)
@@ -73,7 +118,8 @@ class CMDM(torch.nn.Module):
         self.seqTransEncoder = TransformerEncoder(seqTransEncoderLayer,
                                                 num_layers=self.num_layers)
 
-        self.embed_timestep = TimestepEmbedder(self.latent_dim, self.sequence_pos_encoder)
+        self.num_timesteps = kargs.get('num_timesteps', 1000)
+        self.embed_timestep = TimestepEmbedder(self.latent_dim, self.sequence_pos_encoder, self.num_timesteps)
 
         if self.cond_mode != 'no_cond':
             if 'text' in self.cond_mode:
@@ -81,6 +127,9 @@ class CMDM(torch.nn.Module):
                 print('EMBED TEXT')
                 print('Loading CLIP...')
                 self.clip_version = clip_version
+                # the frozen CLIP is shared by all the CMDM instances of the process (see
+                # load_and_freeze_clip): moving or casting one instance (.to(device), .half(),
+                # convert_weights) also moves or casts the CLIP of all the others
                 self.clip_model = self.load_and_freeze_clip(clip_version)
 
         self.output_process = OutputProcess(self.data_rep, self.input_feats, self.latent_dim, self.njoints,
@@ -107,7 +156,7 @@ class CMDM(torch.nn.Module):
 
         self.zero_convs = zero_module(nn.ModuleList([nn.Linear(self.latent_dim, self.latent_dim) for _ in range(self.num_layers)]))
         
-        self.c_embed_timestep = TimestepEmbedder(self.latent_dim, self.sequence_pos_encoder)
+        self.c_embed_timestep = TimestepEmbedder(self.latent_dim, self.sequence_pos_encoder, self.num_timesteps)
 
         if self.cond_mode != 'no_cond':
             if 'text' in self.cond_mode:
@@ -117,6 +166,11 @@ class CMDM(torch.nn.Module):
         return [p for name, p in self.named_parameters() if not name.startswith('clip_model.')]
 
     def load_and_freeze_clip(self, clip_version):
+        # CLIP is frozen, so the instances of the process (e.g. several checkpoints served together) share it.
+        # Moving one instance to a device also moves the CLIP of the others.
+        if clip_version in _CLIP_MODELS:
+            return _CLIP_MODELS[clip_version]
+        import clip
         clip_model, clip_preprocess = clip.load(clip_version, device='cpu',
                                                 jit=False)  # Must set jit=False for training
         clip.model.convert_weights(
@@ -127,11 +181,15 @@ class CMDM(torch.nn.Module):
         for p in clip_model.parameters():
             p.requires_grad = False
 
+        _CLIP_MODELS[clip_version] = clip_model
         return clip_model
 
     def mask_cond(self, cond, force_mask=False):
+        # force_mask - either a bool for the whole batch, or a per-sample bool tensor [bs] (1-> use null_cond)
         bs, d = cond.shape
-        if force_mask:
+        if torch.is_tensor(force_mask):
+            return cond * (~force_mask).float().view(bs, 1)
+        elif force_mask:
             return torch.zeros_like(cond)
         elif self.training and self.cond_mask_prob > 0.:
             mask = torch.bernoulli(torch.ones(bs, device=cond.device) * self.cond_mask_prob).view(bs, 1)  # 1-> use null_cond, 0-> use real cond
@@ -141,6 +199,7 @@ class CMDM(torch.nn.Module):
 
     def encode_text(self, raw_text):
         # raw_text - list (batch_size length) of strings with input text prompts
+        import clip
         device = next(self.parameters()).device
         max_text_len = 20 if self.dataset in ['humanml', 'kit'] else None  # Specific hardcoding for humanml dataset
         if max_text_len is not None:
@@ -154,7 +213,49 @@ class CMDM(torch.nn.Module):
             # print('texts after pad', texts.shape, texts)
         else:
             texts = clip.tokenize(raw_text, truncate=True).to(device) # [bs, context_length] # if n_tokens > 77 -> will truncate
-        return self.clip_model.encode_text(texts).float()
+        with profile_stage('clip'):
+            return self.clip_model.encode_text(texts).float()
+
+    def encode_text_cached(self, raw_text):
+        # same as encode_text, but each distinct prompt is encoded at most once while it is in the LRU
+        device = next(self.parameters()).device
+        missing = [text for text in OrderedDict.fromkeys(raw_text) if text not in self.text_embed_cache]
+        if len(missing) > 0:
+            with torch.no_grad():
+                enc_missing = self.encode_text(missing)
+            for text, enc in zip(missing, enc_missing):
+                self.text_embed_cache[text] = enc
+        enc_text = []
+        for text in raw_text:
+            self.text_embed_cache.move_to_end(text)
+            enc_text.append(self.text_embed_cache[text])
+        while len(self.text_embed_cache) > self.text_cache_size:
+            self.text_embed_cache.popitem(last=False)
+        return torch.stack(enc_text).to(device)
+
+    def cache_text_embedding(self, y):
+        """
+        Encode y['text'] once and keep it in y['text_embed'], so that all the forward passes
+        on this batch (both branches, both CFG passes and all the denoising steps) reuse it.
+        """
+        if 'text' in self.cond_mode and 'text' in y:
+            y['text_embed'] = self.encode_text_cached(y['text'])
+        return y
+
+    def get_text_embedding(self, y):
+        if 'text_embed' in y:
+            return y['text_embed']
+        return self.encode_text(y['text'])
+
+    def padding_mask(self, y, bs):
+        """
+        The key padding mask of the encoders, [bs, seqlen+1], True for the padded frames.
+        The first token (the timestep and text embedding) is never masked.
+        """
+        if not self.mask_padding or 'mask' not in y.keys():
+            return None
+        frames_mask = y['mask'].view(bs, -1)
+        return ~torch.cat([torch.ones_like(frames_mask[:, :1]), frames_mask], dim=1)
 
     def cmdm_forward(self, x, timesteps, y=None, weight=1.0):
         """
@@ -171,7 +272,7 @@ class CMDM(torch.nn.Module):
 
         force_mask = y.get('uncond', False)
         if 'text' in self.cond_mode:
-            enc_text = self.encode_text(y['text'])
+            enc_text = self.get_text_embedding(y)
             emb += self.c_embed_text(self.mask_cond(enc_text, force_mask=force_mask))
 
         x = self.c_input_process(x)
@@ -181,7 +282,7 @@ class CMDM(torch.nn.Module):
         # adding the timestep embed
         xseq = torch.cat((emb, x), axis=0)  # [seqlen+1, bs, d]
         xseq = self.c_sequence_pos_encoder(xseq)  # [seqlen+1, bs, d]
-        output = self.c_seqTransEncoder(xseq)  # [seqlen+1, bs, d]
+        output = self.c_seqTransEncoder(xseq, src_key_padding_mask=self.padding_mask(y, xseq.shape[1]))  # [seqlen+1, bs, d]
 
         control = []
         for i, module in enumerate(self.zero_convs):
@@ -200,7 +301,7 @@ class CMDM(torch.nn.Module):
 
         force_mask = y.get('uncond', False)
         if 'text' in self.cond_mode:
-            enc_text = self.encode_text(y['text'])
+            enc_text = self.get_text_embedding(y)
             emb += self.embed_text(self.mask_cond(enc_text, force_mask=force_mask))
 
         x = self.input_process(x)
@@ -208,34 +309,63 @@ class CMDM(torch.nn.Module):
         # adding the timestep embed
         xseq = torch.cat((emb, x), axis=0)  # [seqlen+1, bs, d]
         xseq = self.sequence_pos_encoder(xseq)  # [seqlen+1, bs, d]
-        output = self.seqTransEncoder(xseq, control=control)[1:]  # , src_key_padding_mask=~maskseq)  # [seqlen, bs, d]
+        output = self.seqTransEncoder(xseq, control=control,
+                                      src_key_padding_mask=self.padding_mask(y, xseq.shape[1]))[1:]  # [seqlen, bs, d]
 
         output = self.output_process(output)  # [bs, njoints, nfeats, nframes]
         return output
 
+    def hinted_cmdm_forward(self, x, timesteps, y=None):
+        """
+        cmdm_forward on the samples that have a hint only, the control of the other samples is zero.
+        Returns None if no sample has a hint.
+        """
+        if 'hint' not in y.keys():
+            return None
+        bs = x.shape[0]
+        idx = torch.nonzero((y['hint'] != 0).flatten(1).any(dim=1)).squeeze(1)
+        if len(idx) == bs:
+            return self.cmdm_forward(x, timesteps, y)
+        if len(idx) == 0:
+            return None
+        y_hinted = {k: v[idx] if torch.is_tensor(v) and v.dim() > 0 and v.shape[0] == bs
+                    else [v[i] for i in idx.tolist()] if isinstance(v, list) and len(v) == bs
+                    else v for k, v in y.items()}
+        hinted_control = self.cmdm_forward(x[idx], timesteps[idx], y_hinted)  # [num_layers, seqlen+1, len(idx), d]
+        control = hinted_control.new_zeros(hinted_control.shape[:2] + (bs,) + hinted_control.shape[3:])
+        control[:, :, idx] = hinted_control
+        return control
+
     def forward(self, x, timesteps, y=None):
         """
         x: [batch_size, njoints, nfeats, max_frames], denoted x_t in the paper
         timesteps: [batch_size] (int)
         """
-        if 'hint' in y.keys():
-            control = self.cmdm_forward(x, timesteps, y)
-        else:
-            n_joints = 22 if self.njoints == 263 else 21
-            y_ = {'hint': torch.zeros((x.shape[0], x.shape[-1], n_joints * 3), device=x.device)}
-            y_.update(y)
-            control = self.cmdm_forward(x, timesteps, y_)
-        output = self.mdm_forward(x, timesteps, y, control)
-        return output
+        with precision_autocast(self.precision, x.device):
+            with profile_stage('control'):
+                if self.skip_empty_control:
+                    control = self.hinted_cmdm_forward(x, timesteps, y)
+                elif 'hint' in y.keys():
+                    control = self.cmdm_forward(x, timesteps, y)
+                else:
+                    n_joints = 22 if self.njoints == 263 else 21
+                    y_ = {'hint': torch.zeros((x.shape[0], x.shape[-1], n_joints * 3), device=x.device)}
+                    y_.update(y)
+                    control = self.cmdm_forward(x, timesteps, y_)
+            with profile_stage('trunk'):
+                output = self.mdm_forward(x, timesteps, y, control)
+        # the diffusion coefficients and the spatial guidance stay in fp32
+        return output.float()
 
     def _apply(self, fn):
         super()._apply(fn)
-        self.rot2xyz.smpl_model._apply(fn)
+        self.rot2xyz._apply(fn)
+        self.text_embed_cache.clear()
 
 
     def train(self, *args, **kwargs):
         super().train(*args, **kwargs)
-        self.rot2xyz.smpl_model.train(*args, **kwargs)
+        self.rot2xyz.train(*args, **kwargs)
 
 
 class HintBlock(nn.Module):
@@ -280,10 +410,11 @@ class PositionalEncoding(nn.Module):
 
 
 class TimestepEmbedder(nn.Module):
-    def __init__(self, latent_dim, sequence_pos_encoder):
+    def __init__(self, latent_dim, sequence_pos_encoder, num_timesteps=1000):
         super().__init__()
         self.latent_dim = latent_dim
         self.sequence_pos_encoder = sequence_pos_encoder
+        self.num_timesteps = num_timesteps  # of the diffusion, the rows of the table
 
         time_embed_dim = self.latent_dim
         self.time_embed = nn.Sequential(
@@ -291,9 +422,21 @@ class TimestepEmbedder(nn.Module):
             nn.SiLU(),
             nn.Linear(time_embed_dim, time_embed_dim),
         )
+        self.embed_table = None
+        self.embed_table_key = None
 
     def forward(self, timesteps):
-        return self.time_embed(self.sequence_pos_encoder.pe[timesteps]).permute(1, 0, 2)
+        if self.training or torch.is_grad_enabled():
+            return self.time_embed(self.sequence_pos_encoder.pe[timesteps]).permute(1, 0, 2)
+        # at inference the embeddings of all the diffusion timesteps are computed once, the table is
+        # recomputed when the weights are moved, cast or updated in place, or the autocast precision changes
+        pe = self.sequence_pos_encoder.pe
+        key = tuple((p.data_ptr(), p.dtype, p._version) for p in self.time_embed.parameters()) + \
+            (pe.data_ptr(), autocast_state(pe.device))
+        if key != self.embed_table_key:
+            self.embed_table = self.time_embed(pe[:self.num_timesteps])
+            self.embed_table_key = key
+        return self.embed_table[timesteps].permute(1, 0, 2)
 
 
 class InputProcess(nn.Module):
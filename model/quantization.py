@@ -0,0 +1,85 @@
+import copy
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+# the CMDM modules whose nn.Linear layers are quantized: both transformers (attention projections
+# included, see SplitMultiheadAttention), the input/output and hint projections and the zero convs.
+# The timestep and text embeddings run once per step and CLIP is left as is.
+QUANTIZED_MODULES = ['seqTransEncoder', 'c_seqTransEncoder', 'input_process', 'c_input_process', 'output_process',
+                     'input_hint_block', 'zero_convs']
+
+
+class SplitMultiheadAttention(nn.Module):
+    """
+    nn.MultiheadAttention for inference, with the q/k/v input projections as separate nn.Linear.
+    quantize_dynamic only quantizes nn.Linear modules, not the packed in_proj_weight of nn.MultiheadAttention.
+    """
+
+    def __init__(self, embed_dim, num_heads):
+        super().__init__()
+        self.embed_dim = embed_dim
+        self.num_heads = num_heads
+        self.head_dim = embed_dim // num_heads
+        self.q_proj = nn.Linear(embed_dim, embed_dim)
+        self.k_proj = nn.Linear(embed_dim, embed_dim)
+        self.v_proj = nn.Linear(embed_dim, embed_dim)
+        self.out_proj = nn.Linear(embed_dim, embed_dim)
+
+    @classmethod
+    def from_float(cls, mha):
+        assert mha._qkv_same_embed_dim, 'separate q/k/v dimensions are not supported'
+        attn = cls(mha.embed_dim, mha.num_heads)
+        with torch.no_grad():
+            for proj, weight, bias in zip([attn.q_proj, attn.k_proj, attn.v_proj], mha.in_proj_weight.chunk(3),
+                                          mha.in_proj_bias.chunk(3)):
+                proj.weight.copy_(weight)
+                proj.bias.copy_(bias)
+            attn.out_proj.weight.copy_(mha.out_proj.weight)
+            attn.out_proj.bias.copy_(mha.out_proj.bias)
+        return attn
+
+    def forward(self, query, key, value, attn_mask=None, key_padding_mask=None, need_weights=False):
+        # query/key/value: [seqlen, bs, d], the attention weights are not returned
+        tgt_len, bs, _ = query.shape
+        src_len = key.shape[0]
+        q = self.q_proj(query) * self.head_dim ** -0.5
+        q = q.reshape(tgt_len, bs * self.num_heads, self.head_dim).transpose(0, 1)
+        k = self.k_proj(key).reshape(src_len, bs * self.num_heads, self.head_dim).transpose(0, 1)
+        v = self.v_proj(value).reshape(src_len, bs * self.num_heads, self.head_dim).transpose(0, 1)
+        weights = torch.bmm(q, k.transpose(1, 2))  # [bs * n_heads, tgt_len, src_len]
+        if attn_mask is not None:
+            if attn_mask.dtype == torch.bool:
+                weights = weights.masked_fill(attn_mask, float('-inf'))
+            else:
+                weights = weights + attn_mask
+        if key_padding_mask is not None:
+            weights = weights.view(bs, self.num_heads, tgt_len, src_len)
+            weights = weights.masked_fill(key_padding_mask[:, None, None, :], float('-inf'))
+            weights = weights.view(bs * self.num_heads, tgt_len, src_len)
+        output = torch.bmm(F.softmax(weights, dim=-1), v)
+        output = output.transpose(0, 1).reshape(tgt_len, bs, self.embed_dim)
+        return self.out_proj(output), None
+
+
+def quantize_cmdm(model, inplace=True):
+    """
+    Dynamic int8 quantization (int8 weights, activations quantized on the fly) of the linear layers of
+    QUANTIZED_MODULES, for CPU inference. The quantized model does not train and runs on the CPU only.
+
+    :param model: a CMDM.
+    :param inplace: if False, model is left as is and a quantized copy is returned.
+    """
+    if model.precision != 'fp32':
+        raise ValueError(f'a quantized model runs in fp32, not {model.precision}')
+    if not inplace:
+        model = copy.deepcopy(model)
+    model.eval()
+    for name in QUANTIZED_MODULES:
+        for module in getattr(model, name).modules():
+            for child_name, child in module.named_children():
+                if isinstance(child, nn.MultiheadAttention):
+                    setattr(module, child_name, SplitMultiheadAttention.from_float(child))
+    qconfig_spec = {name: torch.quantization.default_dynamic_qconfig for name in QUANTIZED_MODULES}
+    return torch.quantization.quantize_dynamic(model, qconfig_spec, dtype=torch.qint8, inplace=True)
@@ -3,7 +3,6 @@ import torch
 import utils.rotation_conversions as geometry
 
 
-from model.smpl import SMPL, JOINTSTYPE_ROOT
 # from .get_model import JOINTSTYPES
 JOINTSTYPES = ["a2m", "a2mpl", "smpl", "vibe", "vertices"]
 
@@ -12,7 +11,38 @@ class Rotation2xyz:
     def __init__(self, device, dataset='amass'):
         self.device = device
         self.dataset = dataset
-        self.smpl_model = SMPL().eval().to(device)
+        # SMPL (smplx, the body model and the joint regressors) is only needed for the rotation
+        # representations, it is loaded on the first access to smpl_model
+        self._smpl_model = None
+        # the device and dtype that the fns applied to the owning model before (e.g. .to(device),
+        # .half()) would give SMPL, tracked on a one-element tensor instead of keeping the fns
+        self._pending_probe = None
+        self._training = False
+
+    @property
+    def smpl_model(self):
+        if self._smpl_model is None:
+            from model.smpl import SMPL
+            smpl_model = SMPL().eval().to(self.device)
+            if self._pending_probe is not None:
+                smpl_model.to(device=self._pending_probe.device, dtype=self._pending_probe.dtype)
+            self._smpl_model = smpl_model.train(self._training)
+            self._pending_probe = None
+        return self._smpl_model
+
+    def _apply(self, fn):
+        if self._smpl_model is None:
+            if self._pending_probe is None:
+                self._pending_probe = torch.zeros(1, device=self.device)
+            self._pending_probe = fn(self._pending_probe)
+        else:
+            self._smpl_model._apply(fn)
+
+    def train(self, mode=True):
+        if self._smpl_model is None:
+            self._training = mode
+        else:
+            self._smpl_model.train(mode)
 
     def __call__(self, x, mask, pose_rep, translation, glob,
                  jointstype, vertstrans, betas=None, beta=0,
@@ -76,6 +106,7 @@ class Rotation2xyz:
 
         # the first translation root at the origin on the prediction
         if jointstype != "vertices":
+            from model.smpl import JOINTSTYPE_ROOT
             rootindex = JOINTSTYPE_ROOT[jointstype]
             x_xyz = x_xyz - x_xyz[:, [rootindex], :, :]
 
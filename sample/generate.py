@@ -4,13 +4,17 @@ Generate a large batch of image samples from a model and save them as a large
 numpy array. This can be used to produce samples for FID evaluation.
 """
 from utils.fixseed import fixseed
+import contextlib
 import os
 import numpy as np
 import torch
 from utils.parser_util import generate_args
-from utils.model_util import create_model_and_diffusion, load_model_wo_clip
+from utils.model_util import load_model_and_diffusion, get_sample_fn
+from utils.long_motion import sample_long_motion
 from utils import dist_util
 from model.cfg_sampler import ClassifierFreeSampleModel
+from diffusion import logger
+from diffusion.profiler import SamplingProfiler
 from data_loaders.get_data import get_dataset_loader
 from data_loaders.humanml.scripts.motion_process import recover_from_ric
 import data_loaders.humanml.utils.paramUtil as paramUtil
@@ -26,11 +30,14 @@ def main():
     fixseed(args.seed)
     out_path = args.output_dir
     name = os.path.basename(os.path.dirname(args.model_path))
-    niter = os.path.basename(args.model_path).replace('model', '').replace('.pt', '')
+    niter = os.path.splitext(os.path.basename(args.model_path))[0].replace('model', '')
     max_frames = 196 if args.dataset in ['kit', 'humanml'] else 60
     fps = 12.5 if args.dataset == 'kit' else 20
     n_frames = min(max_frames, int(args.motion_length*fps))
+    motion_frames = n_frames
     n_frames = 196
+    # longer motions are sampled with overlapping windows of n_frames frames
+    long_frames = int(args.motion_length*fps) if args.text_prompt not in ['', 'predefined'] else 0
     is_using_data = not any([args.text_prompt])
     dist_util.setup_dist(args.device)
     if out_path == '':
@@ -60,9 +67,13 @@ def main():
     if args.control_path:
         loaded = np.load(args.control_path, allow_pickle=True).item()
         hints  = loaded['pos'][None, ...]          # (1, T, 22*3)
+        long_frames = hints.shape[1]
         args.num_samples = 1
         texts  = [''] if args.cond_mode == 'only_spatial' else [args.text_prompt]
 
+    if long_frames <= n_frames:
+        long_frames = 0
+
     assert args.num_samples <= args.batch_size, \
         f'Please either increase batch_size({args.batch_size}) or reduce num_samples({args.num_samples})'
     # So why do we need this check? In order to protect GPU from a memory overload in the following line.
@@ -76,14 +87,12 @@ def main():
     total_num_samples = args.num_samples * args.num_repetitions
 
     print("Creating model and diffusion...")
-    model, diffusion = create_model_and_diffusion(args, data)
-
     print(f"Loading checkpoints from [{args.model_path}]...")
-    state_dict = torch.load(args.model_path, map_location='cpu')
-    load_model_wo_clip(model, state_dict)
+    model, diffusion = load_model_and_diffusion(args, data)
 
     if args.guidance_param != 1:
-        model = ClassifierFreeSampleModel(model)   # wrapping model with the classifier-free sampler
+        model = ClassifierFreeSampleModel(model, fused=args.fused_cfg, guidance_interval=args.guidance_interval,
+                                          guidance_schedule=args.guidance_schedule)   # wrapping model with the classifier-free sampler
     model.to(dist_util.dev())
     model.eval()  # disable random masking
 
@@ -91,7 +100,10 @@ def main():
         iterator = iter(data)
         _, model_kwargs = next(iterator)
     else:
-        collate_args = [{'inp': torch.zeros(n_frames), 'tokens': None, 'lengths': n_frames}] * args.num_samples
+        # with length buckets, text prompts are sampled with --motion_length frames only,
+        # the predefined and loaded hints are laid out on all the frames
+        length = motion_frames if args.length_bucket_size > 0 and hints is None else n_frames
+        collate_args = [{'inp': torch.zeros(n_frames), 'tokens': None, 'lengths': length}] * args.num_samples
         # t2m
         collate_args = [dict(arg, text=txt) for arg, txt in zip(collate_args, texts)]
         if hints is not None:
@@ -108,6 +120,7 @@ def main():
     all_text = []
     all_hint = []
     all_hint_for_vis = []
+    profiler = SamplingProfiler(trace=True, sync_cuda=args.profile_sync_cuda) if args.profile else None
 
     for rep_i in range(args.num_repetitions):
         print(f'### Sampling [repetitions #{rep_i}]')
@@ -116,20 +129,34 @@ def main():
         if args.guidance_param != 1:
             model_kwargs['y']['scale'] = torch.ones(args.batch_size, device=dist_util.dev()) * args.guidance_param
 
-        sample_fn = diffusion.p_sample_loop
-
-        sample = sample_fn(
-            model,
-            (args.batch_size, model.njoints, model.nfeats, n_frames),
-            clip_denoised=False,
-            model_kwargs=model_kwargs,
-            skip_timesteps=0,  # 0 is the default value - i.e. don't skip any step
-            init_image=None,
-            progress=True,
-            dump_steps=None,
-            noise=None,
-            const_noise=False,
-        )
+        sample_fn = get_sample_fn(args, diffusion)
+
+        with profiler if profiler is not None else contextlib.nullcontext():
+            if long_frames:
+                sample = sample_long_motion(
+                    diffusion,
+                    sample_fn,
+                    model,
+                    (args.batch_size, model.njoints, model.nfeats, long_frames),
+                    model_kwargs,
+                    window=n_frames,
+                    overlap=args.window_overlap,
+                    clip_denoised=False,
+                    progress=True,
+                )
+            else:
+                sample = sample_fn(
+                    model,
+                    (args.batch_size, model.njoints, model.nfeats, n_frames),
+                    clip_denoised=False,
+                    model_kwargs=model_kwargs,
+                    skip_timesteps=0,  # 0 is the default value - i.e. don't skip any step
+                    init_image=None,
+                    progress=True,
+                    dump_steps=None,
+                    noise=None,
+                    const_noise=False,
+                )
 
         sample = sample[:, :263]
         # Recover XYZ *positions* from HumanML3D vector representation
@@ -172,10 +199,15 @@ def main():
                 all_hint_for_vis.append(hint.data.cpu().numpy())
 
         all_motions.append(sample.cpu().numpy())
-        all_lengths.append(model_kwargs['y']['lengths'].cpu().numpy())
+        if long_frames:
+            all_lengths.append(np.full(args.batch_size, long_frames))
+        else:
+            all_lengths.append(model_kwargs['y']['lengths'].cpu().numpy())
 
         print(f"created {len(all_motions) * args.batch_size} samples")
 
+    if args.guidance_param != 1:
+        print(f'CFG forward passes: {model.n_cond_passes} conditional, {model.n_uncond_passes} unconditional')
 
     all_motions = np.concatenate(all_motions, axis=0)
     all_motions = all_motions[:total_num_samples]  # [bs, njoints, 6, seqlen]
@@ -194,6 +226,16 @@ def main():
         shutil.rmtree(out_path)
     os.makedirs(out_path)
 
+    if profiler is not None:
+        logger.configure(dir=out_path, format_strs=['csv'])
+        profiler.logkvs()
+        profiler.save_trace(os.path.join(out_path, 'sampling_trace.json'))
+        summary = profiler.summary()
+        print(f"sampling: {summary['time_total']:.2f}s over {summary['n_steps']} steps, "
+              + ', '.join(f"{key[len('time_'):]} {value:.2f}s" for key, value in summary.items()
+                          if key.startswith('time_') and key != 'time_total'))
+        print(f"saving the sampling timings to [{os.path.join(out_path, 'progress.csv')}]")
+
     npy_path = os.path.join(out_path, 'results.npy')
     print(f"saving results file to [{npy_path}]")
     np.save(npy_path,
@@ -0,0 +1,105 @@
+"""
+Numeric drift of a reduced --precision (bf16 / fp16 autocast of the model) from fp32.
+
+Samples the same batch twice, with the same seed and the same initial noise, once in fp32 and once
+in --precision, and reports the distance between the two and their control errors. Half of the batch
+is text-only, the other half follows a pelvis trajectory. No dataset is loaded:
+    python -m sample.precision_drift --model_path ./save/omnicontrol_ckpt/model_humanml3d.pt --precision bf16 --sampler ddim --sample_steps 50
+"""
+import time
+import types
+
+import numpy as np
+import torch
+from utils.fixseed import fixseed
+from utils.parser_util import generate_args
+from utils.model_util import load_model_and_diffusion, get_sample_fn
+from utils import dist_util
+from model.cfg_sampler import ClassifierFreeSampleModel
+from data_loaders.tensors import collate
+from data_loaders.humanml.scripts.motion_process import recover_from_ric
+
+PROMPTS = ['a person walks forward.', 'a person jumps up and down.', 'a person waves with the right hand.',
+           'a person walks in a circle.', 'a person kicks with the left leg.', 'a person sits down.']
+
+
+def trajectory_hint(n_frames, n_joints, fps):
+    # [n_frames, n_joints, 3] global positions, the pelvis walking forward, hinted every 10th frame
+    hint = np.zeros((n_frames, n_joints, 3), dtype=np.float32)
+    frames = np.arange(0, n_frames, 10)
+    hint[frames, 0, 1] = 0.95
+    hint[frames, 0, 2] = 1.2 * frames / fps
+    return hint
+
+
+def main():
+    args = generate_args()
+    assert args.precision != 'fp32', 'choose the --precision to compare with fp32'
+    dist_util.setup_dist(args.device)
+    fps = 12.5 if args.dataset == 'kit' else 20
+    n_frames = 196
+
+    print("Creating model and diffusion...")
+    data = types.SimpleNamespace(dataset=None)
+    print(f"Loading checkpoints from [{args.model_path}]...")
+    model, diffusion = load_model_and_diffusion(args, data)
+    cmdm = model
+
+    if args.guidance_param != 1:
+        model = ClassifierFreeSampleModel(model, fused=args.fused_cfg, guidance_interval=args.guidance_interval,
+                                          guidance_schedule=args.guidance_schedule)   # wrapping model with the classifier-free sampler
+    model.to(dist_util.dev())
+    model.eval()  # disable random masking
+
+    n_joints = 22 if cmdm.njoints == 263 else 21
+    raw_mean = diffusion.raw_mean.cpu().numpy().reshape(n_joints, 3)
+    raw_std = diffusion.raw_std.cpu().numpy().reshape(n_joints, 3)
+    global_hint = trajectory_hint(n_frames, n_joints, fps)
+    mask = global_hint.sum(-1, keepdims=True) != 0
+    hint = ((global_hint - raw_mean) / raw_std * mask).reshape(n_frames, -1)
+
+    prompts = [args.text_prompt] * args.num_samples if args.text_prompt else \
+        [PROMPTS[i % len(PROMPTS)] for i in range(args.num_samples)]
+    collate_args = [{'inp': torch.zeros(n_frames), 'tokens': None, 'lengths': n_frames, 'text': text,
+                     'hint': hint if i >= len(prompts) // 2 else np.zeros_like(hint)}
+                    for i, text in enumerate(prompts)]
+    _, model_kwargs = collate(collate_args)
+    model_kwargs['y'] = {k: v.to(dist_util.dev()) if torch.is_tensor(v) else v for k, v in model_kwargs['y'].items()}
+    if args.guidance_param != 1:
+        model_kwargs['y']['scale'] = torch.ones(args.num_samples, device=dist_util.dev()) * args.guidance_param
+    shape = (args.num_samples, cmdm.njoints, cmdm.nfeats, n_frames)
+    sample_fn = get_sample_fn(args, diffusion)
+
+    joints, times = {}, {}
+    for precision in ['fp32', args.precision]:
+        cmdm.precision = precision
+        cmdm.text_embed_cache.clear()
+        cmdm.embed_timestep.embed_table_key = cmdm.c_embed_timestep.embed_table_key = None
+        fixseed(args.seed)
+        noise = torch.randn(*shape, device=dist_util.dev())
+        start = time.time()
+        sample = sample_fn(model, shape, noise=noise, clip_denoised=False, model_kwargs=model_kwargs,
+                           progress=False)
+        times[precision] = time.time() - start
+        sample = sample.squeeze(2).permute(0, 2, 1) * diffusion.std.to(sample.device) + diffusion.mean.to(sample.device)
+        joints[precision] = recover_from_ric(sample.float(), n_joints).cpu()
+
+    drift = (joints[args.precision] - joints['fp32']).norm(dim=-1)  # [bs, n_frames, n_joints]
+    hinted = torch.arange(args.num_samples) >= len(prompts) // 2
+    target = torch.from_numpy(global_hint)[mask[..., 0]]
+    print(f'{args.sampler}, {diffusion.num_timesteps} steps, guide preset {args.guide_preset}, '
+          f'batch of {args.num_samples}, seed {args.seed}')
+    for name, idx in [('text only', ~hinted), ('with control', hinted)]:
+        if idx.any():
+            print(f'{name:>12}: joint drift from fp32 mean {drift[idx].mean() * 1000:.2f} mm, '
+                  f'max {drift[idx].max() * 1000:.2f} mm')
+    if hinted.any():
+        for precision in ['fp32', args.precision]:
+            control_error = (joints[precision][hinted][:, torch.from_numpy(mask[..., 0])] - target).norm(dim=-1)
+            print(f'{precision:>12}: control error {control_error.mean() * 1000:.2f} mm')
+    for precision in ['fp32', args.precision]:
+        print(f'{precision:>12}: {times[precision]:.2f}s')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,346 @@
+"""
+A long-lived inference server, the model and the diffusion are loaded once and the
+concurrent requests are sampled together.
+
+    python -m sample.server --model_path ./save/omnicontrol_ckpt/model_humanml3d.pt --port 8000
+
+    curl -X POST localhost:8000/generate -d '{"text": "a person walks", "length": 120}'
+
+A request is a JSON object with
+    text: the text prompt.
+    hint: (optional) [n_frames][n_joints][3] global joint positions in meters, all zeros
+          for the joints and frames that are not controlled (as in utils/text_control_example.py).
+    length: (optional) the number of frames, defaults to the length of the hint, or 196.
+    guidance_param: (optional) the classifier-free guidance scale of this request.
+    deadline_ms: (optional, with --deadline_aware) the latency budget of this request [in ms].
+The response holds the joint positions, [length][n_joints][3]. With --profile, it also holds the
+timings of the sampling stages of its batch (see diffusion/profiler.py), with --continuous_batching
+the sums over the batch steps the request took part in.
+"""
+import asyncio
+import json
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from utils.fixseed import fixseed
+from utils.parser_util import server_args
+from utils.model_util import load_model_and_diffusion, get_sample_fn
+from utils import dist_util
+from model.cfg_sampler import ClassifierFreeSampleModel
+from diffusion.continuous_batching import ContinuousBatchSampler
+from diffusion.gaussian_diffusion import CancellationToken
+from diffusion.profiler import SamplingProfiler
+from utils.deadline import SamplingCostModel, DeadlineSampler
+from data_loaders.tensors import collate
+from data_loaders.humanml.scripts.motion_process import recover_from_ric
+
+
+class BatchedSampler:
+    """
+    Coalesces the requests submitted concurrently into sampling batches.
+
+    The first request of a batch waits up to max_wait seconds for others to join, and a batch
+    holds at most max_batch_size requests. The sampling runs in a worker thread, meanwhile the
+    next requests queue up and are sampled in the following batch.
+
+    With continuous=True, the requests join and leave the batch at every denoising step
+    instead (see ContinuousBatchSampler), and max_wait is not used.
+
+    With a DeadlineSampler, each batch is sampled with the best configuration (sampler, number of
+    steps and guidance schedule) that fits the tightest latency budget of its requests.
+    """
+
+    def __init__(self, args, model, diffusion, max_batch_size=32, max_wait=0.02, n_frames=196, continuous=False,
+                 deadline_sampler=None):
+        self.args = args
+        self.model = model
+        self.diffusion = diffusion
+        self.sample_fn = get_sample_fn(args, diffusion)
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.n_frames = n_frames
+        self.n_joints = 22 if model.njoints == 263 else 21
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.queue = None
+        self.worker = None
+        self.scheduler = None
+        self.deadline_sampler = deadline_sampler
+        if continuous:
+            self.scheduler = ContinuousBatchSampler(diffusion, model, max_batch_size=max_batch_size,
+                                                    sampler=args.sampler, eta=args.ddim_eta)
+
+    def start(self):
+        # must be called from the event loop
+        self.queue = asyncio.Queue()
+        self.worker = asyncio.ensure_future(self.run_continuous() if self.scheduler is not None else self.run())
+
+    async def submit(self, text, hint=None, length=None, guidance_param=None, deadline_ms=None):
+        """
+        Queue a request and wait for its result, see the module docstring for the arguments.
+        Raises ValueError if the request is invalid.
+        """
+        if hint is not None:
+            hint = np.asarray(hint, dtype=np.float32)
+            if hint.ndim != 3 or hint.shape[1:] != (self.n_joints, 3) or len(hint) > self.n_frames:
+                raise ValueError(f'hint must be [n_frames <= {self.n_frames}][{self.n_joints}][3]')
+        if length is None:
+            length = self.n_frames if hint is None else len(hint)
+        length = int(length)
+        if not 0 < length <= self.n_frames:
+            raise ValueError(f'length must be in [1, {self.n_frames}]')
+        request = {'text': str(text), 'hint': hint, 'length': length, 'guidance_param': guidance_param,
+                   'deadline': None if deadline_ms is None else time.time() + float(deadline_ms) / 1000,
+                   'future': asyncio.get_event_loop().create_future()}
+        await self.queue.put(request)
+        return await request['future']
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    # past the wait, only the requests already queued join the batch
+                    # (wait_for times out with a zero timeout even if the queue is not empty)
+                    try:
+                        batch.append(self.queue.get_nowait())
+                    except asyncio.QueueEmpty:
+                        break
+                    continue
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                results = await loop.run_in_executor(self.executor, self.sample_batch, batch)
+            except Exception as e:
+                for request in batch:
+                    if not request['future'].done():  # the client may have disconnected
+                        request['future'].set_exception(e)
+                continue
+            for request, result in zip(batch, results):
+                if not request['future'].done():
+                    request['future'].set_result(result)
+
+    async def run_continuous(self):
+        loop = asyncio.get_event_loop()
+        requests = {}
+        while True:
+            if len(self.scheduler) == 0:
+                request = await self.queue.get()
+                requests[self.submit_continuous(request)] = request
+            while not self.queue.empty():
+                request = self.queue.get_nowait()
+                requests[self.submit_continuous(request)] = request
+            try:
+                finished, timings = await loop.run_in_executor(self.executor, self.step_continuous)
+            except Exception as e:
+                for request in requests.values():
+                    if not request['future'].done():  # the client may have disconnected
+                        request['future'].set_exception(e)
+                self.scheduler = ContinuousBatchSampler(self.diffusion, self.model, max_batch_size=self.max_batch_size,
+                                                        sampler=self.args.sampler, eta=self.args.ddim_eta)
+                requests = {}
+                continue
+            if timings is not None:
+                # the timings of the batch steps each request took part in
+                for sample_id in [s['id'] for s in self.scheduler.active] + list(finished):
+                    request_timings = requests[sample_id].setdefault('timings', {})
+                    for key, value in timings.items():
+                        request_timings[key] = request_timings.get(key, 0) + value
+            for sample_id, sample in finished.items():
+                request = requests.pop(sample_id)
+                result = self.decode([request], sample, time.time() - request['submit_time'])[0]
+                del result['batch_size']  # the batch changed at every step
+                if 'timings' in request:
+                    result['timings'] = request['timings']
+                if not request['future'].done():
+                    request['future'].set_result(result)
+
+    def step_continuous(self):
+        # one step of the continuous batch, and its timings with --profile
+        if not self.args.profile:
+            return self.scheduler.step(), None
+        profiler = SamplingProfiler(sync_cuda=self.args.profile_sync_cuda)
+        with profiler:
+            finished = self.scheduler.step()
+        return finished, profiler.summary()
+
+    def submit_continuous(self, request):
+        request['submit_time'] = time.time()
+        y = self.collate_y([request])
+        return self.scheduler.submit(y, (1, self.model.njoints, self.model.nfeats, self.n_frames))
+
+    def collate_y(self, batch):
+        collate_args = [{'inp': torch.zeros(self.n_frames), 'tokens': None, 'lengths': r['length'], 'text': r['text']}
+                        for r in batch]
+        if any(r['hint'] is not None for r in batch):
+            collate_args = [dict(arg, hint=self.normalize_hint(r['hint'])) for arg, r in zip(collate_args, batch)]
+        _, model_kwargs = collate(collate_args)
+        for k, v in model_kwargs['y'].items():
+            if torch.is_tensor(v):
+                model_kwargs['y'][k] = v.to(dist_util.dev())
+        if self.args.guidance_param != 1:
+            scale = [self.args.guidance_param if r['guidance_param'] is None else float(r['guidance_param'])
+                     for r in batch]
+            model_kwargs['y']['scale'] = torch.tensor(scale, device=dist_util.dev())
+        return model_kwargs['y']
+
+    def sample_batch(self, batch):
+        if not self.args.profile:
+            return self._sample_batch(batch)
+        # with --deadline_aware too, the chosen configuration is sampled in this thread
+        profiler = SamplingProfiler(sync_cuda=self.args.profile_sync_cuda)
+        with profiler:
+            results = self._sample_batch(batch)
+        for result in results:
+            result['timings'] = profiler.summary()
+        return results
+
+    def _sample_batch(self, batch):
+        start_time = time.time()
+        bs = len(batch)
+        model_kwargs = {'y': self.collate_y(batch)}
+        shape = (bs, self.model.njoints, self.model.nfeats, self.n_frames)
+
+        if self.deadline_sampler is not None:
+            deadlines = [r['deadline'] for r in batch if r['deadline'] is not None]
+            budget = min(deadlines) - time.time() if len(deadlines) > 0 else None
+            kwargs = {}
+            if budget is not None and self.args.length_bucket_size == 0:
+                # if the estimate was off, stop at the deadline with the current x0 estimate
+                kwargs['cancel'] = CancellationToken(timeout=max(budget, 0))
+            sample, config = self.deadline_sampler.sample(shape, model_kwargs, budget=budget, clip_denoised=False,
+                                                          **kwargs)
+            results = self.decode(batch, sample, time.time() - start_time)
+            for result in results:
+                result['config'] = config
+            return results
+
+        sample = self.sample_fn(
+            self.model,
+            shape,
+            clip_denoised=False,
+            model_kwargs=model_kwargs,
+            skip_timesteps=0,
+            init_image=None,
+            progress=False,
+            dump_steps=None,
+            noise=None,
+            const_noise=False,
+        )
+
+        return self.decode(batch, sample, time.time() - start_time)
+
+    def decode(self, batch, sample, elapsed):
+        # the responses to the requests of batch, from their samples
+        mean, std = self.diffusion.mean.to(sample.device), self.diffusion.std.to(sample.device)
+        sample = sample.squeeze(2).permute(0, 2, 1) * std + mean
+        joints = recover_from_ric(sample, self.n_joints).cpu().numpy()
+        return [{'joints': joints[i, :r['length']].tolist(), 'length': r['length'], 'batch_size': len(batch),
+                 'sampling_time': elapsed} for i, r in enumerate(batch)]
+
+    def normalize_hint(self, hint):
+        # [n_frames x n_joints*3], normalized as the dataset hints, zeros for no hint
+        control = np.zeros((self.n_frames, self.n_joints, 3), dtype=np.float32)
+        if hint is not None:
+            raw_mean = self.diffusion.raw_mean.cpu().numpy().reshape(self.n_joints, 3)
+            raw_std = self.diffusion.raw_std.cpu().numpy().reshape(self.n_joints, 3)
+            mask = hint.sum(-1, keepdims=True) != 0
+            control[:len(hint)] = (hint - raw_mean) / raw_std * mask
+        return control.reshape(self.n_frames, -1)
+
+
+async def handle_connection(sampler, reader, writer):
+    status, response = 200, {}
+    try:
+        method, path, _ = (await reader.readline()).decode().split(' ', 2)
+        content_length = 0
+        while True:
+            line = (await reader.readline()).decode().strip()
+            if not line:
+                break
+            key, value = line.split(':', 1)
+            if key.strip().lower() == 'content-length':
+                content_length = int(value)
+        body = await reader.readexactly(content_length) if content_length > 0 else b''
+
+        if method == 'GET' and path == '/health':
+            response = {'status': 'ok'}
+        elif method == 'POST' and path == '/generate':
+            request = json.loads(body.decode() or '{}')
+            response = await sampler.submit(request.get('text', ''), hint=request.get('hint'),
+                                            length=request.get('length'),
+                                            guidance_param=request.get('guidance_param'),
+                                            deadline_ms=request.get('deadline_ms'))
+        else:
+            status, response = 404, {'error': f'unknown endpoint: {method} {path}'}
+    except (ValueError, KeyError) as e:
+        status, response = 400, {'error': str(e)}
+    except Exception as e:
+        status, response = 500, {'error': repr(e)}
+
+    payload = json.dumps(response).encode()
+    reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}[status]
+    writer.write(f'HTTP/1.1 {status} {reason}\r\nContent-Type: application/json\r\n'
+                 f'Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n'.encode() + payload)
+    try:
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def serve(sampler, host='127.0.0.1', port=8000, socket=''):
+    sampler.start()
+    handler = lambda reader, writer: handle_connection(sampler, reader, writer)
+    if socket:
+        server = await asyncio.start_unix_server(handler, path=socket)
+        print(f'Listening on [{socket}]')
+    else:
+        server = await asyncio.start_server(handler, host=host, port=port)
+        print(f'Listening on [{host}:{port}]')
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    args = server_args()
+    fixseed(args.seed)
+    dist_util.setup_dist(args.device)
+
+    print("Creating model and diffusion...")
+    # the text and hints come with the requests, no dataset is loaded
+    data = types.SimpleNamespace(dataset=None)
+    print(f"Loading checkpoints from [{args.model_path}]...")
+    model, diffusion = load_model_and_diffusion(args, data)
+
+    if args.guidance_param != 1:
+        model = ClassifierFreeSampleModel(model, fused=args.fused_cfg, guidance_interval=args.guidance_interval,
+                                          guidance_schedule=args.guidance_schedule)   # wrapping model with the classifier-free sampler
+    model.to(dist_util.dev())
+    model.eval()  # disable random masking
+
+    deadline_sampler = None
+    if args.deadline_aware:
+        print("Measuring the sampling costs...")
+        cost_model = SamplingCostModel.measure(model, diffusion)
+        print(f'denoising step: {cost_model.step_time[0]:.4f}s + {cost_model.step_time[1]:.4f}s/sample '
+              f'({cost_model.cond_step_time[0]:.4f}s + {cost_model.cond_step_time[1]:.4f}s/sample outside of '
+              f'the CFG interval), '
+              f'guidance iteration: {cost_model.guide_time[0]:.4f}s + {cost_model.guide_time[1]:.4f}s/sample')
+        deadline_sampler = DeadlineSampler(args, model, cost_model)
+
+    sampler = BatchedSampler(args, model, diffusion, max_batch_size=args.max_batch_size,
+                             max_wait=args.max_wait_ms / 1000, continuous=args.continuous_batching,
+                             deadline_sampler=deadline_sampler)
+    asyncio.run(serve(sampler, args.host, args.port, args.socket))
+
+
+if __name__ == "__main__":
+    main()
@@ -158,6 +158,8 @@ class TrainLoop:
             micro_cond = cond
             last_batch = (i + self.microbatch) >= batch.shape[0]
             t, weights = self.schedule_sampler.sample(micro.shape[0], dist_util.dev())
+            # encode the text once for both the control and the main branch
+            self.model.cache_text_embedding(micro_cond['y'])
 
             compute_losses = functools.partial(
                 self.diffusion.training_losses,
@@ -0,0 +1,208 @@
+import json
+import time
+from argparse import Namespace
+
+import torch
+
+from diffusion.guidance import GuidanceSchedule
+from utils.model_util import create_gaussian_diffusion, get_sample_fn
+
+
+# the sampling configurations, from the best quality to the fastest
+SAMPLING_CONFIGS = [
+    dict(sampler='ddpm', sample_steps=0, guide_preset='default'),
+    dict(sampler='ddim', sample_steps=100, guide_preset='default'),
+    dict(sampler='ddim', sample_steps=50, guide_preset='converge'),
+    dict(sampler='dpmsolver', sample_steps=20, guide_preset='converge'),
+    dict(sampler='dpmsolver', sample_steps=10, guide_preset='fast'),
+    dict(sampler='dpmsolver', sample_steps=10, guide_preset='none'),
+]
+
+
+class SamplingCostModel:
+    """
+    The time of a denoising step (the model forward passes, classifier-free guidance included) and
+    of a spatial guidance iteration, each modeled as fixed + per_sample * batch_size seconds.
+
+    :param step_time: (fixed, per_sample) of a denoising step.
+    :param guide_time: (fixed, per_sample) of a guidance iteration.
+    :param cond_step_time: (fixed, per_sample) of a denoising step outside of the classifier-free
+                           guidance interval, with the conditional pass only. Defaults to step_time.
+    """
+
+    def __init__(self, step_time, guide_time, cond_step_time=None):
+        self.step_time = tuple(step_time)
+        self.guide_time = tuple(guide_time)
+        self.cond_step_time = self.step_time if cond_step_time is None else tuple(cond_step_time)
+
+    @classmethod
+    def measure(cls, model, diffusion, n_frames=196, batch_sizes=(1, 8), n_repeats=3):
+        """
+        Time the model and the guidance on random inputs, for each batch size in batch_sizes,
+        and fit the linear costs. With a ClassifierFreeSampleModel, the denoising step is timed with
+        and without the unconditional pass.
+        """
+        device = next(model.parameters()).device
+        n_joints = 22 if model.njoints == 263 else 21
+        guide_schedule = GuidanceSchedule(n_steps=n_repeats, n_steps_tail=n_repeats)
+        cfg = hasattr(model, 'guidance_weight')
+        if cfg:
+            # the calibration passes are not counted in the pass counts of the model
+            pass_counts = model.n_cond_passes, model.n_uncond_passes
+            # a timestep inside the guidance interval, where the unconditional pass runs
+            cfg_steps = guided_steps(model, diffusion)
+            t_cfg = cfg_steps[len(cfg_steps) // 2] if len(cfg_steps) > 0 else diffusion.num_timesteps // 2
+        step_times, cond_step_times, guide_times = [], [], []
+        for bs in batch_sizes:
+            x = torch.randn(bs, model.njoints, model.nfeats, n_frames, device=device)
+            t = torch.full((bs,), t_cfg if cfg else diffusion.num_timesteps // 2, dtype=torch.long, device=device)
+            hint = torch.zeros(bs, n_frames, n_joints, 3, device=device)
+            hint[:, ::20, 0] = torch.randn_like(hint[:, ::20, 0])
+            y = {'text': ['a person walks'] * bs, 'lengths': torch.full((bs,), n_frames, device=device),
+                 'mask': torch.ones(bs, 1, 1, n_frames, dtype=torch.bool, device=device),
+                 'scale': torch.full((bs,), 2.5, device=device), 'hint': hint.view(bs, n_frames, -1)}
+            step_times.append(_time_step(diffusion, model, x, t, y, n_repeats))
+            # the conditional pass alone, as outside of the guidance interval
+            cond_step_times.append(_time_step(diffusion, model.model, x, t, y, n_repeats) if cfg else step_times[-1])
+            diffusion.guide(x, t, model_kwargs={'y': y}, schedule=guide_schedule)  # warm up
+            _sync(device)
+            start = time.time()
+            diffusion.guide(x, t, model_kwargs={'y': y}, schedule=guide_schedule)
+            _sync(device)
+            guide_times.append((time.time() - start) / n_repeats)
+        if cfg:
+            model.n_cond_passes, model.n_uncond_passes = pass_counts
+        return cls(_fit_linear(batch_sizes, step_times), _fit_linear(batch_sizes, guide_times),
+                   _fit_linear(batch_sizes, cond_step_times))
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as fr:
+            return cls(**json.load(fr))
+
+    def save(self, path):
+        with open(path, 'w') as fw:
+            json.dump({'step_time': self.step_time, 'guide_time': self.guide_time,
+                       'cond_step_time': self.cond_step_time}, fw, indent=4)
+
+    def estimate(self, diffusion, batch_size, hinted=True, root_only=False, n_cfg_steps=None):
+        """
+        The estimated sampling time [in seconds] with diffusion (its number of steps and guidance schedule).
+        The guidance is assumed to run all its iterations, early stopping only makes it faster.
+
+        :param n_cfg_steps: the number of steps inside the classifier-free guidance interval (see
+                            guided_steps()), the other steps cost cond_step_time. Defaults to all the steps.
+        """
+        n_steps = diffusion.num_timesteps
+        if n_cfg_steps is None:
+            n_cfg_steps = n_steps
+        total = n_cfg_steps * (self.step_time[0] + self.step_time[1] * batch_size) + \
+            (n_steps - n_cfg_steps) * (self.cond_step_time[0] + self.cond_step_time[1] * batch_size)
+        if hinted:
+            n_iterations = 0
+            for t in diffusion.original_timesteps(torch.arange(n_steps)).tolist():
+                n_guide_steps, _, root_projection = diffusion.guide_schedule.config_at(t)
+                n_iterations += 1 if root_projection and root_only and n_guide_steps > 0 else n_guide_steps
+            total += n_iterations * (self.guide_time[0] + self.guide_time[1] * batch_size)
+        return total
+
+
+class DeadlineSampler:
+    """
+    Picks, per batch, the best sampling configuration that fits a latency budget according
+    to a SamplingCostModel, and samples with it.
+
+    :param args: the sampling arguments, the configurations override sampler, sample_steps and guide_preset.
+    :param model: the model to sample from.
+    :param cost_model: a SamplingCostModel.
+    :param configs: the candidate configurations, from the best quality to the fastest.
+    """
+
+    def __init__(self, args, model, cost_model, configs=SAMPLING_CONFIGS):
+        self.args = args
+        self.model = model
+        self.cost_model = cost_model
+        self.configs = configs
+        self.diffusions = {}
+
+    def diffusion(self, config):
+        key = tuple(sorted(config.items()))
+        if key not in self.diffusions:
+            self.diffusions[key] = create_gaussian_diffusion(Namespace(**dict(vars(self.args), **config)))
+        return self.diffusions[key]
+
+    def choose(self, budget, batch_size, hinted=True, root_only=False):
+        """
+        :param budget: the latency budget [in seconds], None for the best quality.
+        :return: (the configuration, its estimated time), the fastest configuration if none fits.
+        """
+        for config in self.configs:
+            diffusion = self.diffusion(config)
+            n_cfg_steps = len(guided_steps(self.model, diffusion)) if hasattr(self.model, 'guidance_weight') else None
+            estimate = self.cost_model.estimate(diffusion, batch_size, hinted, root_only, n_cfg_steps)
+            if budget is None or estimate <= budget:
+                return config, estimate
+        return config, estimate
+
+    def sample(self, shape, model_kwargs, budget=None, **kwargs):
+        """
+        Sample with the best configuration that fits the budget.
+
+        :param kwargs: the other arguments of the sampling loop, e.g. a CancellationToken as cancel.
+        :return: (the samples, a dict with the chosen configuration, the estimated and the actual time,
+                 whether the estimate fit the budget, and with cancel, the number of steps taken).
+        """
+        start = time.time()
+        hint = model_kwargs['y'].get('hint')
+        hinted, root_only = hint is not None, False
+        if hinted:
+            mask = hint.view(hint.shape[0], hint.shape[1], -1, 3).sum(dim=-1) != 0
+            hinted, root_only = bool(mask.any()), bool(mask.any()) and not mask[..., 1:].any()
+        config, estimate = self.choose(budget, shape[0], hinted, root_only)
+        args = Namespace(**dict(vars(self.args), **config))
+        sample_fn = get_sample_fn(args, self.diffusion(config))
+        sample = sample_fn(self.model, shape, model_kwargs=model_kwargs, **kwargs)
+        metadata = dict(config, budget=budget, estimated_time=estimate, fits_budget=budget is None or estimate <= budget)
+        if isinstance(sample, dict):
+            # sampled with a CancellationToken
+            metadata.update(step=sample['step'], n_steps=sample['n_steps'], cancelled=sample['cancelled'])
+            sample = sample['sample']
+        metadata['sampling_time'] = time.time() - start
+        return sample, metadata
+
+
+def guided_steps(model, diffusion):
+    """
+    :param model: a ClassifierFreeSampleModel.
+    :return: the (respaced) timesteps of diffusion at which model runs the unconditional pass.
+    """
+    weight = model.guidance_weight(diffusion.original_timesteps(torch.arange(diffusion.num_timesteps)))
+    return torch.nonzero(weight > 0).squeeze(1).tolist()
+
+
+def _time_step(diffusion, model, x, t, y, n_repeats):
+    device = x.device
+    with torch.no_grad():
+        diffusion.p_mean_variance(model, x, t, clip_denoised=False, model_kwargs={'y': y})  # warm up
+        _sync(device)
+        start = time.time()
+        for _ in range(n_repeats):
+            diffusion.p_mean_variance(model, x, t, clip_denoised=False, model_kwargs={'y': y})
+        _sync(device)
+    return (time.time() - start) / n_repeats
+
+
+def _fit_linear(xs, ys):
+    # least-squares (fixed, slope) of ys = fixed + slope * xs, both non-negative
+    if len(xs) == 1:
+        return 0., ys[0] / xs[0]
+    n = len(xs)
+    mean_x, mean_y = sum(xs) / n, sum(ys) / n
+    var_x = sum((x - mean_x) ** 2 for x in xs)
+    slope = max(sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / var_x, 0.)
+    return max(mean_y - slope * mean_x, 0.), slope
+
+
+def _sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
@@ -0,0 +1,193 @@
+"""
+Flat, memory-mapped checkpoints.
+
+The file layout is the safetensors one: an 8 byte little-endian header size, a json header with
+the dtype, shape and byte range of every tensor, then the raw tensor data. The tensors are
+memory-mapped (copy-on-write) instead of unpickled, so loading does not read the weights,
+and the worker processes of a host that load the same file share its pages.
+
+Export a checkpoint (with --include_clip, the CLIP text tower goes in the file too and
+clip.load is not called at loading):
+    python -m utils.flat_checkpoint --model_path ./save/omnicontrol_ckpt/model_humanml3d.pt --include_clip
+"""
+import contextlib
+import json
+import os
+import struct
+import sys
+from argparse import ArgumentParser
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from model import cmdm
+from model.clip_text import CLIPTextTower, TEXT_TOWER_PREFIXES
+from utils.model_util import get_model_args, create_gaussian_diffusion
+
+
+DTYPES = {torch.float64: 'F64', torch.float32: 'F32', torch.float16: 'F16', torch.int64: 'I64',
+          torch.int32: 'I32', torch.int16: 'I16', torch.int8: 'I8', torch.uint8: 'U8', torch.bool: 'BOOL'}
+NUMPY_DTYPES = {'F64': np.float64, 'F32': np.float32, 'F16': np.float16, 'I64': np.int64, 'I32': np.int32,
+                'I16': np.int16, 'I8': np.int8, 'U8': np.uint8, 'BOOL': np.bool_}
+
+
+def is_flat_checkpoint(path):
+    return path.endswith('.safetensors')
+
+
+def save_flat_checkpoint(state_dict, path, metadata=None):
+    """
+    :param state_dict: a dict from names to tensors.
+    :param metadata: a dict from str to str, stored in the header.
+    """
+    header = {}
+    if metadata is not None:
+        header['__metadata__'] = metadata
+    # the largest items first, so that every tensor starts aligned to its item size
+    names = sorted(state_dict, key=lambda name: -state_dict[name].element_size())
+    offset = 0
+    for name in names:
+        tensor = state_dict[name]
+        if tensor.dtype not in DTYPES:
+            raise ValueError(f'{name}: {tensor.dtype} tensors are not supported')
+        n_bytes = tensor.numel() * tensor.element_size()
+        header[name] = {'dtype': DTYPES[tensor.dtype], 'shape': list(tensor.shape),
+                        'data_offsets': [offset, offset + n_bytes]}
+        offset += n_bytes
+    header = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    header += b' ' * (-len(header) % 8)
+    with open(path, 'wb') as fw:
+        fw.write(struct.pack('<Q', len(header)))
+        fw.write(header)
+        for name in names:
+            fw.write(state_dict[name].detach().cpu().contiguous().numpy().tobytes())
+
+
+def load_flat_checkpoint(path):
+    """
+    :return: (a dict from names to tensors memory-mapped from the file, the metadata dict).
+    """
+    with open(path, 'rb') as fr:
+        header_size = struct.unpack('<Q', fr.read(8))[0]
+        header = json.loads(fr.read(header_size).decode('utf-8'))
+    metadata = header.pop('__metadata__', {})
+    data_size = max([info['data_offsets'][1] for info in header.values()], default=0)
+    state_dict = {}
+    if data_size == 0:
+        return state_dict, metadata
+    # copy-on-write: the pages are shared with the page cache until a tensor is modified in place
+    data = np.memmap(path, dtype=np.uint8, mode='c', offset=8 + header_size, shape=(data_size,))
+    for name, info in header.items():
+        start, end = info['data_offsets']
+        array = data[start:end].view(NUMPY_DTYPES[info['dtype']]).reshape(info['shape'])
+        state_dict[name] = torch.from_numpy(array)
+    return state_dict, metadata
+
+
+@contextlib.contextmanager
+def skip_init():
+    """
+    Skip the random initialization of the modules created in this context (their weights
+    are overwritten by the checkpoint anyway).
+    """
+    names = ['uniform_', 'normal_', 'trunc_normal_', 'constant_', 'ones_', 'zeros_', 'xavier_uniform_',
+             'xavier_normal_', 'kaiming_uniform_', 'kaiming_normal_', 'orthogonal_']
+    init_fns = [getattr(nn.init, name) for name in names if hasattr(nn.init, name)]
+    # nn.init and the torch.nn modules that import its functions by name (e.g. MultiheadAttention
+    # in torch.nn.modules.activation)
+    originals = []
+    for module_name, module in list(sys.modules.items()):
+        if module is nn.init or (module_name.startswith('torch.nn.modules.') and module is not None):
+            originals += [(module, name, fn) for name, fn in vars(module).items()
+                          if any(fn is init_fn for init_fn in init_fns)]
+    try:
+        for module, name, _ in originals:
+            setattr(module, name, lambda tensor, *args, **kwargs: tensor)
+        yield
+    finally:
+        for module, name, fn in originals:
+            setattr(module, name, fn)
+
+
+def assign_state_dict(model, state_dict):
+    """
+    Like model.load_state_dict(state_dict, strict=False), but the tensors of state_dict become the
+    parameters and buffers of the model instead of being copied into them.
+
+    :return: (the missing keys, the unexpected keys).
+    """
+    own = model.state_dict(keep_vars=True)
+    for name, tensor in state_dict.items():
+        if name not in own:
+            continue
+        if own[name].shape != tensor.shape:
+            raise RuntimeError(f'{name}: the checkpoint has shape {tuple(tensor.shape)}, '
+                               f'the model {tuple(own[name].shape)}')
+        module_name, _, attr = name.rpartition('.')
+        module = model
+        for part in module_name.split('.') if module_name else []:
+            module = getattr(module, part)
+        if attr in module._parameters:
+            module._parameters[attr] = nn.Parameter(tensor, requires_grad=own[name].requires_grad)
+        else:
+            module._buffers[attr] = tensor
+    return [name for name in own if name not in state_dict], [name for name in state_dict if name not in own]
+
+
+def load_flat_model_and_diffusion(args, data, path=None):
+    """
+    The flat checkpoint counterpart of create_model_and_diffusion + load_model_wo_clip.
+
+    :param path: the flat checkpoint, defaults to args.model_path.
+    """
+    state_dict, metadata = load_flat_checkpoint(path or args.model_path)
+    model_args = get_model_args(args, data)
+    clip_state_dict = {name[len('clip_model.'):]: tensor for name, tensor in state_dict.items()
+                       if name.startswith('clip_model.')}
+    clip_version = metadata.get('clip_version', model_args['clip_version'])
+    if len(clip_state_dict) > 0 and clip_version not in cmdm._CLIP_MODELS:
+        # the CLIP of the file, registered as the frozen CLIP shared by the CMDM instances
+        with skip_init():
+            clip_model = CLIPTextTower(**CLIPTextTower.config_from_state_dict(clip_state_dict))
+        assign_state_dict(clip_model, clip_state_dict)
+        clip_model.eval()
+        for p in clip_model.parameters():
+            p.requires_grad = False
+        cmdm._CLIP_MODELS[clip_version] = clip_model
+
+    with skip_init():
+        model = cmdm.CMDM(**model_args)
+    missing_keys, unexpected_keys = assign_state_dict(
+        model, {name: tensor for name, tensor in state_dict.items() if not name.startswith('clip_model.')})
+    print("unexpected_keys: ", unexpected_keys)
+    assert all([k.startswith('clip_model.') for k in missing_keys]), missing_keys
+    return model, create_gaussian_diffusion(args)
+
+
+def export_flat_checkpoint(model_path, output_path, include_clip=False, clip_version='ViT-B/32'):
+    state_dict = torch.load(model_path, map_location='cpu')
+    state_dict = {name: tensor for name, tensor in state_dict.items() if not name.startswith('clip_model.')}
+    metadata = {'source': os.path.basename(model_path)}
+    if include_clip:
+        import clip
+        clip_model, _ = clip.load(clip_version, device='cpu', jit=False)
+        clip.model.convert_weights(clip_model)  # the same weights as CMDM.load_and_freeze_clip
+        for name, tensor in clip_model.state_dict().items():
+            if name.startswith(TEXT_TOWER_PREFIXES):
+                state_dict['clip_model.' + name] = tensor
+        metadata['clip_version'] = clip_version
+    save_flat_checkpoint(state_dict, output_path, metadata)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--model_path', required=True, type=str, help='Path to the model#####.pt file to export.')
+    parser.add_argument('--output_path', default='', type=str,
+                        help='Path of the flat checkpoint, defaults to the model path with a .safetensors extension.')
+    parser.add_argument('--include_clip', action='store_true',
+                        help='Store the frozen CLIP text tower too, so that loading does not need clip.load.')
+    args = parser.parse_args()
+    output_path = args.output_path or os.path.splitext(args.model_path)[0] + '.safetensors'
+    export_flat_checkpoint(args.model_path, output_path, include_clip=args.include_clip)
+    print(f'Saved [{output_path}]')
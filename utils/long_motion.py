@@ -0,0 +1,142 @@
+import torch
+
+from data_loaders.humanml.scripts.motion_process import global_to_local
+
+
+def window_starts(n_frames, window, overlap):
+    """
+    The first frames of overlapping windows covering n_frames frames. The windows
+    overlap by `overlap` frames, except the last one, which is aligned with the end
+    of the motion and may overlap more.
+    """
+    assert 0 <= overlap < window
+    if n_frames <= window:
+        return [0]
+    starts = list(range(0, n_frames - window, window - overlap))
+    return starts + [n_frames - window]
+
+
+def sample_long_motion(diffusion, sample_fn, model, shape, model_kwargs, window=196, overlap=40, **kwargs):
+    """
+    Sample motions longer than the model's maximum length with overlapping windows.
+
+    Every window is conditioned on the frames it shares with the windows sampled
+    before it through inpainting (y['inpainting_mask'] and y['inpainted_motion'], see
+    GaussianDiffusion.p_mean_variance), and the windows are cross-faded over their
+    overlaps. The hml_vec features only depend on the global root pose through their
+    first frame, so the features of the windows are stitched as they are.
+
+    The hints are global positions. A window can only express them in its own coordinates
+    once the motion before it is known, so with hints the windows are sampled one after the
+    other. Without hints, every other window is sampled in a first batch, and the windows
+    in between, conditioned on both of their neighbours, in a second one.
+
+    :param diffusion: the GaussianDiffusion, for the feature and hint normalizations.
+    :param sample_fn: the sampling loop, see get_sample_fn.
+    :param shape: (N, C, 1, n_frames), n_frames can be larger than window.
+    :param model_kwargs: y['hint'], if given, is [N x n_frames x n_joints * 3], y['mask'] and
+                         y['lengths'] are replaced for every window.
+    :param window: the number of frames of a window.
+    :param overlap: the number of frames shared by two consecutive windows.
+    :param kwargs: the other arguments of sample_fn.
+    :return: [N x C x 1 x n_frames] the samples.
+    """
+    bs, n_frames = shape[0], shape[-1]
+    y = model_kwargs['y']
+    starts = window_starts(n_frames, window, overlap)
+    n_windows = len(starts)
+    if 'hint' in y:
+        rounds = [[k] for k in range(n_windows)]
+    else:
+        rounds = [list(range(0, n_windows, 2)), list(range(1, n_windows, 2))]
+
+    windows = [None] * n_windows
+    for ks in rounds:
+        if len(ks) == 0:
+            continue
+        prefix = stitch_windows(windows[:ks[0]], starts) if 'hint' in y and ks[0] > 0 else None
+        ys = [_window_y(diffusion, y, windows, starts, k, window, prefix) for k in ks]
+        batch_y = _cat_y(ys, bs)
+        samples = sample_fn(model, (bs * len(ks),) + tuple(shape[1:-1]) + (window,),
+                            model_kwargs=dict(model_kwargs, y=batch_y), **kwargs)
+        for k, sample in zip(ks, samples.split(bs)):
+            windows[k] = sample
+    return stitch_windows(windows, starts)
+
+
+def stitch_windows(windows, starts):
+    """
+    Concatenate consecutive windows of features, cross-fading linearly over their overlaps.
+    The root velocities (features 0-2) are taken from the later window over the overlap, they
+    are integrated into the root trajectory, and the later window was sampled (and its hints
+    expressed) relative to its own trajectory from its first frame on.
+
+    :param windows: a list of [N x C x 1 x window] features.
+    :param starts: the first frame of each window.
+    """
+    motion = windows[0]
+    for k in range(1, len(windows)):
+        end = motion.shape[-1]
+        n_overlap = end - starts[k]
+        w = torch.arange(1, n_overlap + 1, device=motion.device, dtype=motion.dtype) / (n_overlap + 1)
+        w = w.repeat(motion.shape[1], 1, 1)
+        w[:3] = 1
+        blended = motion[..., starts[k]:] * (1 - w) + windows[k][..., :n_overlap] * w
+        motion = torch.cat([motion[..., :starts[k]], blended, windows[k][..., n_overlap:]], dim=-1)
+    return motion
+
+
+def _window_y(diffusion, y, windows, starts, k, window, prefix=None):
+    # the model_kwargs['y'] of window k, prefix is the stitched motion before it (needed for the hints)
+    bs = len(y['lengths'])
+    start, end = starts[k], starts[k] + window
+    device = y['mask'].device
+    y_k = {key: v for key, v in y.items() if key not in ['hint', 'mask', 'lengths']}
+    y_k['mask'] = torch.ones(bs, 1, 1, window, dtype=torch.bool, device=device)
+    y_k['lengths'] = torch.full((bs,), window, dtype=torch.long, device=y['lengths'].device)
+
+    if 'hint' in y:
+        hint = y['hint'][:, start:end]
+        if prefix is not None:
+            n_joints = hint.shape[-1] // 3
+            raw_mean, raw_std = diffusion.raw_mean.to(hint.device), diffusion.raw_std.to(hint.device)
+            mean, std = diffusion.mean.to(hint.device), diffusion.std.to(hint.device)
+            mask = hint.view(bs, window, n_joints, 3).sum(dim=-1, keepdim=True) != 0
+            positions = (hint * raw_std + raw_mean).view(bs, window, n_joints, 3)
+            data = prefix[..., :start + 1].squeeze(2).permute(0, 2, 1) * std + mean
+            positions = global_to_local(positions, data)
+            hint = ((positions.reshape(bs, window, -1) - raw_mean) / raw_std).view(bs, window, n_joints, 3) * mask
+            hint = hint.view(bs, window, -1).to(y['hint'].dtype)
+        y_k['hint'] = hint
+
+    # condition on the overlaps with the neighbouring windows that are already sampled
+    neighbours = [w for w in windows[max(k - 1, 0):k] + windows[k + 1:k + 2] if w is not None]
+    if len(neighbours) > 0:
+        inpainting_mask = torch.zeros_like(neighbours[0], dtype=torch.bool)
+        inpainted_motion = torch.zeros_like(neighbours[0])
+        if k > 0 and windows[k - 1] is not None:
+            n_overlap = starts[k - 1] + window - start
+            inpainting_mask[..., :n_overlap] = True
+            inpainted_motion[..., :n_overlap] = windows[k - 1][..., window - n_overlap:]
+        if k + 1 < len(windows) and windows[k + 1] is not None:
+            n_overlap = end - starts[k + 1]
+            inpainting_mask[..., window - n_overlap:] = True
+            inpainted_motion[..., window - n_overlap:] = windows[k + 1][..., :n_overlap]
+        y_k['inpainting_mask'] = inpainting_mask
+        y_k['inpainted_motion'] = inpainted_motion
+    return y_k
+
+
+def _cat_y(ys, bs):
+    # batch the model_kwargs['y'] of several windows
+    # the windows of a batch are either all inpainted or none of them is
+    batch_y = {}
+    for key in ys[0]:
+        v = ys[0][key]
+        if torch.is_tensor(v) and v.dim() > 0 and v.shape[0] == bs:
+            batch_y[key] = torch.cat([y_k[key] for y_k in ys])
+        elif isinstance(v, list) and len(v) == bs:
+            batch_y[key] = sum([y_k[key] for y_k in ys], [])
+        else:
+            batch_y[key] = v
+    return batch_y
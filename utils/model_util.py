@@ -1,7 +1,15 @@
 # This code is based on https://github.com/GuyTevet/motion-diffusion-model
+from functools import partial
+import torch
 from model.cmdm import CMDM
+from model.quantization import quantize_cmdm
+from utils import dist_util
 from diffusion import gaussian_diffusion as gd
 from diffusion.respace import SpacedDiffusion, space_timesteps
+from diffusion.guidance import create_named_guidance_schedule
+
+# the number of diffusion steps the models are trained with, sampling respaces them
+DIFFUSION_STEPS = 1000
 
 
 def load_model_wo_clip(model, state_dict):
@@ -17,6 +25,30 @@ def create_model_and_diffusion(args, data):
     return model, diffusion
 
 
+def load_model_and_diffusion(args, data, quantize=None):
+    """
+    create_model_and_diffusion with the weights of args.model_path, a torch checkpoint or its
+    flat export (see utils/flat_checkpoint.py).
+
+    :param quantize: if True, the model is quantized to int8 for the CPU (see model/quantization.py).
+                     Defaults to args.quantize.
+    """
+    from utils.flat_checkpoint import is_flat_checkpoint, load_flat_model_and_diffusion
+    if is_flat_checkpoint(args.model_path):
+        # the weights are memory-mapped, the model is not randomly initialized first
+        model, diffusion = load_flat_model_and_diffusion(args, data)
+    else:
+        model, diffusion = create_model_and_diffusion(args, data)
+        state_dict = torch.load(args.model_path, map_location='cpu')
+        load_model_wo_clip(model, state_dict)
+    if quantize is None:
+        quantize = getattr(args, 'quantize', False)
+    if quantize:
+        assert dist_util.dev().type == 'cpu', 'the quantized model runs on the cpu only, use --device -1'
+        model = quantize_cmdm(model)
+    return model, diffusion
+
+
 def get_model_args(args, data):
 
     # default args
@@ -46,24 +78,37 @@ def get_model_args(args, data):
             'latent_dim': args.latent_dim, 'ff_size': 1024, 'num_layers': args.layers, 'num_heads': 4,
             'dropout': 0.1, 'activation': "gelu", 'data_rep': data_rep, 'cond_mode': args.cond_mode,
             'cond_mask_prob': args.cond_mask_prob, 'action_emb': action_emb, 'arch': args.arch,
-            'emb_trans_dec': args.emb_trans_dec, 'clip_version': clip_version, 'dataset': args.dataset}
+            'emb_trans_dec': args.emb_trans_dec, 'clip_version': clip_version, 'dataset': args.dataset,
+            'skip_empty_control': getattr(args, 'skip_empty_control', False),
+            'precision': getattr(args, 'precision', 'fp32'), 'num_timesteps': DIFFUSION_STEPS,
+            'mask_padding': getattr(args, 'length_bucket_size', 0) > 0}
 
 
-def create_gaussian_diffusion(args):
+def create_gaussian_diffusion(args, norm_stats=None):
     # default params
     predict_xstart = True  # we always predict x_start (a.k.a. x0), that's our deal!
-    steps = 1000
+    steps = DIFFUSION_STEPS
     scale_beta = 1.  # no scaling
-    timestep_respacing = ''  # can be used for ddim sampling, we don't use it.
     learn_sigma = False
     rescale_timesteps = False
 
     betas = gd.get_named_beta_schedule(args.noise_schedule, steps, scale_beta)
     loss_type = gd.LossType.MSE
 
+    # respacing is used at sampling time only (e.g. for ddim), training always uses all the steps
+    sample_steps = getattr(args, 'sample_steps', 0)
+    timestep_respacing = str(sample_steps) if sample_steps > 0 else ''
+    if sample_steps > 0 and getattr(args, 'sampler', 'ddpm') == 'dpmsolver':
+        timestep_respacing = f'quad{sample_steps}'  # multistep solvers need denser steps near t=0
     if not timestep_respacing:
         timestep_respacing = [steps]
 
+    guide_schedule = create_named_guidance_schedule(getattr(args, 'guide_preset', 'default'),
+                                                    atol=getattr(args, 'guide_atol', None),
+                                                    rtol=getattr(args, 'guide_rtol', None),
+                                                    optimizer=getattr(args, 'guide_optimizer', None),
+                                                    root_projection=getattr(args, 'guide_root_projection', None))
+
     return SpacedDiffusion(
         use_timesteps=space_timesteps(steps, timestep_respacing),
         betas=betas,
@@ -84,5 +129,63 @@ def create_gaussian_diffusion(args):
         lambda_vel=args.lambda_vel,
         lambda_rcxyz=args.lambda_rcxyz,
         lambda_fc=args.lambda_fc,
-        dataset=args.dataset
-    )
\ No newline at end of file
+        dataset=args.dataset,
+        guide_schedule=guide_schedule,
+        norm_stats=norm_stats,
+    )
+
+
+def get_sample_fn(args, diffusion):
+    if args.sampler == 'ddpm':
+        sample_fn = diffusion.p_sample_loop
+    elif args.sampler == 'ddim':
+        sample_fn = partial(diffusion.ddim_sample_loop, eta=args.ddim_eta)
+    elif args.sampler == 'dpmsolver':
+        sample_fn = partial(diffusion.dpm_solver_sample_loop, order=args.dpm_solver_order)
+    else:
+        raise ValueError(f'unknown sampler: {args.sampler}')
+    if getattr(args, 'length_bucket_size', 0) > 0:
+        sample_fn = bucket_by_length(sample_fn, args.length_bucket_size)
+    return sample_fn
+
+
+def bucket_by_length(sample_fn, bucket_size):
+    """
+    Wrap sample_fn so that the samples of a batch are grouped by y['lengths'] rounded up to a
+    multiple of bucket_size, and each group is sampled with that many frames only.
+    The samples are zero-padded back to the requested number of frames.
+    """
+    def bucketed_sample_fn(model, shape, noise=None, model_kwargs=None, dump_steps=None, cancel=None, **kwargs):
+        assert dump_steps is None, 'dump_steps is not supported with length buckets'
+        assert cancel is None, 'cancel is not supported with length buckets'
+        y = model_kwargs['y']
+        bs, n_frames = shape[0], shape[-1]
+        bucket_lengths = torch.clamp((y['lengths'] + bucket_size - 1) // bucket_size * bucket_size, 1, n_frames)
+        sample = None
+        for length in torch.unique(bucket_lengths).tolist():
+            idx = torch.nonzero(bucket_lengths == length).squeeze(1)
+            bucket_kwargs = dict(model_kwargs, y=_select_frames(y, idx, bs, length))
+            bucket_noise = noise[idx.to(noise.device)][..., :length] if noise is not None else None
+            bucket_sample = sample_fn(model, (len(idx),) + tuple(shape[1:-1]) + (length,), noise=bucket_noise,
+                                      model_kwargs=bucket_kwargs, dump_steps=None, **kwargs)
+            if sample is None:
+                sample = bucket_sample.new_zeros(shape)
+            sample[idx.to(sample.device), ..., :length] = bucket_sample
+        return sample
+    return bucketed_sample_fn
+
+
+def _select_frames(y, idx, bs, n_frames):
+    # the samples idx of the batch-sized entries of y, cut to their first n_frames frames
+    y_sel = {}
+    for k, v in y.items():
+        if torch.is_tensor(v) and v.dim() > 0 and v.shape[0] == bs:
+            v = v[idx.to(v.device)]
+            if k == 'hint':
+                v = v[:, :n_frames]
+            elif k in ['mask', 'inpainting_mask', 'inpainted_motion']:
+                v = v[..., :n_frames]
+        elif isinstance(v, list) and len(v) == bs:
+            v = [v[i] for i in idx.tolist()]
+        y_sel[k] = v
+    return y_sel
\ No newline at end of file
@@ -143,7 +143,7 @@ def add_training_options(parser):
 def add_sampling_options(parser):
     group = parser.add_argument_group('sampling')
     group.add_argument("--model_path", required=True, type=str,
-                       help="Path to model####.pt file to be sampled.")
+                       help="Path to model####.pt file to be sampled (or its .safetensors export, see utils/flat_checkpoint.py).")
     group.add_argument("--output_dir", default='', type=str,
                        help="Path to results dir (auto created by the script). "
                             "If empty, will create dir in parallel to checkpoint.")
@@ -160,12 +160,100 @@ def add_generate_options(parser):
     group = parser.add_argument_group('generate')
     group.add_argument("--motion_length", default=6.0, type=float,
                        help="The length of the sampled motion [in seconds]. "
-                            "Maximum is 9.8 for HumanML3D (text-to-motion), and 2.0 for HumanAct12 (action-to-motion)")
+                            "Maximum is 9.8 for HumanML3D (text-to-motion), and 2.0 for HumanAct12 (action-to-motion). "
+                            "Longer text-prompt motions (and --control_path hints longer than 196 frames) are sampled "
+                            "with overlapping windows of 196 frames.")
     group.add_argument("--cond_mode", default='both_text_spatial', type=str,
                        help="generation mode: both_text_spatial, only_text, only_spatial. Other words will be used as text prompt.")
     group.add_argument("--text_prompt", default='predefined', type=str,
                        help="A text prompt to be generated. If empty, will take text prompts from dataset.")
     group.add_argument('--control_path', type=str, default='', help='path to npy with spatial control')
+    group.add_argument("--window_overlap", default=40, type=int,
+                       help="For motions longer than 196 frames - the number of frames two consecutive windows share. "
+                            "Each window is inpainted on its overlap with the previous one.")
+
+
+def add_sampler_options(parser):
+    group = parser.add_argument_group('sampler')
+    group.add_argument("--sampler", default='ddpm', choices=['ddpm', 'ddim', 'dpmsolver'], type=str,
+                       help="Sampling algorithm. ddpm runs the ancestral sampler over all the sampling steps, "
+                            "dpmsolver is the multistep DPM-Solver++ (use with --sample_steps 15-25).")
+    group.add_argument("--sample_steps", default=0, type=int,
+                       help="Number of respaced timesteps to sample with (e.g. 50 or 100 for ddim). "
+                            "If 0, will use all diffusion steps.")
+    group.add_argument("--ddim_eta", default=0.0, type=float,
+                       help="For ddim sampling - the noise level eta. 0 is deterministic.")
+    group.add_argument("--dpm_solver_order", default=2, choices=[1, 2, 3], type=int,
+                       help="For dpmsolver sampling - 2 for DPM-Solver++(2M), 3 for DPM-Solver++(3M).")
+    group.add_argument("--fused_cfg", action='store_true',
+                       help="For classifier-free sampling - run the conditional and unconditional passes "
+                            "as a single forward pass over a doubled batch.")
+    group.add_argument("--guidance_interval", default=None, nargs=2, type=int, metavar=('LO', 'HI'),
+                       help="For classifier-free sampling - apply the guidance only at diffusion timesteps "
+                            "in [LO, HI] (0 is the last denoising step), and run only the conditional pass elsewhere.")
+    group.add_argument("--guidance_schedule", default='constant', choices=['constant', 'linear', 'cosine'], type=str,
+                       help="For classifier-free sampling - how the guidance scale is weighted over the timesteps. "
+                            "linear/cosine fade the guidance out towards the last, low-noise, steps.")
+    group.add_argument("--length_bucket_size", default=0, type=int,
+                       help="If > 0, the samples of a batch are grouped by their length rounded up to a multiple of "
+                            "this many frames, each group is sampled with only that many frames and the padded "
+                            "frames are masked out of the attention. 0 samples every motion with all the frames. "
+                            "The spatial guidance runs once per group, so this pays off most for text-only sampling.")
+    group.add_argument("--skip_empty_control", action='store_true',
+                       help="Skip the control branch for the samples that have no hint (text-only), instead of "
+                            "running it on an all-zero hint. Roughly halves the cost of text-only sampling, "
+                            "check its effect on a checkpoint with eval_humanml --text_only.")
+    group.add_argument("--precision", default='fp32', choices=['fp32', 'bf16', 'fp16'], type=str,
+                       help="Precision of the model forward passes (autocast), the spatial guidance and the "
+                            "diffusion steps stay in fp32. bf16 needs a recent GPU, or a CPU with bf16 support. "
+                            "Check the drift from fp32 on a checkpoint with python -m sample.precision_drift.")
+    group.add_argument("--quantize", action='store_true',
+                       help="Dynamic int8 quantization of the model linear layers, for sampling on the CPU "
+                            "(--device -1). With eval_humanml, both the fp32 and the int8 models are evaluated "
+                            "and the metric deltas are reported.")
+    group.add_argument("--profile", action='store_true',
+                       help="Time the stages of the sampling loop (model passes, CFG passes, control branch, "
+                            "trunk, CLIP, spatial guidance) at every denoising step. generate writes them to "
+                            "progress.csv in the output dir, with a Chrome trace (sampling_trace.json).")
+    group.add_argument("--profile_sync_cuda", action='store_true',
+                       help="With --profile, synchronize CUDA at every stage boundary, so that the GPU time is "
+                            "accounted to the right stage. Slows sampling down, avoid it on a server.")
+    group.add_argument("--guide_preset", default='default', choices=['default', 'converge', 'fast', 'lbfgs', 'none'], type=str,
+                       help="Spatial guidance schedule (gradient steps per denoising step and stopping rule). "
+                            "default is the fixed schedule of the paper, converge/fast stop each sample once its "
+                            "control error has converged, lbfgs also uses L-BFGS steps for the last timesteps, "
+                            "none disables the spatial guidance.")
+    group.add_argument("--guide_optimizer", default=None, choices=['sgd', 'lbfgs'], type=str,
+                       help="Spatial guidance - optimizer of the last timesteps. Overrides the preset.")
+    group.add_argument("--guide_root_projection", default=None, action='store_true',
+                       help="Spatial guidance - if only the root joint is hinted, project the root trajectory onto "
+                            "the hints in closed form at the last timesteps, instead of gradient steps. "
+                            "Enabled by the converge/fast/lbfgs presets.")
+    group.add_argument("--guide_atol", default=None, type=float,
+                       help="Spatial guidance - stop a sample once its mean control error (in meters) is below this. "
+                            "Overrides the preset.")
+    group.add_argument("--guide_rtol", default=None, type=float,
+                       help="Spatial guidance - stop a sample once its control error decreases by less than this "
+                            "fraction in one gradient step. Overrides the preset.")
+
+
+def add_server_options(parser):
+    group = parser.add_argument_group('server')
+    group.add_argument("--host", default='127.0.0.1', type=str, help="Address the server listens on.")
+    group.add_argument("--port", default=8000, type=int, help="Port the server listens on.")
+    group.add_argument("--socket", default='', type=str,
+                       help="If specified, listen on this Unix socket instead of host:port.")
+    group.add_argument("--max_batch_size", default=32, type=int,
+                       help="Maximal number of requests sampled together in one batch.")
+    group.add_argument("--max_wait_ms", default=20., type=float,
+                       help="How long the first request of a batch waits for more requests to join it [in ms].")
+    group.add_argument("--continuous_batching", action='store_true',
+                       help="Let the requests join and leave the batch at every denoising step, instead of "
+                            "sampling them batch after batch. Supports the ddpm and ddim samplers.")
+    group.add_argument("--deadline_aware", action='store_true',
+                       help="Measure the sampling costs at startup, and sample each batch with the best "
+                            "sampler/steps/guidance configuration that fits the tightest deadline_ms of its requests. "
+                            "Not used with --continuous_batching.")
 
 
 def add_edit_options(parser):
@@ -188,11 +276,14 @@ def add_edit_options(parser):
 def add_evaluation_options(parser):
     group = parser.add_argument_group('eval')
     group.add_argument("--model_path", required=True, type=str,
-                       help="Path to model####.pt file to be sampled.")
+                       help="Path to model####.pt file to be sampled (or its .safetensors export, see utils/flat_checkpoint.py).")
     group.add_argument("--eval_mode", default='omnicontrol', choices=['omnicontrol'], type=str,
                        help="")
     group.add_argument("--guidance_param", default=2.5, type=float,
                        help="For classifier-free sampling - specifies the s parameter, as defined in the paper.")
+    group.add_argument("--text_only", action='store_true',
+                       help="Generate from the text only (the hints are dropped), with and without the control branch "
+                            "(see --skip_empty_control), to compare their FID/R-precision.")
 
 
 def train_args():
@@ -211,16 +302,29 @@ def generate_args():
     # args specified by the user: (all other will be loaded from the model)
     add_base_options(parser)
     add_sampling_options(parser)
+    add_sampler_options(parser)
     add_generate_options(parser)
     args = parse_and_load_from_model(parser)
 
     return args
 
 
+def server_args():
+    parser = ArgumentParser()
+    # args specified by the user: (all other will be loaded from the model)
+    add_base_options(parser)
+    add_sampling_options(parser)
+    add_sampler_options(parser)
+    add_generate_options(parser)
+    add_server_options(parser)
+    return parse_and_load_from_model(parser)
+
+
 def evaluation_parser():
     parser = ArgumentParser()
     # args specified by the user: (all other will be loaded from the model)
     add_base_options(parser)
     add_evaluation_options(parser)
+    add_sampler_options(parser)
     add_generate_options(parser)
     return parse_and_load_from_model(parser)
\ No newline at end of file